@@ -0,0 +1,119 @@
+"""Throughput and peak memory/disk of the streaming CLI extraction.
+
+Builds a .tar.gz with a `code` member, feeds it to CLIExtractor the way the
+downloader does and checks the peaks against the bounds documented in
+archive.py. Exits non-zero when a bound is exceeded:
+
+    python benchmarks/bench_extract.py [--size-mb N] [--json]
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import sys
+import tarfile
+import tempfile
+import time
+import tracemalloc
+
+from common import load
+
+archive = load("archive")
+downloader = load("downloader")
+
+# archive.py: queue, copy buffers and zlib window stay under this, nothing scales
+# with the archive or its compression ratio.
+MEMORY_BOUND = 1024 * 1024
+
+
+def make_archive(size):
+    # blocks of half random, half repeated bytes: compresses about 2:1 like the
+    # real binary does, for a representative throughput. tests/test_archive.py
+    # holds the bound for archives that compress far better.
+    block = 4096
+    payload = b"".join(
+        os.urandom(block // 2) + bytes(block // 2) for _ in range(size // block)
+    )
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        info = tarfile.TarInfo("code")
+        info.size = len(payload)
+        info.mode = 0o755
+        tar.addfile(info, io.BytesIO(payload))
+    return buffer.getvalue(), payload
+
+
+def disk_usage(directory):
+    return sum(
+        os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)
+    )
+
+
+async def extract(data, directory):
+    dest = os.path.join(directory, "code")
+    extractor = archive.CLIExtractor(dest)
+    peak_disk = 0
+    await extractor.start()
+    for offset in range(0, len(data), downloader.CHUNK_SIZE):
+        await extractor.write(data[offset : offset + downloader.CHUNK_SIZE])
+        peak_disk = max(peak_disk, disk_usage(directory))
+    await extractor.finish()
+    return dest, max(peak_disk, disk_usage(directory))
+
+
+def measure(size_mb=32):
+    data, payload = make_archive(size_mb * 1024 * 1024)
+    with tempfile.TemporaryDirectory() as directory:
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        dest, peak_disk = asyncio.run(extract(data, directory))
+        elapsed = time.perf_counter() - start
+        peak_memory = tracemalloc.get_traced_memory()[1] - baseline
+        tracemalloc.stop()
+
+        with open(dest, "rb") as extracted:
+            intact = extracted.read() == payload
+        leftovers = sorted(set(os.listdir(directory)) - {"code"})
+
+    result = {
+        "archive_bytes": len(data),
+        "member_bytes": len(payload),
+        "mb_per_second": len(data) / elapsed / 1e6,
+        "peak_memory_bytes": peak_memory,
+        "peak_disk_bytes": peak_disk,
+        "intact": intact,
+        "leftovers": leftovers,
+    }
+    failures = []
+    if not intact:
+        failures.append("extracted binary does not match")
+    if leftovers:
+        failures.append(f"intermediate files left behind: {leftovers}")
+    if peak_memory > MEMORY_BOUND:
+        failures.append(f"peak memory {peak_memory} > {MEMORY_BOUND}")
+    if peak_disk > len(payload):
+        failures.append(f"peak disk {peak_disk} > {len(payload)}")
+    result["failures"] = failures
+    return result
+
+
+def main(argv=None):
+    args = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    args.add_argument("--size-mb", type=int, default=32)
+    args.add_argument("--json", action="store_true", help="machine readable output")
+    args = args.parse_args(argv)
+
+    result = measure(args.size_mb)
+    if args.json:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+    else:
+        for key, value in result.items():
+            print(f"{key:18} {value}")
+    return 1 if result["failures"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
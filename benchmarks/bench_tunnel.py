@@ -0,0 +1,271 @@
+"""Latency of setting up, activating and stopping a tunnel, against stand-ins.
+
+A local HTTP server hands out a .tar.gz with fake_code.py as the `code` binary,
+and fake_code.py plays the CLI, so what is measured is our side of it. Every
+benchmark runs --repeat times:
+
+    register_cold   register() into an empty cache: download, extraction, version
+                    probe, spawn and the device code
+    register_warm   register() with the build cached, the server answers 304.
+                    This is the config flow's user step when a login is needed
+    flow_logged_in  the user step when the CLI is logged in already: register()
+                    and then getDevURL()
+    flow_activate   the activate step after a login: activate()
+    activate        from spawning the tunnel to the dev url
+    stop            asyncStopTunnel() of a tunnel with a server child
+    stop_hang       the same, for a tunnel that ignores SIGTERM
+    parallel        PARALLEL tunnels with data directories of their own, from
+                    spawning them together to the last dev url
+
+The config flow itself needs Home Assistant, so its steps are measured as the
+device calls they wait for:
+
+    python benchmarks/bench_tunnel.py [--repeat N] [--json]
+"""
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import logging
+import os
+import statistics
+import sys
+import tarfile
+import tempfile
+import time
+
+import aiohttp
+from aiohttp import web
+
+from common import HERE
+from common import load
+
+timing = load("timing")
+vscode_device = load("vscode_device")
+
+FAKE_CODE = os.path.join(HERE, "fake_code.py")
+# seconds, stop_hang takes at least this long
+STOP_GRACE = 0.2
+PARALLEL = 4
+
+
+def make_archive():
+    with open(FAKE_CODE, "rb") as fake:
+        payload = fake.read()
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        info = tarfile.TarInfo("code")
+        info.size = len(payload)
+        info.mode = 0o755
+        tar.addfile(info, io.BytesIO(payload))
+    return buffer.getvalue()
+
+
+async def serve(data):
+    """A download server for data on a free local port. Returns (runner, url)."""
+    etag = '"' + hashlib.sha256(data).hexdigest()[:16] + '"'
+
+    async def download(request):
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        return web.Response(
+            body=data, headers={"ETag": etag, "Content-Type": "application/gzip"}
+        )
+
+    app = web.Application()
+    app.router.add_get("/cli", download)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, f"http://{host}:{port}/cli"
+
+
+class Bench:
+    def __init__(self, directory, url, session):
+        self.directory = directory
+        self.url = url
+        self.session = session
+        self.script = os.path.join(directory, "script.json")
+        os.environ["FAKE_CODE_SCRIPT"] = self.script
+        # shared by every device, for the per phase breakdown
+        self.timings = timing.PhaseTimings()
+        self.cache = os.path.join(directory, "warm")
+
+    def configure(self, **config):
+        with open(self.script, "w", encoding="utf-8") as file:
+            json.dump(config, file)
+
+    def device(self, cache=None, **kwargs):
+        device = vscode_device.VSCodeDeviceAPI(
+            cache or self.cache,
+            session=self.session,
+            timings=self.timings,
+            stopGrace=STOP_GRACE,
+            **kwargs,
+        )
+        device.downloadURL = self.url
+        return device
+
+    async def register_cold(self):
+        self.configure(auth=True)
+        device = self.device(tempfile.mkdtemp(dir=self.directory))
+        seconds, token = await timed(device.register())
+        await device.asyncStopTunnel()
+        if not token:
+            raise RuntimeError("register() returned no device code")
+        return seconds
+
+    async def register_warm(self):
+        self.configure(auth=True)
+        device = self.device()
+        seconds, token = await timed(device.register())
+        await device.asyncStopTunnel()
+        if not token:
+            raise RuntimeError("register() returned no device code")
+        return seconds
+
+    async def flow_logged_in(self):
+        self.configure()
+        device = self.device()
+
+        async def step():
+            return await device.register() or await device.getDevURL()
+
+        seconds, url = await timed(step())
+        await device.asyncStopTunnel()
+        if not url:
+            raise RuntimeError("no dev url while logged in")
+        return seconds
+
+    async def flow_activate(self):
+        self.configure(auth=True)
+        device = self.device()
+        await device.register()
+        seconds, url = await timed(device.activate())
+        await device.asyncStopTunnel()
+        if not url:
+            raise RuntimeError("activate() returned no dev url")
+        return seconds
+
+    async def activate(self):
+        self.configure()
+        device = self.device()
+
+        async def start():
+            await device.asyncStartTunnel()
+            return await device.activate()
+
+        seconds, url = await timed(start())
+        await device.asyncStopTunnel()
+        if not url:
+            raise RuntimeError("activate() returned no dev url")
+        return seconds
+
+    async def stop(self, **config):
+        self.configure(server=True, **config)
+        device = self.device()
+        await device.asyncStartTunnel()
+        if not await device.activate():
+            raise RuntimeError("activate() returned no dev url")
+        seconds, _ = await timed(device.asyncStopTunnel())
+        return seconds
+
+    async def stop_hang(self):
+        return await self.stop(hang=True)
+
+    async def parallel(self):
+        self.configure(server=True)
+        devices = [
+            self.device(cliDataDir=os.path.join(self.directory, "tunnels", str(n)))
+            for n in range(PARALLEL)
+        ]
+
+        async def start(device):
+            await device.asyncStartTunnel()
+            return await device.activate()
+
+        seconds, urls = await timed(asyncio.gather(*map(start, devices)))
+        await asyncio.gather(*(device.asyncStopTunnel() for device in devices))
+        if not all(urls):
+            raise RuntimeError("a parallel tunnel returned no dev url")
+        return seconds
+
+
+async def timed(coro):
+    start = time.perf_counter()
+    result = await coro
+    return time.perf_counter() - start, result
+
+
+BENCHMARKS = (
+    "register_cold",
+    "register_warm",
+    "flow_logged_in",
+    "flow_activate",
+    "activate",
+    "stop",
+    "stop_hang",
+    "parallel",
+)
+
+
+async def run(repeat, names):
+    runner, url = await serve(make_archive())
+    try:
+        async with aiohttp.ClientSession() as session:
+            with tempfile.TemporaryDirectory() as directory:
+                bench = Bench(directory, url, session)
+                # fills the warm cache, and the first spawn of python is slower
+                await bench.register_cold()
+                warm = bench.device()
+                await warm.register()
+                await warm.asyncStopTunnel()
+                bench.timings = timing.PhaseTimings()
+
+                results = {}
+                for name in names:
+                    samples = [await getattr(bench, name)() for _ in range(repeat)]
+                    results[name] = {
+                        "min_s": min(samples),
+                        "median_s": statistics.median(samples),
+                        "max_s": max(samples),
+                    }
+                results["phases"] = bench.timings.summary()
+                return results
+    finally:
+        await runner.cleanup()
+
+
+def measure(repeat=5, names=BENCHMARKS):
+    return asyncio.run(run(repeat, names))
+
+
+def main(argv=None):
+    args = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    args.add_argument("--repeat", type=int, default=5)
+    args.add_argument("--only", action="append", choices=BENCHMARKS)
+    args.add_argument("--json", action="store_true", help="machine readable output")
+    args = args.parse_args(argv)
+    # the hung tunnel gets killed on purpose, that is not news
+    logging.basicConfig(level=logging.ERROR)
+
+    results = measure(args.repeat, args.only or BENCHMARKS)
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+    for name, stats in results.items():
+        if name == "phases":
+            continue
+        print(
+            f"{name:15} median {stats['median_s'] * 1000:8.1f} ms"
+            f"  min {stats['min_s'] * 1000:8.1f} ms"
+            f"  max {stats['max_s'] * 1000:8.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Micro-benchmark for the tunnel output parser.
+
+Feeds the recorded `code tunnel` transcripts in benchmarks/transcripts through
+TunnelOutputParser and reports lines per second:
+
+    python benchmarks/bench_tunnel_output.py [--json] [transcript ...]
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import timeit
+
+from common import HERE
+from common import load
+
+tunnel_output = load("tunnel_output")
+
+
+def make_parser(event_types):
+    parser = tunnel_output.TunnelOutputParser()
+    for event_type in event_types:
+        parser.subscribe(event_type, lambda event: None)
+    return parser
+
+
+SCENARIOS = {
+    # what VSCodeDeviceAPI subscribes to
+    "device": [
+        tunnel_output.EVENT_DEVICE_CODE,
+        tunnel_output.EVENT_TUNNEL_URL,
+        tunnel_output.EVENT_ERROR,
+        tunnel_output.EVENT_UPDATE_AVAILABLE,
+    ],
+    "all": list(tunnel_output.EVENT_PATTERNS),
+    "none": [],
+}
+
+
+def run(lines, repeat=5, number=200):
+    results = {}
+    for scenario, event_types in SCENARIOS.items():
+        parser = make_parser(event_types)
+        feed = parser.feed
+
+        def feed_all():
+            for line in lines:
+                feed(line)
+
+        best = min(timeit.repeat(feed_all, repeat=repeat, number=number))
+        results[scenario] = len(lines) * number / best
+    return results
+
+
+def measure(paths=None):
+    paths = paths or sorted(glob.glob(os.path.join(HERE, "transcripts", "*.txt")))
+    report = {}
+    for path in paths:
+        with open(path, encoding="utf-8") as transcript:
+            lines = [line.strip() for line in transcript]
+        report[os.path.basename(path)] = run(lines)
+    return report
+
+
+def main(argv=None):
+    args = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    args.add_argument("transcripts", nargs="*")
+    args.add_argument("--json", action="store_true", help="machine readable output")
+    args = args.parse_args(argv)
+
+    report = measure(args.transcripts)
+    if args.json:
+        json.dump({"lines_per_second": report}, sys.stdout, indent=2)
+        print()
+        return
+    for name, results in report.items():
+        for scenario, rate in results.items():
+            print(f"{name:20} {scenario:8} {rate:14,.0f} lines/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""A stand-in for the `code` CLI, for the soak harness.
+
+`code tunnel` writes the lines the real CLI writes, with jitter between them,
+and then stays up until it is signalled. What it does is read from the JSON
+file named by $FAKE_CODE_SCRIPT when it starts, so a driver can change it
+between runs:
+
+    auth         print a device code, and say "not logged in" to `user show`
+    name         the tunnel name, "soak" by default
+    jitter       [low, high] seconds of sleep before every line
+    noise        lines of chatter before the url
+    errors       error lines before the url
+    url          print the url at all, true by default
+    server       start a child process, like the CLI starts the VSCode server
+    hang         ignore SIGTERM, so a stop has to escalate to SIGKILL
+    crash_after  exit this many seconds after the url, with exit_code. Only if
+                 the file <script>.crash exists, which is removed, so the
+                 restart that follows comes up normally
+
+The name given with --name wins over the script's. --cli-data-dir is accepted
+and ignored. The short lived subcommands the integration runs (`tunnel user
+show`, `tunnel status`, `tunnel unregister`, `version`) answer right away.
+"""
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import time
+
+SERVER = "import time\nwhile True:\n    time.sleep(60)"
+
+
+def script():
+    path = os.environ.get("FAKE_CODE_SCRIPT")
+    if not path:
+        return {}, None
+    try:
+        with open(path, encoding="utf-8") as file:
+            return json.load(file), path
+    except (OSError, ValueError):
+        return {}, path
+
+
+def crash_marker(path):
+    # only one of the processes started from a script crashes
+    if path is None:
+        return False
+    try:
+        os.remove(path + ".crash")
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def say(line, jitter):
+    if jitter:
+        time.sleep(random.uniform(*jitter))
+    print(line, flush=True)
+
+
+def stamp():
+    return time.strftime("[%Y-%m-%d %H:%M:%S]")
+
+
+def tunnel(config, path, args):
+    name = config.get("name", "soak")
+    if "--name" in args:
+        name = args[args.index("--name") + 1]
+    jitter = config.get("jitter")
+    if config.get("hang"):
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    crash = config.get("crash_after") is not None and crash_marker(path)
+
+    for line in ("*", "* Visual Studio Code Server", "*"):
+        say(line, jitter)
+    if config.get("auth"):
+        say(
+            "To grant access to the server, please log into "
+            "https://github.com/login/device and use code FAKE-"
+            + str(random.randint(1000, 9999)),
+            jitter,
+        )
+    for i in range(config.get("noise", 0)):
+        say(stamp() + " info [rpc.0] chatter " + str(i), jitter)
+    for i in range(config.get("errors", 0)):
+        say(stamp() + " error Error connecting to tunnel: attempt " + str(i), jitter)
+    say(stamp() + " info Creating tunnel with the name: " + name, jitter)
+    if config.get("server"):
+        # the real server logs to a file, not to the tunnel's stdout
+        subprocess.Popen(
+            [sys.executable, "-c", SERVER],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+    if config.get("url", True):
+        say(
+            "Open this link in your browser https://vscode.dev/tunnel/"
+            + name
+            + "/config",
+            jitter,
+        )
+    if crash:
+        time.sleep(config["crash_after"])
+        sys.exit(config.get("exit_code", 1))
+    while True:
+        time.sleep(60)
+
+
+def main(args):
+    config, path = script()
+    if args[:1] == ["--cli-data-dir"]:
+        args = args[2:]
+    if args[:3] == ["tunnel", "user", "show"]:
+        if config.get("auth"):
+            print("Not logged in")
+            return 1
+        print("Logged in with provider github")
+        return 0
+    if args[:2] == ["tunnel", "status"]:
+        name = config.get("name", "soak")
+        print(json.dumps({"tunnel": {"name": name}, "service_installed": False}))
+        return 0
+    if args[:2] == ["tunnel", "unregister"]:
+        return 0
+    if args[:1] in (["version"], ["--version"]):
+        print("code 1.81.0 (commit 6c3e3dba23e8fadc360aed75ce363ba185c49794)")
+        return 0
+    if args[:1] == ["tunnel"]:
+        tunnel(config, path, args)
+    print("fake code: unknown command " + " ".join(args), file=sys.stderr)
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
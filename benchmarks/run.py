@@ -0,0 +1,136 @@
+"""Run every benchmark and write one JSON report, optionally against a baseline.
+
+    python benchmarks/run.py [--quick] [--output results.json]
+                             [--compare baseline.json] [--tolerance 0.25]
+                             [--min-seconds 0.005]
+
+The report carries the git revision, Python version and machine, so reports
+from different releases or hosts can be told apart. With --compare, every
+number that got worse than the baseline by more than the tolerance is listed
+and the exit status is non-zero. Rates (`*_per_second`) are worse when lower,
+the min and median of latencies and peak memory and disk use when higher. Maxima
+and the per phase breakdown are reported, but too noisy to compare, and so are
+latencies that moved by less than --min-seconds.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import bench_extract
+import bench_tunnel
+import bench_tunnel_output
+from common import HERE
+
+
+def revision():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=HERE,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def collect(quick):
+    return {
+        "extract": bench_extract.measure(8 if quick else 32),
+        "tunnel_output": {"lines_per_second": bench_tunnel_output.measure()},
+        "tunnel": bench_tunnel.measure(3 if quick else 10),
+    }
+
+
+def flatten(tree, prefix=""):
+    for key, value in tree.items():
+        path = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            yield from flatten(value, path)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield path, value
+
+
+def direction(path):
+    """1 if higher is better, -1 if lower is, None for numbers that are neither."""
+    parts = path.split(".")
+    if any(part.endswith("per_second") for part in parts):
+        return 1
+    if "phases" in parts:
+        return None
+    if parts[-1] in ("min_s", "median_s"):
+        return -1
+    if parts[-1].startswith("peak_") and parts[-1].endswith("_bytes"):
+        return -1
+    return None
+
+
+def compare(results, baseline, tolerance, min_seconds):
+    before = dict(flatten(baseline.get("results", {})))
+    regressions = []
+    for path, value in flatten(results):
+        better = direction(path)
+        old = before.get(path)
+        if better is None or not old:
+            continue
+        if path.endswith("_s") and abs(value - old) < min_seconds:
+            continue
+        change = (value - old) / old
+        if -better * change > tolerance:
+            regressions.append({"metric": path, "baseline": old, "now": value})
+    return regressions
+
+
+def main(argv=None):
+    args = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    args.add_argument("--quick", action="store_true", help="fewer, smaller runs")
+    args.add_argument("--output", help="write the report here instead of stdout")
+    args.add_argument("--compare", help="a report of an earlier run")
+    args.add_argument("--tolerance", type=float, default=0.25)
+    args.add_argument("--min-seconds", type=float, default=0.005)
+    args = args.parse_args(argv)
+    logging.basicConfig(level=logging.ERROR)
+
+    report = {
+        "revision": revision(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "results": collect(args.quick),
+    }
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as baseline:
+            report["regressions"] = compare(
+                report["results"],
+                json.load(baseline),
+                args.tolerance,
+                args.min_seconds,
+            )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    failures = report["results"]["extract"]["failures"]
+    for failure in failures:
+        print("FAIL " + failure, file=sys.stderr)
+    for regression in report.get("regressions", ()):
+        print(
+            f"REGRESSION {regression['metric']}: {regression['baseline']:.6g}"
+            f" -> {regression['now']:.6g}",
+            file=sys.stderr,
+        )
+    return 1 if failures or report.get("regressions") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
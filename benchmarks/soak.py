@@ -0,0 +1,326 @@
+"""Start and stop a tunnel over and over, and check that nothing leaks.
+
+Drives VSCodeDeviceAPI against fake_code.py through a rotation of scenarios:
+plain starts, logins, a server child, noisy and failing output, restarts while
+running, on/off bursts, crashes the supervisor recovers from, tunnels that
+ignore SIGTERM and tunnels that never print a url. With --switch the tunnel is
+turned on and off through the switch entity, which needs Home Assistant
+installed; otherwise asyncSetDesired is called directly, which is all the
+switch does.
+
+After a warm up, the thread count, open file descriptors, child processes,
+pending tasks and RSS of this process are taken as the baseline. At the end
+they must be back at it, RSS within --rss-slack. Exits non-zero otherwise, or
+when a scenario does not behave:
+
+    python benchmarks/soak.py [--cycles N] [--scenarios a,b] [--switch] [--json] [-v]
+"""
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import os
+import stat
+import sys
+import tempfile
+import time
+
+from common import HERE
+from common import load
+
+process_tree = load("process_tree")
+vscode_device = load("vscode_device")
+
+FAKE_CODE = os.path.join(HERE, "fake_code.py")
+# seconds
+URL_TIMEOUT = 5.0
+# how long a tunnel that prints no url is given before it is stopped
+SILENT_TIMEOUT = 0.5
+JITTER = [0.0, 0.005]
+
+SCENARIOS = {
+    "plain": {},
+    "auth": {"auth": True},
+    "server": {"server": True},
+    "noisy": {"noise": 200, "errors": 5, "jitter": [0.0, 0.0005]},
+    "restart": {"server": True},
+    "burst": {},
+    "crash": {"crash_after": 0.05, "server": True},
+    "hang": {"hang": True, "server": True},
+    "silent": {"url": False},
+}
+
+
+class SoakError(Exception):
+    """A scenario did not do what it should."""
+
+
+def footprint():
+    gc.collect()
+    status = {}
+    with open("/proc/self/status", encoding="ascii") as lines:
+        for line in lines:
+            key, _, value = line.partition(":")
+            status[key] = value.split()
+    return {
+        "threads": int(status["Threads"][0]),
+        "fds": len(os.listdir("/proc/self/fd")),
+        "children": len(process_tree.descendants(os.getpid())),
+        "tasks": len(asyncio.all_tasks()),
+        "rss": int(status["VmRSS"][0]) * 1024,
+    }
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class Manager:
+    """Hands the switch entity the one device, like the TunnelManager would."""
+
+    def __init__(self, device):
+        self.device = device
+
+    def acquire(self, key, path):
+        return self.device
+
+
+class Soak:
+    def __init__(self, directory, stop_grace, restart_delay, switch=False):
+        self.script = os.path.join(directory, "script.json")
+        os.environ["FAKE_CODE_SCRIPT"] = self.script
+        self.device = vscode_device.VSCodeDeviceAPI(directory, stopGrace=stop_grace)
+        self.device.exePath = FAKE_CODE
+        self.device.supervisor.delay = lambda attempt: restart_delay
+        self.switch = None
+        if switch:
+            self.switch = load("switch").VSCodeEntity(
+                Manager(self.device),
+                "soak",
+                directory,
+                "https://vscode.dev/tunnel/soak",
+            )
+
+    def prepare(self, scenario):
+        config = {"jitter": JITTER, **SCENARIOS[scenario]}
+        with open(self.script, "w", encoding="utf-8") as file:
+            json.dump(config, file)
+        if "crash_after" in config:
+            open(self.script + ".crash", "w", encoding="utf-8").close()
+        return config
+
+    async def up(self, config):
+        device = self.device
+        if config.get("auth") and not await device.getOAuthToken(URL_TIMEOUT):
+            raise SoakError("no device code")
+        if not config.get("url", True):
+            return await device.getDevURL(SILENT_TIMEOUT)
+        url = await device.getDevURL(URL_TIMEOUT)
+        if not url:
+            raise SoakError("no url, tunnel is " + device.lifecycle.state)
+        return url
+
+    async def turn(self, on):
+        if self.switch is None:
+            return await self.device.asyncSetDesired(on)
+        if on:
+            await self.switch.async_turn_on()
+        else:
+            await self.switch.async_turn_off()
+
+    def checkSwitch(self, on):
+        if self.switch is None:
+            return
+        if self.switch.is_on != on:
+            raise SoakError(f"switch is {'on' if self.switch.is_on else 'off'}")
+        state = self.switch.extra_state_attributes["tunnel_state"]
+        if state != self.device.lifecycle.state:
+            raise SoakError("switch says the tunnel is " + state)
+
+    async def until(self, condition, what, timeout=URL_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                raise SoakError("timed out waiting for " + what)
+            await asyncio.sleep(0.01)
+
+    async def cycle(self, scenario):
+        device = self.device
+        config = self.prepare(scenario)
+
+        started = time.monotonic()
+        await self.turn(True)
+        await self.up(config)
+        start = time.monotonic() - started
+        self.checkSwitch(True)
+
+        if scenario == "restart":
+            pid = device.proc.pid
+            await device.asyncStartTunnel()
+            await self.up(config)
+            if device.proc.pid == pid:
+                raise SoakError("restart kept the old process")
+        elif scenario == "burst":
+            await asyncio.gather(
+                self.turn(False), self.turn(True), self.turn(False), self.turn(True)
+            )
+            await self.up(config)
+        elif scenario == "crash":
+            restarts = device.supervisor.restarts
+            pid = device.proc.pid
+            await self.until(
+                lambda: device.supervisor.restarts > restarts
+                and device.proc is not None
+                and device.proc.pid != pid
+                and device.devURL,
+                "the supervisor to restart the tunnel",
+            )
+
+        stopping = time.monotonic()
+        await self.turn(False)
+        stop = time.monotonic() - stopping
+        self.checkSwitch(False)
+        if device.proc is not None or device.lifecycle.active:
+            raise SoakError("still running after a stop: " + device.lifecycle.state)
+        left = process_tree.descendants(os.getpid())
+        if left:
+            raise SoakError(f"{len(left)} processes left after a stop")
+        return start, stop
+
+
+async def soak(args, report):
+    scenarios = args.scenarios.split(",")
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit("unknown scenarios: " + ", ".join(sorted(unknown)))
+    with tempfile.TemporaryDirectory() as directory:
+        runner = Soak(directory, args.stop_grace, args.restart_delay, args.switch)
+        baseline = None
+        peak = {}
+        for number in range(args.warmup + args.cycles):
+            scenario = scenarios[number % len(scenarios)]
+            start, stop = await runner.cycle(scenario)
+            if number < args.warmup:
+                continue
+            if baseline is None:
+                baseline = footprint()
+            current = footprint()
+            for key, value in current.items():
+                peak[key] = max(peak.get(key, value), value)
+            row = {
+                "cycle": number - args.warmup,
+                "scenario": scenario,
+                "start_s": start,
+                "stop_s": stop,
+            }
+            report["cycles"].append(row)
+            if args.verbose:
+                print(
+                    f"{row['cycle']:6} {scenario:8} start {start * 1000:8.1f} ms"
+                    f"  stop {stop * 1000:8.1f} ms  rss {current['rss'] >> 10} KiB",
+                    file=sys.stderr,
+                )
+        report["footprint"] = {
+            "baseline": baseline,
+            "peak": peak,
+            "final": footprint(),
+        }
+        report["supervisor"] = runner.device.supervisor.stats()
+
+
+def summarize(cycles):
+    summary = {}
+    for scenario in SCENARIOS:
+        rows = [row for row in cycles if row["scenario"] == scenario]
+        if not rows:
+            continue
+        summary[scenario] = {"cycles": len(rows)}
+        for phase in ("start_s", "stop_s"):
+            values = [row[phase] for row in rows]
+            summary[scenario][phase] = {
+                "p50": percentile(values, 0.5),
+                "p95": percentile(values, 0.95),
+                "max": max(values),
+            }
+    return summary
+
+
+def check(footprint, rss_slack):
+    baseline, final = footprint["baseline"], footprint["final"]
+    failures = []
+    for key in ("threads", "fds", "tasks"):
+        if final[key] > baseline[key]:
+            failures.append(f"{key} grew from {baseline[key]} to {final[key]}")
+    if final["children"]:
+        failures.append(f"{final['children']} child processes left")
+    if final["rss"] - baseline["rss"] > rss_slack:
+        failures.append(
+            f"rss grew by {(final['rss'] - baseline['rss']) >> 10} KiB"
+            f" from {baseline['rss'] >> 10} KiB"
+        )
+    return failures
+
+
+def main(argv=None):
+    args = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    args.add_argument("--cycles", type=int, default=1000)
+    args.add_argument("--warmup", type=int, default=2 * len(SCENARIOS))
+    args.add_argument("--scenarios", default=",".join(SCENARIOS))
+    args.add_argument("--stop-grace", type=float, default=0.3, help="seconds")
+    args.add_argument("--restart-delay", type=float, default=0.05, help="seconds")
+    args.add_argument(
+        "--rss-slack", type=int, default=8, help="MiB RSS may grow by, allocator noise"
+    )
+    args.add_argument(
+        "--switch", action="store_true", help="through the switch entity, needs HA"
+    )
+    args.add_argument("--json", action="store_true", help="machine readable output")
+    args.add_argument("-v", "--verbose", action="store_true", help="every cycle")
+    args = args.parse_args(argv)
+    if args.cycles < 1:
+        raise SystemExit("--cycles must be at least 1")
+
+    # crashes and kills are expected, only the surprises are of interest
+    logging.basicConfig(level=logging.WARNING if args.verbose else logging.ERROR)
+    mode = os.stat(FAKE_CODE).st_mode
+    if not mode & stat.S_IXUSR:
+        os.chmod(FAKE_CODE, mode | stat.S_IXUSR)
+
+    report = {"cycles": []}
+    failures = []
+    started = time.monotonic()
+    try:
+        asyncio.run(soak(args, report))
+    except SoakError as err:
+        failures.append(f"cycle {len(report['cycles'])}: {err}")
+    report["elapsed_s"] = time.monotonic() - started
+    report["summary"] = summarize(report["cycles"])
+    if "footprint" in report:
+        failures.extend(check(report["footprint"], args.rss_slack * 1024 * 1024))
+    report["failures"] = failures
+
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        for scenario, stats in report["summary"].items():
+            print(
+                f"{scenario:8} {stats['cycles']:6} cycles"
+                + "".join(
+                    f"  {phase[:-2]} p50 {stats[phase]['p50'] * 1000:7.1f}"
+                    f" p95 {stats[phase]['p95'] * 1000:7.1f}"
+                    f" max {stats[phase]['max'] * 1000:7.1f} ms"
+                    for phase in ("start_s", "stop_s")
+                )
+            )
+        for name, values in report.get("footprint", {}).items():
+            print(f"{name:8} {values}")
+        for failure in failures:
+            print("FAIL " + failure)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,17 +1,117 @@
 """Provide the initial setup."""
 import logging
 
+import voluptuous as vol
+from homeassistant.core import SupportsResponse
+from homeassistant.helpers import config_validation as cv
+from homeassistant.helpers.storage import STORAGE_DIR
+from homeassistant.util import dt as dt_util
+
+from .cli_cache import CLICache
+from .cli_cache import legacyBinDir
 from .const import *
+from .manager import async_get_manager
+from .vscode_device import cliArchitecture
 
 _LOGGER = logging.getLogger(__name__)
 
 
 async def async_setup(hass, config):
     """Provide Setup of platform."""
+
+    async def async_resume(call):
+        await async_get_manager(hass).resume(call.data.get("entry_id"))
+
+    hass.services.async_register(
+        DOMAIN,
+        SERVICE_RESUME,
+        async_resume,
+        schema=vol.Schema({vol.Optional("entry_id"): str}),
+    )
+
+    async def async_output(call):
+        output = async_get_manager(hass).output(
+            call.data.get("entry_id"), call.data.get("lines")
+        )
+        return {
+            "tunnels": {
+                key: [
+                    {"time": dt_util.utc_from_timestamp(at).isoformat(), "line": line}
+                    for at, line in lines
+                ]
+                for key, lines in output.items()
+            }
+        }
+
+    hass.services.async_register(
+        DOMAIN,
+        SERVICE_OUTPUT,
+        async_output,
+        schema=vol.Schema(
+            {
+                vol.Optional("entry_id"): str,
+                vol.Optional("lines"): cv.positive_int,
+            }
+        ),
+        supports_response=SupportsResponse.ONLY,
+    )
     return True
 
 
 async def async_setup_entry(hass, config_entry):
+    path = hass.config.path(STORAGE_DIR, DOMAIN, CLI_DIR)
+    if config_entry.data.get("path") != path:
+        # one time move of the cli out of custom_components/ha_vscode/bin
+        await CLICache(path, cliArchitecture()).migrate(legacyBinDir(hass))
+        options = dict(config_entry.options)
+        if "path" in options:
+            options["path"] = path
+        hass.config_entries.async_update_entry(
+            config_entry, data={**config_entry.data, "path": path}, options=options
+        )
+
+    manager = async_get_manager(hass)
+    await manager.load()
+    # the config flow hands over what it measured while setting up the tunnel
+    handover = hass.data.get(DOMAIN_DATA, {}).pop(config_entry.unique_id, {})
+    flow_id = handover.pop("flow_id", None)
+    if flow_id is not None:
+        # the flow's tunnel carries on as the entry's, a second cli for the same
+        # name would fight it for the tunnel
+        manager.rekey(flow_id, config_entry.entry_id)
+    timings = handover.pop("timings", None)
+    if timings is not None:
+        manager.adoptTimings(config_entry.entry_id, timings)
+    record = handover.pop("record", None)
+    if record is not None:
+        manager.adoptRecord(config_entry.entry_id, record)
+
+    config_entry.async_on_unload(
+        config_entry.add_update_listener(async_options_updated)
+    )
+
     # Add sensor
     await hass.config_entries.async_forward_entry_setups(config_entry, PLATFORMS)
     return True
+
+
+async def async_options_updated(hass, config_entry):
+    manager = async_get_manager(hass)
+    options = {**config_entry.data, **config_entry.options}
+    if manager.get(config_entry.entry_id) is not None and manager.usesHelper(
+        config_entry.entry_id
+    ) != bool(options.get(CONF_HELPER)):
+        # moving the tunnel in or out of the helper takes a new device
+        await hass.config_entries.async_reload(config_entry.entry_id)
+        return
+    # applied to the running tunnel, no need to reload and restart it
+    manager.configure(config_entry.entry_id, options)
+
+
+async def async_unload_entry(hass, config_entry):
+    # the entities let go of the tunnel, which stops it
+    return await hass.config_entries.async_unload_platforms(config_entry, PLATFORMS)
+
+
+async def async_remove_entry(hass, config_entry):
+    async_get_manager(hass).forget(config_entry.entry_id)
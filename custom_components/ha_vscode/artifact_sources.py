@@ -0,0 +1,312 @@
+"""Where the VSCode CLI comes from: local bundles, LAN mirrors and upstream.
+
+A bundle is a directory, on disk or served over HTTP by any static file server,
+as seedMirror() lays it out:
+
+    <bundle>/manifest.json
+    <bundle>/vscode_cli_<architecture>.tar.gz
+
+The manifest pins the sha256 of the `code` binary in every archive, the hash
+CLICache files builds under, so a build from a bundle is only installed if it
+is the one that was seeded. Upstream has no manifest, it is trusted for what TLS
+vouches for.
+
+Sources are configured as text, separated by commas or newlines, each an
+absolute path, an http(s) URL or `upstream`, optionally followed by a timeout
+in seconds for the whole fetch from it:
+
+    /share/vscode-cli, http://mirror.lan/vscode-cli 20, upstream
+
+To seed a bundle for every architecture, from the configuration directory:
+
+    python -m custom_components.ha_vscode.artifact_sources /share/vscode-cli
+"""
+import abc
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import tarfile
+import time
+import zlib
+
+from .const import CLI_DOWNLOAD_URL
+from .const import PACKAGE_NAME
+from .downloader import CHUNK_SIZE
+from .downloader import CLIDownloader
+from .downloader import MemorySink
+from .exceptions import HAVSCodeDownloadException
+from .exceptions import HAVSCodeTarException
+from .vscode_device import architecture_map
+
+LOGGER: logging.Logger = logging.getLogger(PACKAGE_NAME)
+
+UPSTREAM = "upstream"
+KIND_FILE = "file"
+KIND_MIRROR = "mirror"
+BUNDLE_MANIFEST = "manifest.json"
+BUNDLE_VERSION = 1
+# a manifest is a few hundred bytes
+MANIFEST_LIMIT = 64 * 1024
+# seconds for the whole fetch from a source that has no timeout of its own
+DEFAULT_TIMEOUTS = {KIND_FILE: 30.0, KIND_MIRROR: 120.0, UPSTREAM: 600.0}
+
+_SHA256 = re.compile(r"^[0-9a-f]{64}$")
+
+
+def archiveName(architecture):
+    return f"vscode_cli_{architecture}.tar.gz"
+
+
+class Upstream:
+    """code.visualstudio.com, at the URL the device asks for. Not pinned."""
+
+    kind = UPSTREAM
+    pinned = False
+
+    def __init__(self, timeout=None):
+        self.location = UPSTREAM
+        self.timeout = timeout or DEFAULT_TIMEOUTS[self.kind]
+
+    def __repr__(self):
+        return UPSTREAM
+
+
+class Bundle(abc.ABC):
+    """A seeded bundle. Subclasses know how to read from where it is."""
+
+    kind = None
+    pinned = True
+
+    def __init__(self, location, timeout=None):
+        self.location = location
+        self.timeout = timeout or DEFAULT_TIMEOUTS[self.kind]
+
+    def __repr__(self):
+        return self.location
+
+    async def pin(self, downloader, architecture):
+        """The manifest entry of architecture: file, sha256 and what else the
+        seeder knew. Raises HAVSCodeDownloadException if there is none."""
+        try:
+            manifest = json.loads(await self.read(downloader, BUNDLE_MANIFEST))
+            build = manifest["builds"][architecture]
+            if not _SHA256.match(build["sha256"]):
+                raise ValueError("bad sha256 " + str(build["sha256"]))
+            if build["file"] != os.path.basename(build["file"]):
+                raise ValueError("bad file name " + str(build["file"]))
+        except (ValueError, KeyError, TypeError) as err:
+            LOGGER.error("No usable %s build in %s: %r", architecture, self, err)
+            raise HAVSCodeDownloadException() from err
+        return build
+
+    @abc.abstractmethod
+    async def read(self, downloader, name):
+        """The small file name of the bundle, as bytes."""
+
+    @abc.abstractmethod
+    async def stream(self, downloader, name, sink, progress=None):
+        """Hand the file name of the bundle to a download sink."""
+
+    @abc.abstractmethod
+    def where(self, name):
+        """The path or URL of the file name of the bundle."""
+
+
+class LocalBundle(Bundle):
+    """A bundle in a directory, e.g. on a USB stick or a network share."""
+
+    kind = KIND_FILE
+
+    async def read(self, downloader, name):
+        return await asyncio.get_running_loop().run_in_executor(
+            None, _readSmall, self.where(name)
+        )
+
+    async def stream(self, downloader, name, sink, progress=None):
+        await streamFile(self.where(name), sink, progress)
+
+    def where(self, name):
+        return os.path.join(self.location, name)
+
+
+class MirrorBundle(Bundle):
+    """A bundle served over HTTP, e.g. by a box on the LAN."""
+
+    kind = KIND_MIRROR
+
+    async def read(self, downloader, name):
+        sink = MemorySink(MANIFEST_LIMIT)
+        await downloader.stream(self.where(name), sink)
+        return sink.data
+
+    async def stream(self, downloader, name, sink, progress=None):
+        await downloader.stream(self.where(name), sink, progress)
+
+    def where(self, name):
+        return self.location.rstrip("/") + "/" + name
+
+
+def parseSources(text):
+    """The sources in text, in order. Raises ValueError if there are none or
+    one makes no sense."""
+    sources = []
+    for entry in re.split(r"[,\n]", text or ""):
+        fields = entry.split()
+        if not fields:
+            continue
+        if len(fields) > 2:
+            raise ValueError("expected a location and a timeout: " + entry.strip())
+        timeout = None
+        if len(fields) == 2:
+            timeout = float(fields[1])
+            if not timeout > 0:
+                raise ValueError("the timeout of a source has to be positive")
+        location = fields[0]
+        if location == UPSTREAM:
+            sources.append(Upstream(timeout))
+        elif location.startswith(("http://", "https://")):
+            sources.append(MirrorBundle(location, timeout))
+        elif location.startswith("file://"):
+            sources.append(LocalBundle(location[len("file://") :], timeout))
+        elif os.path.isabs(location):
+            sources.append(LocalBundle(location, timeout))
+        else:
+            raise ValueError("not an absolute path, URL or upstream: " + location)
+    if not sources:
+        raise ValueError("no sources")
+    return sources
+
+
+def _readSmall(path):
+    with open(path, "rb") as file:
+        data = file.read(MANIFEST_LIMIT + 1)
+    if len(data) > MANIFEST_LIMIT:
+        raise ValueError(path + " is larger than " + str(MANIFEST_LIMIT) + " bytes")
+    return data
+
+
+async def streamFile(path, sink, progress=None, chunk_size=CHUNK_SIZE):
+    """Hand the file at path to a download sink, as CLIDownloader.stream does
+    with a URL. Reads in the executor."""
+    loop = asyncio.get_running_loop()
+    source = await loop.run_in_executor(None, open, path, "rb")
+    try:
+        total = os.fstat(source.fileno()).st_size
+        await sink.start()
+        try:
+            received = 0
+            while True:
+                chunk = await loop.run_in_executor(None, source.read, chunk_size)
+                if not chunk:
+                    break
+                await sink.write(chunk)
+                received += len(chunk)
+                if progress:
+                    progress(received, total)
+        except BaseException:
+            await sink.abort()
+            raise
+        await sink.finish()
+    finally:
+        await loop.run_in_executor(None, source.close)
+
+
+async def seedMirror(directory, downloader, architectures=None, url=CLI_DOWNLOAD_URL):
+    """Download the latest build of every architecture into directory and pin
+    them in its manifest. Archives the server says did not change are kept.
+    Returns the manifest."""
+    loop = asyncio.get_running_loop()
+    manifest = await loop.run_in_executor(None, _loadBundle, directory)
+    for architecture in architectures or sorted(set(architecture_map.values())):
+        name = archiveName(architecture)
+        path = os.path.join(directory, name)
+        old = manifest["builds"].get(architecture)
+        headers = {}
+        if old and old.get("etag") and os.path.exists(path):
+            headers["If-None-Match"] = old["etag"]
+        result = await downloader.download(
+            url.format(architecture=architecture), path + ".tmp", headers=headers
+        )
+        if result is None:
+            await loop.run_in_executor(None, os.unlink, path + ".tmp")
+            LOGGER.info("%s did not change", name)
+            continue
+        build = await loop.run_in_executor(None, _pinArchive, path + ".tmp", path)
+        build.update(file=name, etag=result.etag, url=result.url, seeded=time.time())
+        manifest["builds"][architecture] = build
+        LOGGER.info("Seeded %s, code has sha256 %s", name, build["sha256"])
+    await loop.run_in_executor(None, _saveBundle, directory, manifest)
+    return manifest
+
+
+def _loadBundle(directory):
+    os.makedirs(directory, exist_ok=True)
+    try:
+        with open(os.path.join(directory, BUNDLE_MANIFEST), encoding="utf-8") as file:
+            manifest = json.load(file)
+    except FileNotFoundError:
+        manifest = {}
+    manifest.setdefault("version", BUNDLE_VERSION)
+    manifest.setdefault("builds", {})
+    return manifest
+
+
+def _saveBundle(directory, manifest):
+    path = os.path.join(directory, BUNDLE_MANIFEST)
+    with open(path + ".tmp", "w", encoding="utf-8") as file:
+        json.dump(manifest, file, indent=2)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def _pinArchive(download, path, member="code"):
+    # the binary for another architecture cannot be run, so no version probe
+    archive = hashlib.sha256()
+    with open(download, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            archive.update(block)
+    binary = hashlib.sha256()
+    try:
+        with tarfile.open(download, mode="r:gz") as tar:
+            for info in tar:
+                if os.path.normpath(info.name) == member and info.isfile():
+                    source = tar.extractfile(info)
+                    for block in iter(lambda: source.read(1024 * 1024), b""):
+                        binary.update(block)
+                    break
+            else:
+                LOGGER.error("No %s in %s", member, download)
+                raise HAVSCodeTarException()
+    except (OSError, EOFError, zlib.error, tarfile.TarError) as err:
+        LOGGER.error("Reading %s failed: %s", download, err)
+        raise HAVSCodeTarException() from err
+    os.replace(download, path)
+    return {
+        "sha256": binary.hexdigest(),
+        "archive_sha256": archive.hexdigest(),
+        "size": os.path.getsize(path),
+    }
+
+
+def main(argv=None):
+    architectures = sorted(set(architecture_map.values()))
+    parser = argparse.ArgumentParser(description="Seed a bundle of the VSCode CLI")
+    parser.add_argument("directory", help="where the archives and manifest go")
+    parser.add_argument(
+        "--architecture",
+        action="append",
+        choices=architectures,
+        help="only this one, can be given more than once. Default: all",
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(seedMirror(args.directory, CLIDownloader(), args.architecture))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,389 @@
+"""Versioned cache of VSCode CLI builds.
+
+Builds are stored by the sha256 of the `code` binary:
+
+    <directory>/manifest.json
+    <directory>/<sha256>/code
+    <directory>/code -> <sha256>/code    (the current build)
+
+A fetch with stage=True installs a new build next to the current one without
+switching to it. promote() swaps the symlink over to it, once nothing is
+running the old one.
+
+The manifest records version, commit, sha256, architecture and the HTTP
+validators of every build, so the next fetch can be a conditional request that
+the server answers with 304 when nothing changed. A build from a bundle, see
+artifact_sources, is only installed if it has the sha256 the bundle pins.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import time
+
+from .archive import CLIExtractor
+from .const import DOMAIN
+from .const import LEGACY_BIN_DIR
+from .const import PACKAGE_NAME
+from .exceptions import HAVSCodeChecksumException
+from .exceptions import HAVSCodeDownloadException
+from .exceptions import HAVSCodeException
+
+LOGGER: logging.Logger = logging.getLogger(PACKAGE_NAME)
+
+MANIFEST = "manifest.json"
+CURRENT = "code"
+STAGING = ".staging-code"
+# the current build plus the one before it, in case we need to go back
+KEEP = 2
+VERSION_TIMEOUT = 10.0
+
+_SHA256 = re.compile(r"^[0-9a-f]{64}$")
+_VERSION = re.compile(
+    r"(?P<version>\d+\.\d+\.\d+)\S*\s+\(commit (?P<commit>[0-9a-f]+)\)"
+)
+_COMMIT_IN_URL = re.compile(r"/(?P<commit>[0-9a-f]{40})/")
+
+
+def legacyBinDir(hass):
+    """Where the CLI lived before it moved under .storage."""
+    return os.path.join(hass.config.path("custom_components"), DOMAIN, LEGACY_BIN_DIR)
+
+
+class CLICache:
+    """The CLI builds in directory, for one architecture."""
+
+    def __init__(self, directory, architecture):
+        self.log = LOGGER
+        self.directory = directory
+        self.architecture = architecture
+        self.exePath = os.path.join(directory, CURRENT)
+        self.manifest = {"current": None, "builds": {}}
+        self._loaded = False
+        # tunnels that share the cache fetch one after the other, the second one
+        # gets a 304 for what the first one downloaded
+        self._fetchLock = asyncio.Lock()
+
+    async def load(self):
+        if not self._loaded:
+            await asyncio.get_running_loop().run_in_executor(None, self._load)
+        return self.manifest
+
+    def _load(self):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, MANIFEST)
+        try:
+            with open(path, encoding="utf-8") as manifest:
+                self.manifest = json.load(manifest)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as err:
+            # not worth failing over, the next fetch simply downloads again
+            self.log.warning("Ignoring unreadable CLI manifest %s: %s", path, err)
+        self._loaded = True
+
+    def current(self):
+        """Manifest entry of the current build, None if there is none yet."""
+        return self.manifest["builds"].get(self.manifest.get("current"))
+
+    def staged(self):
+        """Manifest entry of the build waiting for promote(), None if there is
+        none."""
+        return self.manifest["builds"].get(self.manifest.get("staged"))
+
+    def latest(self):
+        return self.staged() or self.current()
+
+    def conditionalHeaders(self):
+        build = self.latest()
+        if build is None or build.get("architecture") != self.architecture:
+            return {}
+        if not os.path.exists(self.exePath):
+            return {}
+        headers = {}
+        if build.get("etag"):
+            headers["If-None-Match"] = build["etag"]
+        if build.get("last_modified"):
+            headers["If-Modified-Since"] = build["last_modified"]
+        return headers
+
+    async def fetch(
+        self, downloader, url, progress=None, timings=None, sources=None, stage=False
+    ):
+        """Make sure the latest build is current, or with stage, staged. Returns
+        its manifest entry.
+
+        sources are tried in order, see artifact_sources. Upstream is url, and
+        the only source if there are none. A staged build has to answer
+        --version.
+        """
+        async with self._fetchLock:
+            if not sources:
+                return await self._fetch(downloader, url, progress, timings, stage)
+            error = None
+            for source in sources:
+                try:
+                    return await asyncio.wait_for(
+                        self._fetchSource(
+                            source, downloader, url, progress, timings, stage
+                        ),
+                        source.timeout,
+                    )
+                except asyncio.TimeoutError as err:
+                    self.log.warning(
+                        "No VSCode CLI from %s within %ss", source, source.timeout
+                    )
+                    error = err
+                except (HAVSCodeException, OSError) as err:
+                    self.log.warning("No VSCode CLI from %s: %s", source, err)
+                    error = err
+            raise HAVSCodeDownloadException() from error
+
+    async def _fetchSource(self, source, downloader, url, progress, timings, stage):
+        if not source.pinned:
+            return await self._fetch(downloader, url, progress, timings, stage)
+        await self.load()
+        loop = asyncio.get_running_loop()
+        pin = await source.pin(downloader, self.architecture)
+        build = self.latest()
+        exists = await loop.run_in_executor(None, os.path.exists, self.exePath)
+        if build is not None and build.get("sha256") == pin["sha256"] and exists:
+            self.log.debug("VSCode CLI is the one pinned by %s", source)
+            return build
+
+        staging = os.path.join(self.directory, STAGING)
+        extractor = CLIExtractor(staging, timings=timings)
+        await source.stream(downloader, pin["file"], extractor, progress)
+        if extractor.sha256 != pin["sha256"]:
+            self.log.error(
+                "%s from %s has sha256 %s, the manifest pins %s",
+                pin["file"],
+                source,
+                extractor.sha256,
+                pin["sha256"],
+            )
+            await loop.run_in_executor(None, os.unlink, staging)
+            raise HAVSCodeChecksumException()
+
+        build = {
+            "sha256": extractor.sha256,
+            "architecture": self.architecture,
+            "etag": None,
+            "last_modified": None,
+            "url": source.where(pin["file"]),
+            "downloaded": time.time(),
+        }
+        return await self._installStaging(build, stage)
+
+    async def _fetch(self, downloader, url, progress, timings, stage=False):
+        await self.load()
+        loop = asyncio.get_running_loop()
+        staging = os.path.join(self.directory, STAGING)
+        extractor = CLIExtractor(staging, timings=timings)
+        headers = await loop.run_in_executor(None, self.conditionalHeaders)
+        result = await downloader.stream(url, extractor, progress, headers=headers)
+        if result is None:
+            self.log.debug("VSCode CLI is up to date, skipping download")
+            return self.latest()
+
+        build = {
+            "sha256": extractor.sha256,
+            "architecture": self.architecture,
+            "etag": result.etag,
+            "last_modified": result.last_modified,
+            "url": url,
+            "downloaded": time.time(),
+        }
+        match = _COMMIT_IN_URL.search(result.url)
+        build["commit"] = match.group("commit") if match else None
+        return await self._installStaging(build, stage)
+
+    async def _installStaging(self, build, stage):
+        loop = asyncio.get_running_loop()
+        staging = os.path.join(self.directory, STAGING)
+        version = await self.probeVersion(staging)
+        if stage and version["version"] is None:
+            # nobody is waiting on it, so only a build that runs is good enough
+            await loop.run_in_executor(None, os.unlink, staging)
+            self.log.warning("Not staging a VSCode CLI that does not run")
+            raise HAVSCodeDownloadException()
+        build.update({key: value for key, value in version.items() if value})
+        build.setdefault("version", None)
+        build.setdefault("commit", None)
+        await loop.run_in_executor(None, self._install, staging, build, stage)
+        return build
+
+    async def promote(self):
+        """Switch to the staged build. Returns its manifest entry, None if there
+        was none. Tunnels that run keep the build they were started with."""
+        await self.load()
+        if self.staged() is None:
+            return None
+        await asyncio.get_running_loop().run_in_executor(None, self._promote)
+        return self.current()
+
+    def _promote(self):
+        self._activate(self.manifest["staged"])
+        self.collectGarbage()
+        self._save()
+
+    async def probeVersion(self, exe):
+        """Ask the binary for its version and commit."""
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                exe,
+                "--version",
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT,
+            )
+        except OSError as err:
+            self.log.debug("Could not get the version of %s: %s", exe, err)
+            return {"version": None, "commit": None}
+        try:
+            out, _ = await asyncio.wait_for(proc.communicate(), VERSION_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.log.debug("%s --version did not answer", exe)
+            proc.kill()
+            await proc.wait()
+            return {"version": None, "commit": None}
+        match = _VERSION.search(out.decode(errors="replace"))
+        if match is None:
+            return {"version": None, "commit": None}
+        return match.groupdict()
+
+    def _install(self, binary, build, stage=False):
+        sha256 = build["sha256"]
+        target = os.path.join(self.directory, sha256, CURRENT)
+        if os.path.exists(target):
+            # same bytes as a build we already have, e.g. the etag changed
+            os.unlink(binary)
+            build = {**self.manifest["builds"].get(sha256, {}), **build}
+        else:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(binary, target)
+        self.manifest["builds"][sha256] = build
+        if not stage:
+            self._activate(sha256)
+        elif sha256 == self.manifest.get("current"):
+            # the newest build is the one we run already
+            self.manifest.pop("staged", None)
+        else:
+            self.manifest["staged"] = sha256
+        self.collectGarbage()
+        self._save()
+        self.log.info(
+            "VSCode CLI %s (%s) %s at %s",
+            build.get("version"),
+            sha256[:12],
+            "staged" if stage else "installed",
+            target,
+        )
+
+    def _activate(self, sha256):
+        # swap the symlink atomically, a running tunnel keeps its own inode
+        tmp = self.exePath + ".tmp"
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        os.symlink(os.path.join(sha256, CURRENT), tmp)
+        os.replace(tmp, self.exePath)
+        self.manifest["current"] = sha256
+        # a build installed since it was staged wins, too
+        self.manifest.pop("staged", None)
+
+    def _save(self):
+        path = os.path.join(self.directory, MANIFEST)
+        with open(path + ".tmp", "w", encoding="utf-8") as manifest:
+            json.dump(self.manifest, manifest, indent=2)
+            manifest.flush()
+            os.fsync(manifest.fileno())
+        os.replace(path + ".tmp", path)
+
+    def collectGarbage(self, keep=KEEP):
+        """Drop all but the current, the staged and the keep - 1 most recent other
+        builds."""
+        builds = self.manifest["builds"]
+        current = self.manifest.get("current")
+        staged = self.manifest.get("staged")
+        others = sorted(
+            (sha256 for sha256 in builds if sha256 not in (current, staged)),
+            key=lambda sha256: builds[sha256].get("downloaded", 0),
+            reverse=True,
+        )
+        keepers = set(others[: keep - 1])
+        keepers.add(current)
+        if staged:
+            keepers.add(staged)
+        for sha256 in list(builds):
+            if sha256 not in keepers:
+                del builds[sha256]
+        for name in os.listdir(self.directory):
+            # only touch what looks like one of ours
+            if _SHA256.match(name) and name not in keepers:
+                self.log.debug("Removing old VSCode CLI build %s", name)
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+    async def migrate(self, legacy_dir):
+        """Move a binary from the old custom_components/ha_vscode/bin directory
+        into the cache. Safe to call more than once."""
+        await self.load()
+        if legacy_dir is None or os.path.normpath(legacy_dir) == os.path.normpath(
+            self.directory
+        ):
+            return None
+        loop = asyncio.get_running_loop()
+        sha256 = await loop.run_in_executor(None, self._adoptLegacy, legacy_dir)
+        if sha256 is None:
+            return None
+        build = self.manifest["builds"][sha256]
+        build.update(
+            await self.probeVersion(os.path.join(self.directory, sha256, CURRENT))
+        )
+        await loop.run_in_executor(None, self._save)
+        return build
+
+    def _adoptLegacy(self, legacy_dir):
+        legacy = os.path.join(legacy_dir, CURRENT)
+        sha256 = None
+        if os.path.isfile(legacy):
+            digest = hashlib.sha256()
+            with open(legacy, "rb") as binary:
+                for block in iter(lambda: binary.read(1024 * 1024), b""):
+                    digest.update(block)
+            sha256 = digest.hexdigest()
+            target = os.path.join(self.directory, sha256, CURRENT)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            # may cross file systems, so no os.replace
+            shutil.move(legacy, target)
+            os.chmod(target, 0o755)
+            # no validators: the first fetch will download, but we have a
+            # working binary until then
+            self.manifest["builds"].setdefault(
+                sha256,
+                {
+                    "sha256": sha256,
+                    "architecture": self.architecture,
+                    "etag": None,
+                    "last_modified": None,
+                    "url": None,
+                    "downloaded": os.path.getmtime(target),
+                    "version": None,
+                    "commit": None,
+                },
+            )
+            if self.current() is None:
+                self._activate(sha256)
+            self.log.info("Moved VSCode CLI from %s to %s", legacy, target)
+
+        # leftovers of the gzip/tar based install
+        for leftover in ("vscode_cli.tar.gz", "vscode_cli.tar"):
+            path = os.path.join(legacy_dir, leftover)
+            if os.path.exists(path):
+                os.unlink(path)
+        try:
+            os.rmdir(legacy_dir)
+        except OSError:
+            pass
+        return sha256
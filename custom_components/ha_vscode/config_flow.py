@@ -1,6 +1,13 @@
-"""Adds config flow for VSCode HA Tunnel."""
+"""Adds config flow for VSCode HA Tunnel.
+
+While the user picks a name the CLI is fetched in the background. Once the name
+is in, the rest of the setup runs as tasks behind progress steps, one for each of
+the CLI, the tunnel and the device code, which is shown the moment the tunnel
+prints it.
+"""
+import asyncio
 import logging
-import os.path
+import re
 
 import voluptuous as vol
 from awesomeversion import AwesomeVersion
@@ -11,13 +18,37 @@ from homeassistant.helpers import aiohttp_client
 from homeassistant.helpers.event import async_call_later
 from homeassistant.helpers.storage import STORAGE_DIR
 from homeassistant.loader import async_get_integration
+from homeassistant.util import slugify
 
+from .artifact_sources import parseSources
+from .cli_cache import legacyBinDir
+from .downloader import CLIDownloader
 from .const import *
 from .exceptions import *
-from .vscode_device import VSCodeDeviceAPI
+from .idle import IDLE_MODES
+from .resource_profile import IO_CLASSES
+from .timing import PHASE_DOWNLOAD
+from .timing import TIMEOUT_FLOOR
+from .manager import async_get_manager
+from .vscode_device import cliArchitecture
 
 LOGGER: logging.Logger = logging.getLogger(PACKAGE_NAME)
 
+_TUNNEL_NAME = re.compile(r"^[a-z0-9][a-z0-9-]*$")
+
+# what the progress step shows while the setup runs
+PROGRESS_DOWNLOAD = "download_cli"
+PROGRESS_START = "start_tunnel"
+PROGRESS_DEVICE_CODE = "wait_for_oauth"
+
+
+def _validSources(value):
+    try:
+        parseSources(value)
+    except ValueError as err:
+        raise vol.Invalid(str(err)) from err
+    return value
+
 
 class HAVSCodeFlowHandler(config_entries.ConfigFlow, domain=DOMAIN):
     """Config flow for ha_vscode."""
@@ -33,50 +64,194 @@ class HAVSCodeFlowHandler(config_entries.ConfigFlow, domain=DOMAIN):
         self.devURL = None
         self.log = LOGGER
         self.path = None
-        self.activate = False
-        self.timeout = 5.0
-
-    async def async_step_user(self, user_input):
-        if self._async_current_entries():
-            return self.async_abort(reason="single_instance_allowed")
-        if self.hass.data.get(DOMAIN):
-            return self.async_abort(reason="single_instance_allowed")
+        self.tunnelName = None
+        self.cliDataDir = None
+        self.sources = None
+        # the CLI fetched while the user fills in the form, with these sources
+        self._prefetch = None
+        self._prefetchSources = None
+        # the task behind the progress step, and the phase it runs
+        self._setup = None
+        self._phase = None
+        # the least the waits for the tunnel last, they adapt to the host above that
+        self.timeout = TIMEOUT_FLOOR
 
+    async def async_step_user(self, user_input=None):
+        """Pick a name for the tunnel, every entry has one of its own, and where
+        the CLI comes from."""
         if AwesomeVersion(HAVERSION) < MINIMUM_HA_VERSION:
             return self.async_abort(
                 reason="min_ha_version",
                 description_placeholders={"version": MINIMUM_HA_VERSION},
             )
 
+        manager = async_get_manager(self.hass)
+        await manager.load()
         if self.path is None:
-            self.path = os.path.join(self.hass.config.path("custom_components"), DOMAIN)
-            self.path = os.path.join(self.path, "bin")
+            self.path = self.hass.config.path(STORAGE_DIR, DOMAIN, CLI_DIR)
             self.log.info("bin directory located at: " + self.path)
+        if self._prefetch is None:
+            # the download overlaps with the user reading and typing
+            self._prefetchSources = self._knownSources()
+            self._prefetch = self.hass.async_create_task(
+                self._fetchCLI(self._prefetchSources)
+            )
+        errors = {}
+        if user_input is not None:
+            name = user_input[CONF_TUNNEL_NAME].strip().lower()
+            sources = user_input.get(CONF_SOURCES, DEFAULT_SOURCES)
+            if len(name) > TUNNEL_NAME_MAX or not _TUNNEL_NAME.match(name):
+                errors[CONF_TUNNEL_NAME] = "invalid_name"
+            elif name in self._takenNames(manager):
+                errors[CONF_TUNNEL_NAME] = "name_taken"
+            try:
+                parseSources(sources)
+            except ValueError:
+                errors[CONF_SOURCES] = "invalid_sources"
+            if not errors:
+                self.sources = sources
+                await self.async_set_unique_id(name)
+                self._abort_if_unique_id_configured()
+                self.tunnelName = name
+                self.cliDataDir = self.hass.config.path(
+                    STORAGE_DIR, DOMAIN, TUNNELS_DIR, name
+                )
+                return await self.async_step_register()
 
+        return self.async_show_form(
+            step_id="user",
+            data_schema=vol.Schema(
+                {
+                    vol.Required(
+                        CONF_TUNNEL_NAME, default=self._suggestName(manager)
+                    ): str,
+                    # a fleet's mirror is most likely the same for every tunnel
+                    vol.Optional(CONF_SOURCES, default=self._knownSources()): str,
+                }
+            ),
+            errors=errors,
+            description_placeholders={"max": str(TUNNEL_NAME_MAX)},
+        )
+
+    def _takenNames(self, manager):
+        # entries from before there could be more than one only have a record
+        return {
+            entry.unique_id or manager.record(entry.entry_id).get("tunnelName")
+            for entry in self._async_current_entries()
+        }
+
+    def _knownSources(self):
+        for entry in self._async_current_entries():
+            sources = {**entry.data, **entry.options}.get(CONF_SOURCES)
+            if sources:
+                return sources
+        return DEFAULT_SOURCES
+
+    def _suggestName(self, manager):
+        base = slugify(self.hass.config.location_name or "", separator="-") or "ha"
+        taken = self._takenNames(manager)
+        name = base[:TUNNEL_NAME_MAX]
+        number = 1
+        while name in taken:
+            number += 1
+            suffix = "-" + str(number)
+            name = base[: TUNNEL_NAME_MAX - len(suffix)] + suffix
+        return name
+
+    async def async_step_register(self, user_input=None):
         if self.device is None:
-            self.device = VSCodeDeviceAPI(self.path)
-            response = await self.device.register(
-                timeout=5
-            )  # can specify a timeout here. default is 3 seconds
-            if response is None:
-                # check to see if we are somehow already authenticated
-                response = await self.device.getDevURL(timeout=self.timeout)
-                if response is None:
-                    self._error = HAVSCodeAuthenticationException()
-                else:
-                    self.devURL = response
-            else:
-                self.oauthToken = response
+            # there is no entry yet, the tunnel is kept under the flow's id
+            self.device = async_get_manager(self.hass).acquire(
+                self.flow_id, self.path, self.tunnelName, self.cliDataDir
+            )
+            self.device.sources = parseSources(self.sources or DEFAULT_SOURCES)
+        return self._progress("register", PROGRESS_DOWNLOAD, self._getCLI, "start")
+
+    async def async_step_start(self, user_input=None):
+        return self._progress("start", PROGRESS_START, self._startTunnel, "wait")
+
+    async def async_step_wait(self, user_input=None):
+        return self._progress(
+            "wait",
+            PROGRESS_DEVICE_CODE,
+            self._waitForAuth,
+            "activate" if self.devURL is not None else "authorize",
+        )
 
+    def _progress(self, step_id, phase, work, next_step_id):
+        """Show phase while work runs as the setup task, then go on to
+        next_step_id, or to failed. The flow is configured again when the task
+        is done."""
+        if self._phase != phase:
+            self._phase = phase
+            self._setup = self.hass.async_create_task(self._runSetup(work))
+        if not self._setup.done():
+            return self.async_show_progress(
+                step_id=step_id, progress_action=phase, progress_task=self._setup
+            )
         if self._error is not None:
-            return self.async_abort(reason=self.reason_for_error())
-        if self.oauthToken is not None and self.activate:
-            return await self.async_step_activate(user_input)
-        elif self.devURL is not None:
+            return self.async_show_progress_done(next_step_id="failed")
+        return self.async_show_progress_done(next_step_id=next_step_id)
+
+    async def _fetchCLI(self, sources):
+        """Migrate and fetch the CLI, before there is a device."""
+        cache = async_get_manager(self.hass).cache(self.path)
+        await cache.migrate(legacyBinDir(self.hass))
+        # the device adopts these timings when it is created
+        timings = async_get_manager(self.hass).timings(self.flow_id)
+        with timings.span(PHASE_DOWNLOAD):
+            return await cache.fetch(
+                CLIDownloader(aiohttp_client.async_get_clientsession(self.hass)),
+                CLI_DOWNLOAD_URL.format(architecture=cliArchitecture()),
+                timings=timings,
+                sources=parseSources(sources),
+            )
+
+    async def _runSetup(self, work):
+        try:
+            await work()
+        except HAVSCodeException as err:
+            self._error = err
+        except Exception as err:  # pylint: disable=broad-except
+            self.log.exception("Setting up the tunnel failed")
+            self._error = err
+
+    async def _getCLI(self):
+        device = self.device
+        # the device's own fetch would wait for it on the cache anyway
+        (build,) = await asyncio.gather(self._prefetch, return_exceptions=True)
+        if isinstance(build, BaseException):
+            self.log.debug("Fetching the CLI in the background failed: %r", build)
+            build = await device.download()
+        elif self._prefetchSources != (self.sources or DEFAULT_SOURCES):
+            build = await device.download()
+        if build:
+            device.record.update(cliVersion=build.get("version"))
+        await device.checkExe()
+
+    async def _startTunnel(self):
+        # a start that is cancelled half way could leave the process behind,
+        # the release in async_remove waits for it and stops it instead
+        await asyncio.shield(self.device.asyncStartTunnel())
+
+    async def _waitForAuth(self):
+        # a device code, or a dev url if we are somehow already authenticated.
+        # waits as long as they took on this host before
+        self.oauthToken, self.devURL = await self.device.waitForAuth()
+        if self.oauthToken is None and self.devURL is None:
+            raise HAVSCodeAuthenticationException()
+        if self.devURL is not None:
             # set the auth token to "already_registered"
             self.oauthToken = "already_registered"
-            return await self.async_step_activate(user_input)
 
+    async def async_step_failed(self, _user_input=None):
+        reason = self.reason_for_error()
+        self.log.debug("Reason setup error: " + reason)
+        return self.async_abort(reason=reason)
+
+    async def async_step_authorize(self, user_input=None):
+        if user_input is not None:
+            return await self.async_step_activate(user_input)
         return await self._show_config_form(user_input)
 
     def reason_for_error(self):
@@ -91,6 +266,8 @@ class HAVSCodeFlowHandler(config_entries.ConfigFlow, domain=DOMAIN):
             return "tar"
         except HAVSCodeZipException:
             return "zip"
+        except HAVSCodeChecksumException:
+            return "checksum"
         except Exception:
             return "unknown"
 
@@ -98,7 +275,7 @@ class HAVSCodeFlowHandler(config_entries.ConfigFlow, domain=DOMAIN):
 
     async def async_step_activate(self, _user_input):
         if not self.devURL and not self._error:
-            result = await self.device.activate(timeout=3)
+            result = await self.device.activate()
             if not result:
                 self._error = HAVSCodeAuthenticationException()
             else:
@@ -109,14 +286,25 @@ class HAVSCodeFlowHandler(config_entries.ConfigFlow, domain=DOMAIN):
             self.log.debug("Reason activation error: " + reason)
             return self.async_abort(reason=reason)
 
+        # keep the setup timings and what we learned about the tunnel for the entry,
+        # and the tunnel itself, it is already up
+        self.hass.data.setdefault(DOMAIN_DATA, {})[self.unique_id] = {
+            "timings": self.device.timings,
+            "record": self.device.record.export(),
+            "flow_id": self.flow_id,
+        }
+
         # create entry and finish.
         return self.async_create_entry(
-            title="HA VSCode Tunnel",
+            title=NAME + " " + self.tunnelName,
             data={
                 "token": self.oauthToken,
                 "dev_url": self.devURL,
                 "path": self.path,
                 "timeout": self.timeout,
+                CONF_TUNNEL_NAME: self.tunnelName,
+                CONF_CLI_DATA_DIR: self.cliDataDir,
+                CONF_SOURCES: self.sources or DEFAULT_SOURCES,
             },
             description="Created configuration for HA VSCode Tunnel.\nPlease access VSCode instance at {url}",
             description_placeholders={
@@ -128,16 +316,22 @@ class HAVSCodeFlowHandler(config_entries.ConfigFlow, domain=DOMAIN):
     def async_remove(self):
         """Clean up resources or tasks associated with the flow."""
         self.log.info("Cleaning up...")
+        for task in (self._prefetch, self._setup):
+            if task is not None and not task.done():
+                task.cancel()
+        manager = async_get_manager(self.hass)
         if self.device:
-            self.device.stopTunnel()
+            # the entry it created took the device over, this only lets go of it
+            self.hass.async_create_task(manager.release(self.flow_id))
+            self.device = None
+        # the prefetch records timings before there is a device. an entry that
+        # got created has adopted them already
+        manager.forget(self.flow_id)
 
     async def _show_config_form(self, user_input):
-        """Show the configuration form to edit location data."""
-
-        self.activate = True
-
+        """Show the device code, the user submits once it is entered."""
         return self.async_show_form(
-            step_id="user",
+            step_id="authorize",
             data_schema=None,
             description_placeholders={
                 "url": "https://github.com/login/device",
@@ -164,23 +358,68 @@ class HAVSCodeOptionsFlowHandler(config_entries.OptionsFlow):
         self.path = config_entry.options.get("path")
         self.devURL = config_entry.options.get("dev_url")
         self.oauthToken = config_entry.options.get("token")
-        self.timeout = config_entry.options.get("timeout")
+        # the form starts from what the setup chose, unless the options were
+        # saved since. saving writes all of them to the options
+        options = {**config_entry.data, **config_entry.options}
+        self.timeout = options.get("timeout")
         if self.timeout is None:
-            self.timeout = 7.0
+            self.timeout = TIMEOUT_FLOOR
+        # idle suspend, resource profile, CLI sources and updates
+        self.tuning = {
+            key: options.get(key, default) for key, default in TUNING_DEFAULTS.items()
+        }
         self.log = LOGGER
         self._reauth = False
+        # only stop what we started, the switch may be using the tunnel
+        self._ownsTunnel = False
 
     async def async_step_init(self, _user_input=None):
         if self.path is None:
-            self.path = os.path.join(self.hass.config.path("custom_components"), DOMAIN)
-            self.path = os.path.join(self.path, "bin")
+            self.path = self.hass.config.path(STORAGE_DIR, DOMAIN, CLI_DIR)
             self.log.debug("bin directory located at: " + self.path)
 
         if self.device is None:
+            self.device = async_get_manager(self.hass).acquire(
+                self.config_entry.entry_id, self.path
+            )
+            if self._tunnelUp() and self.device.devURL:
+                # the switch has the tunnel up, it already told us where it is
+                self.devURL = self.device.devURL
+                return await self.async_step_user()
+            if self._tunnelUp() and self.device.oauthToken:
+                # the running tunnel is waiting to be authorized
+                self.oauthToken = self.device.oauthToken
+                self._reauth = True
+                return await self.async_step_user()
+
+            if self.device.record.authenticatedRecently():
+                # we saw the tunnel logged in not long ago, no need to ask the cli
+                if self.devURL is None:
+                    self.devURL = self.device.record.devURL
+                return await self.async_step_user()
+
+            # ask the cli first, that is quick and does not open a tunnel
+            state = await self.device.probeAuth()
+            if state.authenticated:
+                if self.devURL is None:
+                    self.devURL = state.devURL
+                return await self.async_step_user()
+
+            if self._tunnelUp():
+                # the switch's tunnel has not printed anything yet. it is not ours
+                # to restart or stop, wait for what it prints instead
+                token, url = await self.device.waitForAuth()
+                if token is not None:
+                    self.oauthToken = token
+                    self._reauth = True
+                elif url is not None:
+                    self.devURL = url
+                return await self.async_step_user()
+
             # start a tunnel and see if an oauth token is generated. if it is, then we need to reauth.
-            self.device = VSCodeDeviceAPI(self.path)
             self.device.startTunnel()
-            token = await self.device.getOAuthToken()
+            self._ownsTunnel = True
+            token, url = await self.device.waitForAuth()
             if token is not None:
                 self.oauthToken = token
                 self.log.debug("Token received during option setup was: " + token)
@@ -188,19 +427,26 @@ class HAVSCodeOptionsFlowHandler(config_entries.OptionsFlow):
                 self._reauth = True
                 # we'll have to stop the tunnel later...
             else:
-                url = await self.device.getDevURL(self.timeout)
                 if self.devURL is None:
                     self.devURL = url
                 self.device.stopTunnel()
+                self._ownsTunnel = False
 
         return await self.async_step_user()
 
+    def _tunnelUp(self):
+        # starting counts, the switch may have just turned it on
+        return self.device.isRunning() or self.device.lifecycle.active
+
     async def async_step_user(self, user_input=None):
         """Handle a flow initialized by the user."""
-        havsc = self.hass.data.get(DOMAIN)
         if user_input is not None:
             _timeout = float(user_input.get("timeout"))
-            if self.timeout != _timeout:
+            _tuning = {
+                key: user_input.get(key, default)
+                for key, default in self.tuning.items()
+            }
+            if self.timeout != _timeout or self.tuning != _tuning:
                 return self.async_create_entry(
                     title="HA VSCode Tunnel",
                     data={
@@ -208,6 +454,7 @@ class HAVSCodeOptionsFlowHandler(config_entries.OptionsFlow):
                         "dev_url": self.devURL,
                         "path": self.path,
                         "timeout": _timeout,
+                        **_tuning,
                     },
                     description="Created configuration for HA VSCode Tunnel.\nPlease access VSCode instance at {url}",
                     description_placeholders={
@@ -220,9 +467,43 @@ class HAVSCodeOptionsFlowHandler(config_entries.OptionsFlow):
         if self.config_entry is None:
             return self.async_abort(reason="not_setup")
 
-        placeHolders = None
         schema = {
             vol.Optional("timeout", default=self.timeout): float,
+            vol.Optional(CONF_IDLE_MODE, default=self.tuning[CONF_IDLE_MODE]): vol.In(
+                IDLE_MODES
+            ),
+            vol.Optional(
+                CONF_IDLE_TIMEOUT, default=self.tuning[CONF_IDLE_TIMEOUT]
+            ): vol.All(vol.Coerce(float), vol.Range(min=1)),
+            vol.Optional(CONF_NICE, default=self.tuning[CONF_NICE]): vol.All(
+                vol.Coerce(int), vol.Range(min=0, max=19)
+            ),
+            vol.Optional(CONF_IO_CLASS, default=self.tuning[CONF_IO_CLASS]): vol.In(
+                IO_CLASSES
+            ),
+            vol.Optional(
+                CONF_MEMORY_LIMIT, default=self.tuning[CONF_MEMORY_LIMIT]
+            ): vol.All(vol.Coerce(int), vol.Range(min=0)),
+            vol.Optional(CONF_MAX_FILES, default=self.tuning[CONF_MAX_FILES]): vol.All(
+                vol.Coerce(int), vol.Range(min=0)
+            ),
+            vol.Optional(CONF_CGROUP, default=self.tuning[CONF_CGROUP]): bool,
+            vol.Optional(CONF_CPU_MAX, default=self.tuning[CONF_CPU_MAX]): vol.All(
+                vol.Coerce(int), vol.Range(min=0)
+            ),
+            vol.Optional(
+                CONF_MEMORY_MAX, default=self.tuning[CONF_MEMORY_MAX]
+            ): vol.All(vol.Coerce(int), vol.Range(min=0)),
+            vol.Optional(CONF_HELPER, default=self.tuning[CONF_HELPER]): bool,
+            vol.Optional(CONF_SOURCES, default=self.tuning[CONF_SOURCES]): vol.All(
+                str, _validSources
+            ),
+            vol.Optional(
+                CONF_UPDATE_INTERVAL, default=self.tuning[CONF_UPDATE_INTERVAL]
+            ): vol.All(vol.Coerce(float), vol.Range(min=0)),
+            vol.Optional(
+                CONF_UPDATE_JITTER, default=self.tuning[CONF_UPDATE_JITTER]
+            ): vol.All(vol.Coerce(float), vol.Range(min=0)),
         }
         if self._reauth:
             return self.async_show_form(
@@ -244,8 +525,10 @@ class HAVSCodeOptionsFlowHandler(config_entries.OptionsFlow):
 
     async def async_step_reauth(self, user_input=None):
         if user_input is not None:
-            url = await self.device.getDevURL(self.timeout)
-            self.device.stopTunnel()
+            url = await self.device.getDevURL()
+            if self._ownsTunnel:
+                self.device.stopTunnel()
+                self._ownsTunnel = False
             if url is None:
                 return self.async_abort(reason="reauth_error")
             self.devURL = url
@@ -256,6 +539,7 @@ class HAVSCodeOptionsFlowHandler(config_entries.OptionsFlow):
                     "dev_url": self.devURL,
                     "path": self.path,
                     "timeout": self.timeout,
+                    **self.tuning,
                 },
                 description="Created configuration for HA VSCode Tunnel.\nPlease access VSCode instance at {url}",
                 description_placeholders={
@@ -269,5 +553,9 @@ class HAVSCodeOptionsFlowHandler(config_entries.OptionsFlow):
     def async_remove(self):
         """Clean up resources or tasks associated with the flow."""
         if self.device is not None:
-            self.device.stopTunnel()
+            if self._ownsTunnel:
+                self.device.stopTunnel()
+            self.hass.async_create_task(
+                async_get_manager(self.hass).release(self.config_entry.entry_id)
+            )
             self.device = None
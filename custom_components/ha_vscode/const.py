@@ -3,14 +3,68 @@ DOMAIN = "ha_vscode"
 PACKAGE_NAME = "custom_components.ha_vscode"
 DOMAIN_DATA = f"{DOMAIN}_data"
 VERSION = "0.1.50"
-MINIMUM_HA_VERSION = "2023.6.0"
+MINIMUM_HA_VERSION = "2023.7.0"
 ICON = "mdi:format-quote-close"
 CONF_ENABLED = "enabled"
+CONF_IDLE_MODE = "idle_mode"
+# minutes in the options, IdlePolicy takes seconds
+CONF_IDLE_TIMEOUT = "idle_timeout"
+DEFAULT_IDLE_TIMEOUT = 30
+DEFAULT_IDLE_MODE = "off"
+# the resource profile of the tunnel, sizes in MiB and 0 for no limit
+CONF_NICE = "nice"
+CONF_IO_CLASS = "io_class"
+CONF_MEMORY_LIMIT = "memory_limit"
+CONF_MAX_FILES = "max_files"
+CONF_CGROUP = "cgroup"
+CONF_CPU_MAX = "cpu_max"
+CONF_MEMORY_MAX = "memory_max"
+# run the tunnel in a process of its own, which survives Home Assistant restarts
+CONF_HELPER = "helper"
+# every entry is a tunnel of its own, with its own name and cli data directory
+CONF_TUNNEL_NAME = "tunnel_name"
+CONF_CLI_DATA_DIR = "cli_data_dir"
+# the limit of the cli
+TUNNEL_NAME_MAX = 20
+# where the cli is fetched from, in order, see artifact_sources
+CONF_SOURCES = "sources"
+DEFAULT_SOURCES = "upstream"
+# hours between background checks for a new cli, 0 for none, and minutes of
+# random delay on top, so a fleet does not ask all at once
+CONF_UPDATE_INTERVAL = "update_interval"
+CONF_UPDATE_JITTER = "update_jitter"
+# what the options form lets you change besides the timeout, with defaults
+TUNING_DEFAULTS = {
+    CONF_IDLE_MODE: DEFAULT_IDLE_MODE,
+    CONF_IDLE_TIMEOUT: DEFAULT_IDLE_TIMEOUT,
+    CONF_NICE: 0,
+    CONF_IO_CLASS: "default",
+    CONF_MEMORY_LIMIT: 0,
+    CONF_MAX_FILES: 0,
+    CONF_CGROUP: False,
+    CONF_CPU_MAX: 0,
+    CONF_MEMORY_MAX: 0,
+    CONF_HELPER: False,
+    CONF_SOURCES: DEFAULT_SOURCES,
+    CONF_UPDATE_INTERVAL: 24,
+    CONF_UPDATE_JITTER: 60,
+}
+SERVICE_RESUME = "resume"
+SERVICE_OUTPUT = "output"
 DEFAULT_NAME = DOMAIN
 HAVSCODE_SYSTEM_ID = "98450013-1865-4292-be24-abde34214bd6"
 ISSUE_URL = "https://https://github.com/adechant/ha_vscode/issues"
+# under .storage/ha_vscode, bin/ inside the integration was wiped by HACS updates
+CLI_DIR = "cli"
+LEGACY_BIN_DIR = "bin"
+CLI_DOWNLOAD_URL = (
+    "https://code.visualstudio.com/sha/download?build=stable&os=cli-{architecture}"
+)
+# .storage/ha_vscode/tunnels/<tunnel name>, the --cli-data-dir of each tunnel
+TUNNELS_DIR = "tunnels"
 SWITCH = "switch"
-PLATFORMS = [SWITCH]
+SENSOR = "sensor"
+PLATFORMS = [SWITCH, SENSOR]
 
 
 STARTUP_MESSAGE = f"""
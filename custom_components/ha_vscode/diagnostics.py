@@ -0,0 +1,66 @@
+"""Diagnostics support for HA VSCode Tunnel."""
+import os
+import re
+
+from homeassistant.components.diagnostics import async_redact_data
+from homeassistant.components.diagnostics import REDACTED
+
+from .cli_cache import CLICache
+from .const import CONF_CLI_DATA_DIR
+from .const import CONF_TUNNEL_NAME
+from .manager import async_get_manager
+from .vscode_device import cliArchitecture
+
+_SECRETS = re.compile(r"(use code |vscode\.dev/tunnel/)[^/\s]+")
+
+# the tunnel name is in the entry's title, unique id and data directory as well
+TO_REDACT = {
+    "token",
+    "dev_url",
+    "devURL",
+    "tunnelName",
+    "title",
+    "unique_id",
+    CONF_TUNNEL_NAME,
+    CONF_CLI_DATA_DIR,
+}
+
+
+def _redactOutput(device):
+    # the tunnel name is part of every url, the device code is a login
+    secrets = [device.record.tunnelName] if device.record.tunnelName else []
+    lines = []
+    for _, line in device.output.snapshot():
+        line = _SECRETS.sub(lambda match: match.group(1) + REDACTED, line)
+        for secret in secrets:
+            line = line.replace(secret, REDACTED)
+        lines.append(line)
+    return {"dropped": device.output.dropped, "lines": lines}
+
+
+async def async_get_config_entry_diagnostics(hass, config_entry):
+    """Return diagnostics for a config entry."""
+    manager = async_get_manager(hass)
+    device = manager.get(config_entry.entry_id)
+    cache = CLICache(config_entry.data["path"], cliArchitecture())
+    await cache.load()
+
+    diagnostics = {
+        "entry": async_redact_data(config_entry.as_dict(), TO_REDACT),
+        # to compare boards and cli versions
+        "machine": os.uname().machine,
+        "cli": cache.current(),
+        "timings": manager.timings(config_entry.entry_id).summary(),
+        "record": async_redact_data(manager.record(config_entry.entry_id), TO_REDACT),
+    }
+    if device is not None:
+        diagnostics["tunnel"] = {
+            "running": device.isRunning(),
+            "state": device.lifecycle.state,
+            "supervisor": device.supervisor.stats(),
+            "resources": device.resources.sample._asdict()
+            if device.resources.sample
+            else None,
+            "output": _redactOutput(device),
+        }
+    return diagnostics
@@ -0,0 +1,223 @@
+"""Stream the VSCode CLI archive over HTTP, without curl or wget."""
+import asyncio
+import logging
+from typing import NamedTuple
+from typing import Optional
+
+import aiohttp
+
+from .const import PACKAGE_NAME
+from .exceptions import HAVSCodeDownloadException
+
+LOGGER: logging.Logger = logging.getLogger(PACKAGE_NAME)
+
+CHUNK_SIZE = 64 * 1024
+RETRIES = 3
+READ_TIMEOUT = 30.0
+
+# the transfer broke off in the middle, these are worth resuming
+RESUMABLE_ERRORS = (
+    aiohttp.ClientPayloadError,
+    aiohttp.ClientConnectionError,
+    asyncio.TimeoutError,
+)
+
+
+class DownloadResult(NamedTuple):
+    """What came back from a completed download."""
+
+    received: int
+    etag: Optional[str]
+    last_modified: Optional[str]
+    # after redirects
+    url: str
+
+
+class FileSink:
+    """Download sink writing to a file, from the executor."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self._file = await loop.run_in_executor(None, open, self.path, "wb")
+
+    async def write(self, chunk):
+        await asyncio.get_running_loop().run_in_executor(None, self._file.write, chunk)
+
+    async def rewind(self):
+        await asyncio.get_running_loop().run_in_executor(None, self._rewind)
+
+    def _rewind(self):
+        self._file.seek(0)
+        self._file.truncate()
+
+    async def finish(self):
+        await asyncio.get_running_loop().run_in_executor(None, self._file.close)
+        return self.path
+
+    async def abort(self):
+        await self.finish()
+
+
+class MemorySink:
+    """Download sink keeping a small body, e.g. a manifest, in memory."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._chunks = []
+        self._size = 0
+        # the body, once finished
+        self.data = None
+
+    async def start(self):
+        self._chunks = []
+        self._size = 0
+
+    async def write(self, chunk):
+        self._size += len(chunk)
+        if self._size > self.limit:
+            LOGGER.error("Response is larger than %d bytes", self.limit)
+            raise HAVSCodeDownloadException()
+        self._chunks.append(chunk)
+
+    async def rewind(self):
+        await self.start()
+
+    async def finish(self):
+        self.data = b"".join(self._chunks)
+        return self.data
+
+    async def abort(self):
+        self._chunks = []
+
+
+class CLIDownloader:
+    """Download a file in chunks, resuming with HTTP Range requests when the
+    connection drops.
+
+    Only one chunk is held in memory at a time: the next one is not read from the
+    socket until the previous one is on disk. TLS certificates are verified by the
+    session (Home Assistant's shared session does this by default).
+    """
+
+    def __init__(
+        self,
+        session=None,
+        chunk_size=CHUNK_SIZE,
+        retries=RETRIES,
+        read_timeout=READ_TIMEOUT,
+    ):
+        self.log = LOGGER
+        self.session = session
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.read_timeout = read_timeout
+
+    async def download(self, url, outfile, progress=None, headers=None):
+        """Save url to outfile. progress(received, total) is called after every
+        chunk, total is None if the server did not send a length."""
+        return await self.stream(url, FileSink(outfile), progress, headers)
+
+    async def stream(self, url, sink, progress=None, headers=None):
+        """Hand the body of url to sink chunk by chunk. sink needs async start,
+        write(chunk), rewind, finish and abort methods; see FileSink.
+
+        Returns a DownloadResult, or None if headers made the request conditional
+        and the server answered 304 Not Modified.
+        """
+        if self.session is not None:
+            return await self._download(self.session, url, sink, progress, headers)
+        # outside of home assistant, e.g. when running vscode_device.main()
+        async with aiohttp.ClientSession() as session:
+            return await self._download(session, url, sink, progress, headers)
+
+    async def _download(self, session, url, sink, progress, headers):
+        await sink.start()
+        try:
+            result = await self._transfer(session, url, sink, progress, headers or {})
+        except BaseException:
+            await sink.abort()
+            raise
+        if result is None:
+            await sink.abort()
+            self.log.debug("%s not modified", url)
+            return None
+        await sink.finish()
+        self.log.debug("Downloaded %d bytes from %s", result.received, url)
+        return result
+
+    async def _transfer(self, session, url, sink, progress, conditional):
+        received = 0
+        final_url = url
+        total = None
+        validator = None
+        failures = 0
+        while True:
+            # conditional headers only make sense for the first request
+            headers = {} if received else dict(conditional)
+            if received:
+                headers["Range"] = f"bytes={received}-"
+                if validator:
+                    # only resume if the file did not change in the meantime
+                    headers["If-Range"] = validator
+            try:
+                async with session.get(
+                    url,
+                    headers=headers,
+                    timeout=aiohttp.ClientTimeout(sock_read=self.read_timeout),
+                ) as response:
+                    final_url = str(response.url)
+                    if response.status == 304 and not received:
+                        return None
+                    if response.status == 206 and received:
+                        self.log.debug("Resuming download at byte %d", received)
+                    elif response.status == 200:
+                        if received:
+                            self.log.debug("Server ignored range, restarting download")
+                            await sink.rewind()
+                            received = 0
+                    else:
+                        response.raise_for_status()
+                        self.log.error(
+                            "Unexpected response %d downloading %s",
+                            response.status,
+                            url,
+                        )
+                        raise HAVSCodeDownloadException()
+
+                    if response.content_length is not None:
+                        total = received + response.content_length
+                    etag = response.headers.get("ETag")
+                    last_modified = response.headers.get("Last-Modified")
+                    validator = etag or last_modified
+
+                    async for chunk in response.content.iter_chunked(self.chunk_size):
+                        await sink.write(chunk)
+                        received += len(chunk)
+                        if progress:
+                            progress(received, total)
+
+                if total is not None and received < total:
+                    raise aiohttp.ClientPayloadError(
+                        f"Transfer ended at {received} of {total} bytes"
+                    )
+                return DownloadResult(received, etag, last_modified, final_url)
+            except aiohttp.ClientSSLError as err:
+                # a certificate that does not verify won't on the next try either
+                self.log.error("Downloading %s failed: %s", url, err)
+                raise HAVSCodeDownloadException() from err
+            except RESUMABLE_ERRORS as err:
+                failures += 1
+                if failures > self.retries:
+                    self.log.error("Giving up downloading %s: %s", url, err)
+                    raise HAVSCodeDownloadException() from err
+                self.log.debug(
+                    "Download interrupted at %d bytes (%s), retrying", received, err
+                )
+                await asyncio.sleep(0.5 * failures)
+            except aiohttp.ClientResponseError as err:
+                self.log.error("Downloading %s failed: %s", url, err)
+                raise HAVSCodeDownloadException() from err
@@ -17,8 +17,18 @@ class HAVSCodeAuthenticationException(HAVSCodeException):
 
 class HAVSCodeDownloadException(HAVSCodeException):
     exception_message = (
-        "Neither curl nor wget are available on your system. "
-        "Please install one or the other and try again."
+        "Downloading the VSCode CLI failed. "
+        "Please check your network connection and the system logs."
+    )
+
+    def __init__(self) -> None:
+        super().__init__(self.exception_message)
+
+
+class HAVSCodeChecksumException(HAVSCodeException):
+    exception_message = (
+        "The VSCode CLI does not match the sha256 pinned in the manifest "
+        "of its source."
     )
 
     def __init__(self) -> None:
@@ -37,3 +47,13 @@ class HAVSCodeTarException(HAVSCodeException):
 
     def __init__(self) -> None:
         super().__init__(self.exception_message)
+
+
+class HAVSCodeHelperException(HAVSCodeException):
+    exception_message = (
+        "The tunnel helper process could not be reached. "
+        "Please check helper.log next to its socket."
+    )
+
+    def __init__(self) -> None:
+        super().__init__(self.exception_message)
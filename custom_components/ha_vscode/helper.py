@@ -0,0 +1,569 @@
+"""Keep the tunnel in a helper process that outlives Home Assistant.
+
+The helper is `python helper_main.py --helper SOCKET`, a script in this
+directory that runs main() of vscode_device.py without Home Assistant. It owns
+the `code tunnel` process, so the tunnel's output and children cost the Home
+Assistant process nothing. A restart of Home Assistant leaves the tunnel, and
+whoever is editing through it, alone. Home Assistant talks to the helper
+through a HelperDeviceAPI: a VSCodeDeviceAPI whose process level operations go
+over a Unix socket, and which reattaches to a running tunnel in one round trip.
+
+Every frame is a 4 byte big endian length, then that many bytes of compact
+JSON. The client sends requests {"id": n, "op": ..., ...}. Each one gets a
+{"id": n, "result": ...} or {"id": n, "error": "..."}, not necessarily in
+order. After a subscribe the helper also sends events, which have no id:
+
+    {"event": "state", "previous": ..., "state": ..., "pid": ...,
+     "supervisor": {...}}
+    {"event": "line", "at": ..., "line": ...}
+    {"event": "record", "record": {...}}
+    {"event": "supervisor", "supervisor": {...}}
+
+The helper's own TunnelSupervisor restarts a tunnel that crashes, Home
+Assistant only shows its stats.
+
+The ops are status, subscribe (answers with the status too), start (with a
+profile and a name), stop, stop_server and shutdown.
+
+A helper that is killed with SIGKILL leaves its tunnel behind without an owner.
+"""
+import asyncio
+import itertools
+import json
+import logging
+from logging.handlers import RotatingFileHandler
+import os
+import signal
+import socket
+import struct
+import sys
+import time
+
+from .const import PACKAGE_NAME
+from .exceptions import HAVSCodeHelperException
+from .lifecycle import ACTIVE_STATES
+from .lifecycle import route
+from .lifecycle import STATE_FAILED
+from .lifecycle import STATE_STARTING
+from .lifecycle import STATE_STOPPED
+from .resource_profile import ResourceProfile
+from .supervisor import CIRCUIT_CLOSED
+from .tunnel_record import FIELDS
+from .vscode_device import VSCodeDeviceAPI
+
+LOGGER: logging.Logger = logging.getLogger(PACKAGE_NAME)
+
+HELPER_SOCKET = "helper.sock"
+HELPER_LOG = "helper.log"
+HELPER_SCRIPT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "helper_main.py"
+)
+# seconds for a new helper to open its socket
+HELPER_START_TIMEOUT = 10.0
+
+_HEADER = struct.Struct("!I")
+MAX_FRAME = 1024 * 1024
+# a subscriber this far behind is dropped instead of buffering without end
+MAX_BACKLOG = 1024 * 1024
+
+
+class HelperProtocolError(Exception):
+    """The other side sent something that is not a frame."""
+
+
+async def readFrame(reader):
+    """The next message from reader, None at the end of the stream."""
+    try:
+        header = await reader.readexactly(_HEADER.size)
+    except asyncio.IncompleteReadError as err:
+        if err.partial:
+            raise HelperProtocolError("stream ended inside a frame header") from err
+        return None
+    (size,) = _HEADER.unpack(header)
+    if size > MAX_FRAME:
+        raise HelperProtocolError(f"frame of {size} bytes is too large")
+    try:
+        body = await reader.readexactly(size)
+    except asyncio.IncompleteReadError as err:
+        raise HelperProtocolError("stream ended inside a frame") from err
+    try:
+        return json.loads(body)
+    except ValueError as err:
+        raise HelperProtocolError("frame is not JSON") from err
+
+
+def writeFrame(writer, message):
+    body = json.dumps(message, separators=(",", ":")).encode()
+    writer.write(_HEADER.pack(len(body)) + body)
+
+
+class TunnelHelper:
+    """Serves the tunnel of device on a Unix socket at path until shut down."""
+
+    def __init__(self, device, path):
+        self.log = LOGGER
+        self.device = device
+        self.path = path
+        self._clients = set()
+        self._subscribers = set()
+        self._tasks = set()
+        self._done = None
+        self._ops = {
+            "status": self._status,
+            "subscribe": self._subscribe,
+            "start": self._start,
+            "stop": self._stop,
+            "stop_server": self._stopServer,
+            "shutdown": self._shutdown,
+        }
+        device.lifecycle.addListener(self._onTransition)
+        device.output.addListener(self._onLine)
+        device.record.addListener(self._onRecord)
+        device.supervisor.addListener(self._onSupervisor)
+
+    def status(self):
+        device = self.device
+        return {
+            "state": device.lifecycle.state,
+            "desired": device.desired,
+            "pid": device.pid,
+            "devURL": device.devURL,
+            "oauthToken": device.oauthToken,
+            "record": device.record.export(),
+            "output": device.output.snapshot(),
+            "supervisor": device.supervisor.stats(),
+        }
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        self._done = asyncio.Event()
+        await loop.run_in_executor(None, self._claimSocket)
+        # nobody but us gets to control the tunnel
+        umask = os.umask(0o177)
+        try:
+            server = await asyncio.start_unix_server(self._onClient, path=self.path)
+        finally:
+            os.umask(umask)
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self._done.set)
+        self.log.info("Tunnel helper %d serving on %s", os.getpid(), self.path)
+        try:
+            await self._done.wait()
+            await self.device.asyncSetDesired(False)
+        finally:
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                loop.remove_signal_handler(sig)
+            server.close()
+            for writer in tuple(self._clients):
+                writer.close()
+            await server.wait_closed()
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+        self.log.info("Tunnel helper %d done", os.getpid())
+
+    def _claimSocket(self):
+        # a socket file without a helper behind it is left over from a crash
+        if not os.path.exists(self.path):
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.unlink(self.path)
+        else:
+            raise HAVSCodeHelperException()
+        finally:
+            probe.close()
+
+    async def _onClient(self, reader, writer):
+        self._clients.add(writer)
+        try:
+            while True:
+                request = await readFrame(reader)
+                if request is None:
+                    break
+                # a start or stop takes a while, keep reading in the meantime
+                task = asyncio.get_running_loop().create_task(
+                    self._answer(writer, request)
+                )
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+        except (HelperProtocolError, ConnectionError) as err:
+            self.log.warning("Dropping tunnel helper client: %s", err)
+        finally:
+            self._clients.discard(writer)
+            self._subscribers.discard(writer)
+            writer.close()
+
+    async def _answer(self, writer, request):
+        op = self._ops.get(request.get("op"))
+        try:
+            if op is None:
+                raise ValueError("unknown op " + str(request.get("op")))
+            response = {"id": request.get("id"), "result": await op(writer, request)}
+        except Exception as err:  # pylint: disable=broad-except
+            self.log.warning("Tunnel helper op %s failed: %s", request.get("op"), err)
+            response = {"id": request.get("id"), "error": str(err) or repr(err)}
+        self._send(writer, response)
+
+    def _send(self, writer, message):
+        if writer.is_closing():
+            return
+        if writer.transport.get_write_buffer_size() > MAX_BACKLOG:
+            self.log.warning("Tunnel helper client does not keep up, dropping it")
+            writer.close()
+            return
+        writeFrame(writer, message)
+
+    def _broadcast(self, message):
+        for writer in tuple(self._subscribers):
+            self._send(writer, message)
+
+    def _onTransition(self, previous, state):
+        self._broadcast(
+            {
+                "event": "state",
+                "previous": previous,
+                "state": state,
+                "pid": self.device.pid,
+                "supervisor": self.device.supervisor.stats(),
+            }
+        )
+
+    def _onLine(self, at, line):
+        self._broadcast({"event": "line", "at": at, "line": line})
+
+    def _onRecord(self):
+        self._broadcast({"event": "record", "record": self.device.record.export()})
+
+    def _onSupervisor(self):
+        self._broadcast(
+            {"event": "supervisor", "supervisor": self.device.supervisor.stats()}
+        )
+
+    async def _status(self, writer, request):
+        return self.status()
+
+    async def _subscribe(self, writer, request):
+        # the status and then every event after it, nothing in between
+        self._subscribers.add(writer)
+        return self.status()
+
+    async def _start(self, writer, request):
+        device = self.device
+        if request.get("profile") is not None:
+            device.resourceProfile = ResourceProfile(*request["profile"])
+        if request.get("name"):
+            device.record.update(tunnelName=request["name"])
+        # the supervisor only restarts a tunnel that is wanted
+        device.desired = True
+        await device.asyncStartTunnel()
+        return self.status()
+
+    async def _stop(self, writer, request):
+        await self.device.asyncSetDesired(False)
+        return self.status()
+
+    async def _stopServer(self, writer, request):
+        await self.device.asyncStopServer()
+
+    async def _shutdown(self, writer, request):
+        # answered before serve() gets to stop the tunnel
+        asyncio.get_running_loop().call_soon(self._done.set)
+
+
+async def runHelper(path, storage_dir, cliDataDir=None):
+    """The helper process: serve a VSCodeDeviceAPI for storage_dir on path. The
+    log goes next to the socket, there is one helper per tunnel."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    handler = RotatingFileHandler(
+        os.path.join(os.path.dirname(path), HELPER_LOG),
+        maxBytes=1024 * 1024,
+        backupCount=1,
+    )
+    handler.setFormatter(
+        logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+    )
+    LOGGER.addHandler(handler)
+    LOGGER.setLevel(logging.INFO)
+    device = VSCodeDeviceAPI(storage_dir, cliDataDir=cliDataDir)
+    await TunnelHelper(device, path).serve()
+
+
+class HelperSupervisor:
+    """The supervisor of a HelperDeviceAPI, which only reports the stats of the
+    helper's. A second one restarting the tunnel from here would start it again
+    after every crash, and each start from outside resets the helper's count of
+    failures, so its circuit breaker would never open."""
+
+    def __init__(self, device):
+        self._stats = {
+            "restarts": 0,
+            "consecutive_failures": 0,
+            "circuit": CIRCUIT_CLOSED,
+            "last_recovery_s": None,
+        }
+        self._listeners = []
+
+    def stats(self):
+        return dict(self._stats)
+
+    def addListener(self, listener):
+        """Call listener() when the helper's stats change. Returns a remove
+        callable."""
+        self._listeners.append(listener)
+        return lambda: self._listeners.remove(listener)
+
+    def follow(self, stats):
+        if not stats or stats == self._stats:
+            return
+        self._stats = dict(stats)
+        for listener in tuple(self._listeners):
+            listener()
+
+
+class HelperDeviceAPI(VSCodeDeviceAPI):
+    """A VSCodeDeviceAPI whose tunnel runs in a helper process.
+
+    The lifecycle, the output and the record follow what the helper reports, so
+    everything built on the device (switch, idle policy, sensors) works as it
+    does for a local tunnel. Restarts are left to the helper, see
+    HelperSupervisor. workdir is where the helper runs, Home Assistant's
+    configuration directory.
+    """
+
+    supervisorClass = HelperSupervisor
+
+    def __init__(self, storage_dir, workdir, **kwargs):
+        super().__init__(storage_dir, **kwargs)
+        # next to the tunnel's own cli data, if it has any
+        self.socketPath = os.path.join(self.cliDataDir or storage_dir, HELPER_SOCKET)
+        self.workdir = workdir
+        self.remotePid = None
+        self._writer = None
+        self._listener = None
+        self._attaching = None
+        self._detaching = False
+        self._requests = {}
+        self._ids = itertools.count(1)
+
+    def isRunning(self):
+        return self.remotePid is not None and self.lifecycle.active
+
+    @property
+    def pid(self):
+        return self.remotePid if self.lifecycle.active else None
+
+    async def asyncAttach(self):
+        """Connect to the helper, starting it if there is none, and take over the
+        state of its tunnel."""
+        if self._writer is not None:
+            return
+        if self._attaching is None or self._attaching.done():
+            self._attaching = asyncio.get_running_loop().create_task(self._attach())
+        await asyncio.shield(self._attaching)
+
+    async def _attach(self):
+        started = time.monotonic()
+        try:
+            reader, writer = await asyncio.open_unix_connection(self.socketPath)
+        except (FileNotFoundError, ConnectionRefusedError):
+            reader, writer = await self._startHelper()
+        self._writer = writer
+        self._detaching = False
+        self._listener = asyncio.get_running_loop().create_task(self._listen(reader))
+        self._mirror(await self._request("subscribe"))
+        self.log.debug(
+            "Attached to tunnel helper in %.3fs, tunnel is %s",
+            time.monotonic() - started,
+            self.lifecycle.state,
+        )
+
+    async def _startHelper(self):
+        self.log.info("Starting the tunnel helper at " + self.socketPath)
+        loop = asyncio.get_running_loop()
+        await self._makeDataDir()
+        await asyncio.create_subprocess_exec(
+            sys.executable,
+            HELPER_SCRIPT,
+            "--helper",
+            self.socketPath,
+            "--storage",
+            self.storage_dir,
+            *(("--cli-data-dir", self.cliDataDir) if self.cliDataDir else ()),
+            cwd=self.workdir,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
+            # not in Home Assistant's session, so it is not stopped along with it
+            start_new_session=True,
+        )
+        deadline = loop.time() + HELPER_START_TIMEOUT
+        while True:
+            await asyncio.sleep(0.05)
+            try:
+                return await asyncio.open_unix_connection(self.socketPath)
+            except (FileNotFoundError, ConnectionRefusedError) as err:
+                if loop.time() > deadline:
+                    raise HAVSCodeHelperException() from err
+
+    async def _request(self, op, **params):
+        await self.asyncAttach()
+        number = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._requests[number] = future
+        try:
+            writeFrame(self._writer, {"id": number, "op": op, **params})
+            await self._writer.drain()
+        except (ConnectionError, AttributeError) as err:
+            # AttributeError: the connection went away while we were waiting
+            self._requests.pop(number, None)
+            raise HAVSCodeHelperException() from err
+        return await future
+
+    async def _listen(self, reader):
+        try:
+            while True:
+                message = await readFrame(reader)
+                if message is None:
+                    break
+                if "event" in message:
+                    self._onEvent(message)
+                    continue
+                future = self._requests.pop(message.get("id"), None)
+                if future is None or future.done():
+                    continue
+                if "error" in message:
+                    self.log.warning("Tunnel helper: " + str(message["error"]))
+                    future.set_exception(HAVSCodeHelperException())
+                else:
+                    future.set_result(message.get("result"))
+        except (HelperProtocolError, ConnectionError) as err:
+            self.log.warning("Lost the tunnel helper: " + str(err))
+        finally:
+            self._disconnected()
+
+    def _disconnected(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._writer = None
+        for future in self._requests.values():
+            if not future.done():
+                future.set_exception(HAVSCodeHelperException())
+        self._requests.clear()
+        if self._detaching:
+            return
+        if self.lifecycle.active:
+            # the helper is gone, and its tunnel with it
+            self.log.warning("Tunnel helper went away with the tunnel running")
+            self.remotePid = None
+            self._follow(STATE_FAILED)
+
+    def _onEvent(self, message):
+        event = message.get("event")
+        if event == "line":
+            line = message["line"]
+            self.output.append(line, message.get("at"))
+            self.outputLog.debug("Tunnel output: %s", line)
+            self.parser.feed(line)
+        elif event == "state":
+            self.remotePid = message.get("pid")
+            # before the transition, whose listeners show the stats
+            self.supervisor.follow(message.get("supervisor"))
+            self._follow(message["state"])
+        elif event == "record":
+            self._adoptRecord(message["record"])
+        elif event == "supervisor":
+            self.supervisor.follow(message["supervisor"])
+
+    def _follow(self, state):
+        if state == STATE_STARTING and self.lifecycle.state != STATE_STARTING:
+            # what a local asyncStartTunnel does before it spawns
+            self.loop = asyncio.get_running_loop()
+            self.oauthToken = None
+            self.devURL = None
+            self._tokenFuture = self.loop.create_future()
+            self._devURLFuture = self.loop.create_future()
+            self._spawnedAt = time.monotonic()
+        # after a reattach we may be a few transitions behind
+        for step in route(self.lifecycle.state, state) or [state]:
+            self.lifecycle.advance(step)
+        if state in (STATE_FAILED, STATE_STOPPED):
+            # what the reader does at the end of the output
+            self._spawnedAt = None
+            self._resolve(self._tokenFuture, None)
+            self._resolve(self._devURLFuture, None)
+
+    def _adoptRecord(self, record):
+        # a helper that just started knows less than we do
+        self.record.update(
+            **{
+                field: value
+                for field, value in record.items()
+                if field in FIELDS and value is not None
+            }
+        )
+
+    def _mirror(self, status):
+        self._adoptRecord(status.get("record") or {})
+        if not len(self.output):
+            for at, line in status.get("output") or ():
+                self.output.append(line, at)
+        self.remotePid = status.get("pid")
+        self.supervisor.follow(status.get("supervisor"))
+        if status["state"] in ACTIVE_STATES and self.desired is None:
+            self.desired = True
+        if status["state"] != self.lifecycle.state:
+            self._follow(status["state"])
+        if status.get("oauthToken"):
+            self.oauthToken = status["oauthToken"]
+            self._resolve(self._tokenFuture, self.oauthToken)
+        if status.get("devURL"):
+            self.devURL = status["devURL"]
+            self._resolve(self._devURLFuture, self.devURL)
+            self._resolve(self._tokenFuture, None)
+
+    async def asyncStartTunnel(self, profile=None):
+        if profile is not None:
+            self.resourceProfile = profile
+        async with self._opLock:
+            # the helper starts whatever the symlink points to
+            await self.promoteCLI()
+            # the helper's transitions set everything up, see _follow
+            status = await self._request(
+                "start", profile=list(self.resourceProfile), name=self.tunnelName
+            )
+            self.remotePid = status.get("pid")
+
+    async def _stop(self):
+        await self._request("stop")
+        await self.promoteCLI()
+
+    async def _hasTunnel(self):
+        # there is no proc on this side, what we mirror may be behind
+        status = await self._request("status")
+        return status["state"] != STATE_STOPPED
+
+    async def asyncStopServer(self):
+        await self._request("stop_server")
+
+    async def asyncDetach(self):
+        """Disconnect and leave the tunnel running for the next Home Assistant."""
+        self._detaching = True
+        if self._writer is not None:
+            self._writer.close()
+        if self._listener is not None:
+            await asyncio.gather(self._listener, return_exceptions=True)
+
+    async def asyncClose(self):
+        """Shut the helper down, it has nothing to do any more."""
+        await super().asyncClose()
+        if self._writer is None:
+            return
+        try:
+            await self._request("shutdown")
+        except HAVSCodeHelperException:
+            pass
+        await self.asyncDetach()
@@ -0,0 +1,28 @@
+"""Run the tunnel helper, see helper.py:
+
+    python helper_main.py --helper SOCKET --storage DIR [--cli-data-dir DIR]
+
+Not `python -m custom_components.ha_vscode.vscode_device`: that imports the
+integration's __init__, which needs Home Assistant, and the helper has to run
+without it. The modules are imported as submodules of a bare package pointing
+at this directory instead, none of the ones the helper uses need more.
+"""
+import importlib
+import os
+import sys
+import types
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PACKAGE = "ha_vscode_helper"
+
+
+def load(name):
+    if PACKAGE not in sys.modules:
+        package = types.ModuleType(PACKAGE)
+        package.__path__ = [HERE]
+        sys.modules[PACKAGE] = package
+    return importlib.import_module(f"{PACKAGE}.{name}")
+
+
+if __name__ == "__main__":
+    load("vscode_device").main()
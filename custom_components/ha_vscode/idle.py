@@ -0,0 +1,138 @@
+"""Suspend a tunnel nobody is connected to.
+
+The tunnel prints a line whenever a client opens or closes a channel. Once the
+last one is gone for the idle timeout the policy either stops the VSCode server
+(the CLI stays up and starts a new server for the next client) or the whole
+tunnel, which then comes back through the switch or the resume service under
+the same name, and so at the same address.
+"""
+import asyncio
+import logging
+import time
+
+from .const import PACKAGE_NAME
+from .lifecycle import STATE_RUNNING
+from .lifecycle import STATE_STARTING
+from .tunnel_output import EVENT_CONNECTED
+from .tunnel_output import EVENT_DISCONNECTED
+
+LOGGER: logging.Logger = logging.getLogger(PACKAGE_NAME)
+
+IDLE_OFF = "off"
+IDLE_SERVER = "server"
+IDLE_TUNNEL = "tunnel"
+IDLE_MODES = (IDLE_OFF, IDLE_SERVER, IDLE_TUNNEL)
+# seconds
+IDLE_TIMEOUT = 30 * 60
+
+
+class IdlePolicy:
+    """Counts the clients of a device's tunnel and suspends it when idle."""
+
+    def __init__(self, device, mode=IDLE_OFF, timeout=IDLE_TIMEOUT):
+        self.log = LOGGER
+        self.device = device
+        self.mode = mode
+        self.timeout = timeout
+        self.clients = set()
+        # wall clock, for the attributes
+        self.idleSince = None
+        # None, or the mode the tunnel was suspended with
+        self.suspended = None
+        self._timer = None
+        self._listeners = []
+        device.parser.subscribe(EVENT_CONNECTED, self._onConnected)
+        device.parser.subscribe(EVENT_DISCONNECTED, self._onDisconnected)
+        device.lifecycle.addListener(self._onTransition)
+
+    def configure(self, mode, timeout):
+        if mode not in IDLE_MODES:
+            raise ValueError("Unknown idle mode: " + str(mode))
+        self.mode = mode
+        self.timeout = timeout
+        if self.clients or self.device.lifecycle.state != STATE_RUNNING:
+            return
+        self._arm()
+
+    def stats(self):
+        return {
+            "clients": len(self.clients),
+            "idle_since": self.idleSince,
+            "suspended": self.suspended,
+        }
+
+    def addListener(self, listener):
+        """Call listener() when clients come or go, or the tunnel is suspended.
+        Returns a remove callable."""
+        self._listeners.append(listener)
+        return lambda: self._listeners.remove(listener)
+
+    def _notify(self):
+        for listener in tuple(self._listeners):
+            listener()
+
+    def _onConnected(self, event):
+        self.clients.add(event.value)
+        self._disarm()
+        self.idleSince = None
+        # the cli started a new server for this client
+        self.suspended = None
+        self._notify()
+
+    def _onDisconnected(self, event):
+        if event.value in self.clients:
+            self.clients.discard(event.value)
+        elif self.clients:
+            # no channel in the message, one of them is gone
+            self.clients.pop()
+        if not self.clients:
+            self._arm()
+        self._notify()
+
+    def _onTransition(self, previous, state):
+        if state == STATE_RUNNING:
+            if not self.clients:
+                self._arm()
+            return
+        if state == STATE_STARTING:
+            self.suspended = None
+        if previous == STATE_RUNNING:
+            # a new process starts out without clients
+            self._disarm()
+            self.clients.clear()
+            self.idleSince = None
+
+    def _arm(self):
+        self._disarm()
+        self.idleSince = time.time()
+        if self.mode == IDLE_OFF:
+            return
+        self._timer = asyncio.get_running_loop().call_later(self.timeout, self._onIdle)
+
+    def _disarm(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _onIdle(self):
+        self._timer = None
+        asyncio.get_running_loop().create_task(self.suspend())
+
+    async def suspend(self):
+        if self.suspended or self.device.lifecycle.state != STATE_RUNNING:
+            return
+        self.log.info(
+            "No client for %ds, suspending the tunnel (%s)", self.timeout, self.mode
+        )
+        if self.mode == IDLE_SERVER:
+            await self.device.asyncStopServer()
+            self.suspended = IDLE_SERVER
+        else:
+            self.suspended = IDLE_TUNNEL
+            await self.device.asyncSetDesired(False)
+        self._notify()
+
+    async def resume(self):
+        if self.suspended == IDLE_TUNNEL:
+            await self.device.asyncSetDesired(True)
+        # a suspended server comes back by itself when a client connects
@@ -0,0 +1,81 @@
+"""The states a tunnel goes through, from spawning the CLI to stopping it."""
+import logging
+
+from .const import PACKAGE_NAME
+
+LOGGER: logging.Logger = logging.getLogger(PACKAGE_NAME)
+
+STATE_STOPPED = "stopped"
+STATE_STARTING = "starting"
+STATE_AWAITING_AUTH = "awaiting_auth"
+STATE_RUNNING = "running"
+STATE_STOPPING = "stopping"
+STATE_FAILED = "failed"
+
+# a process is alive (or about to be) in these, the switch shows them as on
+ACTIVE_STATES = (STATE_STARTING, STATE_AWAITING_AUTH, STATE_RUNNING)
+
+TRANSITIONS = {
+    STATE_STOPPED: (STATE_STARTING,),
+    STATE_STARTING: (
+        STATE_AWAITING_AUTH,
+        STATE_RUNNING,
+        STATE_STOPPING,
+        STATE_FAILED,
+    ),
+    # the device code is printed again when the login expires
+    STATE_AWAITING_AUTH: (STATE_RUNNING, STATE_STOPPING, STATE_FAILED),
+    STATE_RUNNING: (STATE_AWAITING_AUTH, STATE_STOPPING, STATE_FAILED),
+    STATE_STOPPING: (STATE_STOPPED,),
+    # a dead process still has to be reaped before it can start again
+    STATE_FAILED: (STATE_STARTING, STATE_STOPPING),
+}
+
+
+def route(start, goal):
+    """The states to advance through, in order, to get from start to goal. Empty
+    if start is goal, None if there is no way."""
+    paths = {start: []}
+    queue = [start]
+    for state in queue:
+        if state == goal:
+            return paths[state]
+        for following in TRANSITIONS[state]:
+            if following not in paths:
+                paths[following] = paths[state] + [following]
+                queue.append(following)
+    return None
+
+
+class TunnelLifecycle:
+    """The current state of one tunnel, telling listeners about every change."""
+
+    def __init__(self, state=STATE_STOPPED):
+        self.log = LOGGER
+        self.state = state
+        self._listeners = []
+
+    @property
+    def active(self):
+        return self.state in ACTIVE_STATES
+
+    def advance(self, state):
+        """Move to state. Returns False, and stays put, if the current state does
+        not lead there."""
+        if state == self.state:
+            return True
+        if state not in TRANSITIONS[self.state]:
+            self.log.debug("Ignoring tunnel transition %s -> %s", self.state, state)
+            return False
+        previous = self.state
+        self.state = state
+        self.log.debug("Tunnel %s -> %s", previous, state)
+        for listener in tuple(self._listeners):
+            listener(previous, state)
+        return True
+
+    def addListener(self, listener):
+        """Call listener(previous, state) after every transition. Returns a remove
+        callable."""
+        self._listeners.append(listener)
+        return lambda: self._listeners.remove(listener)
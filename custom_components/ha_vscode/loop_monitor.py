@@ -0,0 +1,104 @@
+"""Measure how long calls into the device API hold the event loop."""
+import asyncio
+import functools
+import logging
+import time
+
+from .const import PACKAGE_NAME
+
+LOGGER: logging.Logger = logging.getLogger(PACKAGE_NAME)
+
+
+class _Timed:
+    """Await a coroutine, timing every step it runs on the loop.
+
+    A step is what runs between two suspensions, i.e. the time nothing else on the
+    loop could run.
+    """
+
+    def __init__(self, coro, name, monitor):
+        self._coro = coro
+        self._name = name
+        self._monitor = monitor
+
+    def __await__(self):
+        coro = self._coro
+        value = None
+        error = None
+        while True:
+            start = time.perf_counter()
+            try:
+                if error is not None:
+                    future = coro.throw(error)
+                else:
+                    future = coro.send(value)
+            except StopIteration as stop:
+                self._monitor.record(self._name, time.perf_counter() - start)
+                return stop.value
+            except BaseException:
+                self._monitor.record(self._name, time.perf_counter() - start)
+                raise
+            self._monitor.record(self._name, time.perf_counter() - start, final=False)
+            try:
+                value = yield future
+                error = None
+            except BaseException as err:
+                value = None
+                error = err
+
+
+class LoopStallMonitor:
+    """Per method statistics of the time spent on the loop, with a warning for
+    every step that took longer than threshold seconds."""
+
+    def __init__(self, threshold):
+        self.log = LOGGER
+        self.threshold = threshold
+        self.stats = {}
+
+    def record(self, name, step, final=True):
+        stats = self.stats.setdefault(
+            name, {"calls": 0, "held": 0.0, "max_step": 0.0, "stalls": 0}
+        )
+        stats["held"] += step
+        stats["max_step"] = max(stats["max_step"], step)
+        if final:
+            stats["calls"] += 1
+        if step > self.threshold:
+            stats["stalls"] += 1
+            self.log.warning(
+                "%s held the event loop for %.3fs (threshold %.3fs)",
+                name,
+                step,
+                self.threshold,
+            )
+
+    def wrap(self, name, func):
+        if asyncio.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def timed(*args, **kwargs):
+                return await _Timed(func(*args, **kwargs), name, self)
+
+            return timed
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                # called from a worker thread, the loop is not held
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(name, time.perf_counter() - start)
+
+        return timed
+
+    def instrument(self, obj, methods):
+        """Replace methods of obj with timed versions."""
+        prefix = type(obj).__name__
+        for method in methods:
+            setattr(obj, method, self.wrap(f"{prefix}.{method}", getattr(obj, method)))
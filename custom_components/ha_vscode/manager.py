@@ -0,0 +1,302 @@
+"""One tunnel per config entry, shared by the flows and the entities.
+
+Every entry has a tunnel of its own, with its own name and CLI data directory
+(login and tunnel state). They all run the one cached CLI binary.
+"""
+import asyncio
+import logging
+
+from homeassistant.const import EVENT_HOMEASSISTANT_STOP
+from homeassistant.helpers import aiohttp_client
+from homeassistant.helpers.storage import Store
+
+from .artifact_sources import parseSources
+from .cli_cache import CLICache
+from .const import CONF_CLI_DATA_DIR
+from .const import CONF_HELPER
+from .const import CONF_IDLE_MODE
+from .const import CONF_IDLE_TIMEOUT
+from .const import CONF_SOURCES
+from .const import CONF_UPDATE_INTERVAL
+from .const import CONF_UPDATE_JITTER
+from .const import CONF_TUNNEL_NAME
+from .const import DEFAULT_IDLE_MODE
+from .const import DEFAULT_IDLE_TIMEOUT
+from .const import DEFAULT_SOURCES
+from .const import DOMAIN
+from .const import PACKAGE_NAME
+from .const import TUNING_DEFAULTS
+from .exceptions import HAVSCodeHelperException
+from .helper import HelperDeviceAPI
+from .resource_profile import ResourceProfile
+from .timing import PhaseTimings
+from .timing import TIMEOUT_FLOOR
+from .vscode_device import cliArchitecture
+from .vscode_device import VSCodeDeviceAPI
+
+LOGGER: logging.Logger = logging.getLogger(PACKAGE_NAME)
+
+# the timings of every entry, so waits keep adapting across restarts
+STORAGE_VERSION = 1
+STORAGE_KEY = f"{DOMAIN}.timings"
+# the TunnelRecord of every entry, for warm starts
+RECORDS_STORAGE_KEY = f"{DOMAIN}.tunnels"
+SAVE_DELAY = 30
+
+
+def async_get_manager(hass):
+    """The TunnelManager of this Home Assistant instance."""
+    manager = hass.data.get(DOMAIN)
+    if manager is None:
+        manager = hass.data[DOMAIN] = TunnelManager(hass)
+    return manager
+
+
+class TunnelManager:
+    """Hands out one reference counted VSCodeDeviceAPI per key.
+
+    The key is the config entry id, or the flow id while a config flow sets up a
+    tunnel that has no entry yet; the entry takes that device over. Whoever acquires a device has to release it; the
+    tunnel is stopped when the last reference goes away.
+    """
+
+    def __init__(self, hass):
+        self.hass = hass
+        self.log = LOGGER
+        self._devices = {}
+        self._refs = {}
+        # removes the record listener of every device
+        self._unlisten = {}
+        # keys whose device was handed to another key, see rekey
+        self._moved = {}
+        # one CLICache per directory, so tunnels do not download over each other
+        self._caches = {}
+        # outlive the devices, so diagnostics keep their history
+        self._timings = {}
+        self._store = Store(hass, STORAGE_VERSION, STORAGE_KEY)
+        # what was stored, None until loaded
+        self._stored = None
+        # exported TunnelRecords, they outlive the devices too
+        self._records = {}
+        self._recordStore = Store(hass, STORAGE_VERSION, RECORDS_STORAGE_KEY)
+        hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, self.stopAll)
+
+    async def load(self):
+        """Read the timings and records of earlier runs. Safe to call more than
+        once."""
+        if self._stored is not None:
+            return
+        stored, records = await asyncio.gather(
+            self._store.async_load(), self._recordStore.async_load()
+        )
+        self._stored = stored or {}
+        for key, timings in self._timings.items():
+            timings.restore(self._stored.get(key, {}))
+        # anything recorded since we started is newer
+        self._records = {**(records or {}), **self._records}
+        for key, device in self._devices.items():
+            device.record.restore(self._records.get(key, {}))
+
+    def acquire(self, key, path, tunnelName=None, cliDataDir=None):
+        """The device of key, the CLI cached in path. tunnelName and cliDataDir
+        default to those of the config entry; entries from before there could be
+        more than one have neither, and use the CLI's default data directory."""
+        device = self._devices.get(key)
+        if device is None:
+            options = self._options(key)
+            tunnelName = tunnelName or options.get(CONF_TUNNEL_NAME)
+            kwargs = {
+                "session": aiohttp_client.async_get_clientsession(self.hass),
+                "timings": self.timings(key),
+                "cache": self.cache(path),
+                "cliDataDir": cliDataDir or options.get(CONF_CLI_DATA_DIR),
+            }
+            if options.get(CONF_HELPER):
+                device = HelperDeviceAPI(path, self.hass.config.config_dir, **kwargs)
+            else:
+                device = VSCodeDeviceAPI(path, **kwargs)
+            device.record.restore(self._records.get(key, {}))
+            if tunnelName:
+                # what the user picked wins over what the cli made up
+                device.record.update(tunnelName=tunnelName)
+            self._listen(key, device)
+            self._devices[key] = device
+            self._refs[key] = 0
+            # a tunnel in a helper may still be running from before a restart
+            self.hass.async_create_task(self._attach(device))
+        self._refs[key] += 1
+        self.log.debug("Acquired tunnel %s (%d references)", key, self._refs[key])
+        return device
+
+    def _listen(self, key, device):
+        self._unlisten[key] = device.record.addListener(
+            lambda: self._recordChanged(key, device)
+        )
+
+    def rekey(self, old, new):
+        """Hand the device of old to new, with its references and its running
+        tunnel, e.g. the one a config flow set up to the entry it created. Those
+        who hold it under old release it under old, as before."""
+        if old not in self._devices or new in self._devices:
+            return False
+        device = self._devices.pop(old)
+        self._devices[new] = device
+        self._refs[new] = self._refs.pop(old)
+        self._unlisten.pop(old)()
+        self._listen(new, device)
+        self._recordChanged(new, device)
+        self._moved[old] = new
+        self.log.debug("Tunnel %s is now %s", old, new)
+        return True
+
+    def cache(self, path):
+        """The CLICache of path, shared by every tunnel that uses it."""
+        cache = self._caches.get(path)
+        if cache is None:
+            cache = self._caches[path] = CLICache(path, cliArchitecture())
+        return cache
+
+    def _options(self, key):
+        entry = self.hass.config_entries.async_get_entry(key)
+        return {**entry.data, **entry.options} if entry is not None else {}
+
+    async def _attach(self, device):
+        try:
+            await device.asyncAttach()
+        except HAVSCodeHelperException as err:
+            self.log.warning("%s", err)
+
+    def usesHelper(self, key):
+        """Whether the device of key, if somebody holds it, runs in a helper."""
+        return isinstance(self._devices.get(key), HelperDeviceAPI)
+
+    async def release(self, key):
+        key = self._moved.pop(key, key)
+        if key not in self._devices:
+            return
+        self._refs[key] -= 1
+        self.log.debug("Released tunnel %s (%d references)", key, self._refs[key])
+        if self._refs[key] > 0:
+            return
+        device = self._devices.pop(key)
+        del self._refs[key]
+        # what the stop changes is still recorded
+        self._unlisten.pop(key)
+        await device.asyncStopTunnel()
+        await device.asyncClose()
+
+    async def stopAll(self, _event=None):
+        """Stop every tunnel, e.g. because Home Assistant shuts down. Takes at most
+        the stop grace period plus the kill timeout of the devices. Tunnels in a
+        helper keep running."""
+        devices = list(self._devices.values())
+        if devices:
+            self.log.debug("Stopping %d tunnels", len(devices))
+        # a local device's detach also tells a start that is under way to stop
+        await asyncio.gather(
+            *(device.asyncDetach() for device in devices),
+            return_exceptions=True,
+        )
+
+    def configure(self, key, options):
+        """Apply the options of a config entry to its device, if somebody holds it."""
+        device = self._devices.get(key)
+        if device is None:
+            return
+        device.minTimeout = float(options.get("timeout") or TIMEOUT_FLOOR)
+        device.idle.configure(
+            options.get(CONF_IDLE_MODE, DEFAULT_IDLE_MODE),
+            float(options.get(CONF_IDLE_TIMEOUT, DEFAULT_IDLE_TIMEOUT)) * 60,
+        )
+        # takes effect the next time the tunnel starts
+        device.resourceProfile = ResourceProfile.fromOptions(options)
+        try:
+            device.sources = parseSources(options.get(CONF_SOURCES, DEFAULT_SOURCES))
+        except ValueError as err:
+            # the forms validate, so this is an entry edited by hand
+            self.log.warning("Ignoring the CLI sources of %s: %s", key, err)
+            device.sources = None
+        # hours and minutes in the options
+        tuning = {**TUNING_DEFAULTS, **options}
+        device.updater.configure(
+            float(tuning[CONF_UPDATE_INTERVAL]) * 3600,
+            float(tuning[CONF_UPDATE_JITTER]) * 60,
+        )
+
+    async def resume(self, key=None):
+        """Bring back the tunnel of key, or every tunnel, after an idle suspend."""
+        devices = list(self._devices.values()) if key is None else [self.get(key)]
+        await asyncio.gather(
+            *(device.idle.resume() for device in devices if device is not None)
+        )
+
+    def output(self, key=None, limit=None):
+        """The last lines of output of the tunnel of key, or of every tunnel, as
+        (time, line). Only tunnels somebody holds have any."""
+        keys = list(self._devices) if key is None else [key]
+        return {
+            key: self._devices[key].output.snapshot(limit)
+            for key in keys
+            if key in self._devices
+        }
+
+    def get(self, key):
+        """The device for key if somebody holds it, without taking a reference."""
+        return self._devices.get(key)
+
+    def timings(self, key):
+        timings = self._timings.get(key)
+        if timings is None:
+            timings = self._timings[key] = PhaseTimings()
+            if self._stored:
+                timings.restore(self._stored.get(key, {}))
+            # the store coalesces a burst of samples into one write
+            timings.addListener(lambda _phase: self._scheduleSave())
+        return timings
+
+    def adoptTimings(self, key, timings):
+        """Continue the statistics gathered under another key, e.g. by the config
+        flow before the entry existed."""
+        self._timings[key] = timings
+        self._scheduleSave()
+
+    def record(self, key):
+        """The last known TunnelRecord fields of key, also while nobody holds its
+        device."""
+        device = self._devices.get(key)
+        if device is not None:
+            return device.record.export()
+        return dict(self._records.get(key, {}))
+
+    def adoptRecord(self, key, data):
+        """Start the record of key from what was learned under another key."""
+        self._records[key] = dict(data)
+        device = self._devices.get(key)
+        if device is not None:
+            device.record.restore(data)
+        self._recordStore.async_delay_save(self._recordData, SAVE_DELAY)
+
+    def _recordChanged(self, key, device):
+        self._records[key] = device.record.export()
+        # a burst of tunnel output ends up as one write
+        self._recordStore.async_delay_save(self._recordData, SAVE_DELAY)
+
+    def _recordData(self):
+        return dict(self._records)
+
+    def forget(self, key):
+        self._timings.pop(key, None)
+        if self._stored:
+            self._stored.pop(key, None)
+        self._scheduleSave()
+        if self._records.pop(key, None) is not None:
+            self._recordStore.async_delay_save(self._recordData, SAVE_DELAY)
+
+    def _scheduleSave(self):
+        self._store.async_delay_save(self._data, SAVE_DELAY)
+
+    def _data(self):
+        # entries that are not set up (yet) keep what they had
+        data = dict(self._stored or {})
+        data.update({key: timings.export() for key, timings in self._timings.items()})
+        return data
@@ -0,0 +1,166 @@
+"""Find, measure and signal the processes of a tunnel, from /proc.
+
+`code tunnel` starts the VSCode server and its extension hosts as children. Some
+of them outlive the CLI, and once they are orphaned they are no longer children
+of the CLI, so the tree is read before the CLI is stopped. A process is
+identified by its pid and start time, so a reused pid is never signalled.
+
+These functions read /proc and belong in the executor. Where there is no /proc
+they find nothing.
+"""
+import logging
+import os
+from typing import NamedTuple
+from typing import Optional
+
+from .const import PACKAGE_NAME
+
+LOGGER: logging.Logger = logging.getLogger(PACKAGE_NAME)
+
+PROC = "/proc"
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+class ProcessStat(NamedTuple):
+    """The fields of /proc/<pid>/stat we care about."""
+
+    pid: int
+    state: str
+    ppid: int
+    pgrp: int
+    starttime: int
+    # clock ticks
+    utime: int
+    stime: int
+    threads: int
+
+
+class ProcessUsage(NamedTuple):
+    """What a process uses besides CPU. None where /proc would not tell us."""
+
+    stat: ProcessStat
+    # bytes
+    rss: int
+    fds: Optional[int]
+    readBytes: Optional[int]
+    writeBytes: Optional[int]
+
+
+def readStat(pid):
+    """The stat of pid, None if it is gone."""
+    try:
+        with open(
+            os.path.join(PROC, str(pid), "stat"), encoding="ascii", errors="replace"
+        ) as stat:
+            line = stat.read()
+    except OSError:
+        return None
+    # the command name is in parentheses and may contain anything, even ") "
+    fields = line[line.rfind(")") + 2 :].split()
+    try:
+        return ProcessStat(
+            pid,
+            fields[0],
+            int(fields[1]),
+            int(fields[2]),
+            int(fields[19]),
+            int(fields[11]),
+            int(fields[12]),
+            int(fields[17]),
+        )
+    except (IndexError, ValueError):
+        return None
+
+
+def snapshot():
+    """The stat of every process we can see."""
+    try:
+        names = os.listdir(PROC)
+    except OSError:
+        return {}
+    table = {}
+    for name in names:
+        if name.isdigit():
+            stat = readStat(int(name))
+            if stat is not None:
+                table[stat.pid] = stat
+    return table
+
+
+def descendants(pid, table=None):
+    """Everything below pid, children before grandchildren."""
+    if table is None:
+        table = snapshot()
+    children = {}
+    for stat in table.values():
+        children.setdefault(stat.ppid, []).append(stat)
+    found = []
+    parents = [pid]
+    while parents:
+        parent = parents.pop(0)
+        for child in children.get(parent, ()):
+            found.append(child)
+            parents.append(child.pid)
+    return found
+
+
+def alive(process):
+    """Whether process still runs. Zombies are dead, whoever their parent is will
+    reap them."""
+    stat = readStat(process.pid)
+    return (
+        stat is not None
+        and stat.starttime == process.starttime
+        and stat.state not in ("Z", "X")
+    )
+
+
+def survivors(processes):
+    return [process for process in processes if alive(process)]
+
+
+def signalAll(processes, sig):
+    for process in survivors(processes):
+        try:
+            os.kill(process.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+
+def readUsage(stat):
+    """Memory, file descriptors and disk IO of the process stat describes."""
+    base = os.path.join(PROC, str(stat.pid))
+    try:
+        with open(os.path.join(base, "statm"), encoding="ascii") as statm:
+            rss = int(statm.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return None
+    try:
+        fds = len(os.listdir(os.path.join(base, "fd")))
+    except OSError:
+        fds = None
+    readBytes = writeBytes = None
+    try:
+        with open(os.path.join(base, "io"), encoding="ascii") as io:
+            for line in io:
+                key, _, value = line.partition(":")
+                if key == "read_bytes":
+                    readBytes = int(value)
+                elif key == "write_bytes":
+                    writeBytes = int(value)
+    except (OSError, ValueError):
+        pass
+    return ProcessUsage(stat, rss, fds, readBytes, writeBytes)
+
+
+def usage(pid):
+    """The usage of pid and all of its descendants, in one pass over /proc."""
+    table = snapshot()
+    if pid not in table:
+        return []
+    rows = []
+    for stat in [table[pid]] + descendants(pid, table):
+        row = readUsage(stat)
+        if row is not None:
+            rows.append(row)
+    return rows
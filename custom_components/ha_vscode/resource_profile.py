@@ -0,0 +1,195 @@
+"""Keep the tunnel from competing with Home Assistant for CPU, memory and disk.
+
+Priority and limits are set in the child between fork and exec, so the CLI and
+everything it starts inherit them. Moving the CLI into a cgroup v2 sub-group
+needs its pid and happens right after the spawn, before it starts the server.
+
+A cgroup only gets cpu.max and memory.max if its parent has the controllers
+enabled for its children, which the kernel refuses while the parent itself has
+processes (the "no internal processes" rule). Inside a container that usually
+means the cgroup part fails, which is logged and otherwise ignored.
+"""
+import ctypes
+import logging
+import os
+import resource
+from typing import NamedTuple
+from typing import Optional
+
+from .const import CONF_CGROUP
+from .const import CONF_CPU_MAX
+from .const import CONF_IO_CLASS
+from .const import CONF_MAX_FILES
+from .const import CONF_MEMORY_LIMIT
+from .const import CONF_MEMORY_MAX
+from .const import CONF_NICE
+from .const import PACKAGE_NAME
+
+LOGGER: logging.Logger = logging.getLogger(PACKAGE_NAME)
+
+IO_CLASS_DEFAULT = "default"
+# lowest priority of the best effort class
+IO_CLASS_LOW = "low"
+# only gets the disk when nobody else wants it
+IO_CLASS_IDLE = "idle"
+IO_CLASSES = (IO_CLASS_DEFAULT, IO_CLASS_LOW, IO_CLASS_IDLE)
+
+_IOPRIO_CLASS_SHIFT = 13
+_IOPRIO = {
+    IO_CLASS_LOW: 2 << _IOPRIO_CLASS_SHIFT | 7,
+    IO_CLASS_IDLE: 3 << _IOPRIO_CLASS_SHIFT,
+}
+_IOPRIO_WHO_PROCESS = 1
+# there is no wrapper for ioprio_set in the standard library, nor in libc
+_SYS_IOPRIO_SET = {"x86_64": 251, "aarch64": 30, "armv7l": 314, "i686": 289}
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+CGROUP_NAME = "ha_vscode"
+# cpu.max is a quota per period, both in microseconds
+CPU_PERIOD = 100000
+
+MIB = 1024 * 1024
+
+
+def _ioprioSetter():
+    number = _SYS_IOPRIO_SET.get(os.uname().machine)
+    if number is None:
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+    except OSError:
+        return None
+    return lambda value: libc.syscall(number, _IOPRIO_WHO_PROCESS, 0, value)
+
+
+def _ownCgroup():
+    # the unified hierarchy is the line with the empty controller list
+    with open("/proc/self/cgroup", encoding="ascii") as cgroups:
+        for line in cgroups:
+            hierarchy, _, path = line.strip().split(":", 2)
+            if hierarchy == "0":
+                return path
+    return None
+
+
+def _write(path, value):
+    with open(path, "w", encoding="ascii") as control:
+        control.write(value)
+
+
+class ResourceProfile(NamedTuple):
+    """Priority and limits of the tunnel. None and 0 mean leave it alone."""
+
+    nice: int = 0
+    ioClass: str = IO_CLASS_DEFAULT
+    # bytes of address space (RLIMIT_AS) per process
+    memoryLimit: Optional[int] = None
+    # RLIMIT_NOFILE
+    maxFiles: Optional[int] = None
+    cgroup: bool = False
+    # percent of one CPU for the whole tunnel, only in a cgroup
+    cpuMax: Optional[int] = None
+    # bytes for the whole tunnel, only in a cgroup
+    memoryMax: Optional[int] = None
+
+    @classmethod
+    def fromOptions(cls, options):
+        def mib(key):
+            value = int(options.get(key) or 0)
+            return value * MIB if value > 0 else None
+
+        return cls(
+            nice=int(options.get(CONF_NICE) or 0),
+            ioClass=options.get(CONF_IO_CLASS) or IO_CLASS_DEFAULT,
+            memoryLimit=mib(CONF_MEMORY_LIMIT),
+            maxFiles=int(options.get(CONF_MAX_FILES) or 0) or None,
+            cgroup=bool(options.get(CONF_CGROUP)),
+            cpuMax=int(options.get(CONF_CPU_MAX) or 0) or None,
+            memoryMax=mib(CONF_MEMORY_MAX),
+        )
+
+    def preexec(self):
+        """A preexec_fn for the spawn, None if there is nothing to do in the child.
+
+        Everything that could fail is worked out here, in the parent: an exception
+        in the child would only surface as a failed spawn.
+        """
+        limits = []
+        for which, value in (
+            (resource.RLIMIT_AS, self.memoryLimit),
+            (resource.RLIMIT_NOFILE, self.maxFiles),
+        ):
+            if value:
+                # can't go above the hard limit without privileges
+                _, hard = resource.getrlimit(which)
+                if hard != resource.RLIM_INFINITY:
+                    value = min(value, hard)
+                limits.append((which, value))
+        ioprio = _IOPRIO.get(self.ioClass)
+        setIoprio = _ioprioSetter() if ioprio is not None else None
+        if ioprio is not None and setIoprio is None:
+            LOGGER.warning("Can't set the I/O priority on %s", os.uname().machine)
+        nice = self.nice
+        if not (nice or limits or setIoprio):
+            return None
+
+        def apply():
+            # runs in the forked child, so only plain system calls
+            if nice:
+                os.nice(nice)
+            for which, value in limits:
+                resource.setrlimit(which, (value, value))
+            if setIoprio is not None:
+                setIoprio(ioprio)
+
+        return apply
+
+    def placeInCgroup(self, pid, name=CGROUP_NAME):
+        """Move pid into a sub-group of our own cgroup and set its limits. Returns
+        the path of the group, None if that did not work. Blocking."""
+        if not self.cgroup:
+            return None
+        try:
+            own = _ownCgroup()
+            if own is None:
+                LOGGER.warning("No cgroup v2 hierarchy, can't limit the tunnel")
+                return None
+            parent = os.path.join(CGROUP_ROOT, own.lstrip("/"))
+            if not os.path.exists(os.path.join(parent, "cgroup.controllers")):
+                # e.g. a v1 or hybrid hierarchy, where this is not a cgroup2 mount
+                LOGGER.warning(
+                    "%s is not a cgroup v2 group, can't limit the tunnel", parent
+                )
+                return None
+            group = os.path.join(parent, name)
+            os.makedirs(group, exist_ok=True)
+            controllers = []
+            if self.cpuMax:
+                controllers.append("+cpu")
+            if self.memoryMax:
+                controllers.append("+memory")
+            if controllers:
+                try:
+                    _write(
+                        os.path.join(parent, "cgroup.subtree_control"),
+                        " ".join(controllers),
+                    )
+                except OSError as err:
+                    LOGGER.warning(
+                        "Can't enable %s for %s, the tunnel runs without limits: %s",
+                        " ".join(controllers),
+                        group,
+                        err,
+                    )
+                else:
+                    if self.cpuMax:
+                        quota = CPU_PERIOD * self.cpuMax // 100
+                        _write(os.path.join(group, "cpu.max"), f"{quota} {CPU_PERIOD}")
+                    if self.memoryMax:
+                        _write(os.path.join(group, "memory.max"), str(self.memoryMax))
+            _write(os.path.join(group, "cgroup.procs"), str(pid))
+        except OSError as err:
+            LOGGER.warning("Can't move the tunnel into a cgroup: %s", err)
+            return None
+        LOGGER.debug("Tunnel %d runs in cgroup %s", pid, group)
+        return group
@@ -0,0 +1,120 @@
+"""Sample what the tunnel and its server children use, while the tunnel is up.
+
+A sample is one pass over /proc in the executor, no processes are started. CPU
+time and disk IO are accounted per process between two samples, so processes
+that come and go in between do not make the totals jump backwards.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import NamedTuple
+from typing import Optional
+
+from .const import PACKAGE_NAME
+from .lifecycle import ACTIVE_STATES
+from .process_tree import usage
+
+LOGGER: logging.Logger = logging.getLogger(PACKAGE_NAME)
+
+# seconds
+SAMPLE_INTERVAL = 30.0
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+class ResourceSample(NamedTuple):
+    """The whole tunnel tree at one point in time."""
+
+    processes: int
+    # of one core, None for the first sample of a tunnel
+    cpuPercent: Optional[float]
+    # bytes
+    rss: int
+    threads: int
+    fds: int
+    # since the tunnel started
+    readBytes: int
+    writeBytes: int
+
+
+class ResourceSampler:
+    """Samples the process tree of device every interval seconds while the
+    tunnel is active."""
+
+    def __init__(self, device, interval=SAMPLE_INTERVAL):
+        self.log = LOGGER
+        self.device = device
+        self.interval = interval
+        self.sample = None
+        self._task = None
+        self._listeners = []
+        self._reset()
+        device.lifecycle.addListener(self._onTransition)
+
+    def _reset(self):
+        self._previous = {}
+        self._sampledAt = None
+        self._readBytes = 0
+        self._writeBytes = 0
+
+    def addListener(self, listener):
+        """Call listener() after every sample. Returns a remove callable."""
+        self._listeners.append(listener)
+        return lambda: self._listeners.remove(listener)
+
+    def _onTransition(self, previous, state):
+        if state in ACTIVE_STATES:
+            if self._task is None:
+                self._reset()
+                self._task = asyncio.get_running_loop().create_task(self._run())
+        elif self._task is not None:
+            self._task.cancel()
+            self._task = None
+            self.sample = None
+            self._notify()
+
+    def _notify(self):
+        for listener in tuple(self._listeners):
+            listener()
+
+    async def _run(self):
+        while True:
+            await self.sampleNow()
+            await asyncio.sleep(self.interval)
+
+    async def sampleNow(self):
+        pid = self.device.pid
+        if pid is None:
+            return self.sample
+        rows = await asyncio.get_running_loop().run_in_executor(None, usage, pid)
+        now = time.monotonic()
+
+        ticks = 0
+        current = {}
+        for row in rows:
+            key = (row.stat.pid, row.stat.starttime)
+            cpu = row.stat.utime + row.stat.stime
+            current[key] = (cpu, row.readBytes or 0, row.writeBytes or 0)
+            # new processes count with everything they did so far
+            before = self._previous.get(key, (0, 0, 0))
+            ticks += max(0, cpu - before[0])
+            self._readBytes += max(0, current[key][1] - before[1])
+            self._writeBytes += max(0, current[key][2] - before[2])
+
+        cpuPercent = None
+        if self._sampledAt is not None and now > self._sampledAt:
+            cpuPercent = ticks / CLOCK_TICKS / (now - self._sampledAt) * 100
+        self._previous = current
+        self._sampledAt = now
+
+        self.sample = ResourceSample(
+            len(rows),
+            cpuPercent,
+            sum(row.rss for row in rows),
+            sum(row.stat.threads for row in rows),
+            sum(row.fds or 0 for row in rows),
+            self._readBytes,
+            self._writeBytes,
+        )
+        self._notify()
+        return self.sample
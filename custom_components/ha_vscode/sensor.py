@@ -0,0 +1,169 @@
+"""Latency and resource sensors for the tunnel."""
+from homeassistant.components.sensor import SensorDeviceClass
+from homeassistant.components.sensor import SensorEntity
+from homeassistant.components.sensor import SensorEntityDescription
+from homeassistant.components.sensor import SensorStateClass
+from homeassistant.const import EntityCategory
+from homeassistant.const import PERCENTAGE
+from homeassistant.const import UnitOfInformation
+from homeassistant.const import UnitOfTime
+from homeassistant.core import callback
+
+from .const import CONF_TUNNEL_NAME
+from .manager import async_get_manager
+from .timing import PHASES
+
+MIB = 1024 * 1024
+
+# the key is the field of ResourceSample, sizes are converted to MiB
+RESOURCE_SENSORS = (
+    SensorEntityDescription(
+        key="cpuPercent",
+        name="CPU",
+        native_unit_of_measurement=PERCENTAGE,
+        state_class=SensorStateClass.MEASUREMENT,
+        suggested_display_precision=1,
+    ),
+    SensorEntityDescription(
+        key="rss",
+        name="memory",
+        native_unit_of_measurement=UnitOfInformation.MEBIBYTES,
+        device_class=SensorDeviceClass.DATA_SIZE,
+        state_class=SensorStateClass.MEASUREMENT,
+        suggested_display_precision=1,
+    ),
+    SensorEntityDescription(
+        key="processes",
+        name="processes",
+        state_class=SensorStateClass.MEASUREMENT,
+        entity_registry_enabled_default=False,
+    ),
+    SensorEntityDescription(
+        key="threads",
+        name="threads",
+        state_class=SensorStateClass.MEASUREMENT,
+        entity_registry_enabled_default=False,
+    ),
+    SensorEntityDescription(
+        key="fds",
+        name="open files",
+        state_class=SensorStateClass.MEASUREMENT,
+        entity_registry_enabled_default=False,
+    ),
+    SensorEntityDescription(
+        key="readBytes",
+        name="disk read",
+        native_unit_of_measurement=UnitOfInformation.MEBIBYTES,
+        device_class=SensorDeviceClass.DATA_SIZE,
+        state_class=SensorStateClass.TOTAL_INCREASING,
+        suggested_display_precision=1,
+        entity_registry_enabled_default=False,
+    ),
+    SensorEntityDescription(
+        key="writeBytes",
+        name="disk write",
+        native_unit_of_measurement=UnitOfInformation.MEBIBYTES,
+        device_class=SensorDeviceClass.DATA_SIZE,
+        state_class=SensorStateClass.TOTAL_INCREASING,
+        suggested_display_precision=1,
+        entity_registry_enabled_default=False,
+    ),
+)
+_IN_MIB = ("rss", "readBytes", "writeBytes")
+
+
+async def async_setup_entry(hass, config, async_add_devices):
+    manager = async_get_manager(hass)
+    timings = manager.timings(config.entry_id)
+    # every tunnel has sensors of its own, entries from before there could be
+    # more than one have no name
+    tunnelName = {**config.data, **config.options}.get(CONF_TUNNEL_NAME)
+    prefix = "VSCode Tunnel " + tunnelName if tunnelName else "VSCode Tunnel"
+    entities = [
+        PhaseLatencySensor(config.entry_id, timings, phase, prefix) for phase in PHASES
+    ]
+    entities += [
+        ResourceSensor(
+            manager, config.entry_id, config.data["path"], description, prefix
+        )
+        for description in RESOURCE_SENSORS
+    ]
+    async_add_devices(entities)
+
+
+class PhaseLatencySensor(SensorEntity):
+    """p95 of the recent durations of one phase, p50 and max as attributes."""
+
+    _attr_device_class = SensorDeviceClass.DURATION
+    _attr_state_class = SensorStateClass.MEASUREMENT
+    _attr_native_unit_of_measurement = UnitOfTime.MILLISECONDS
+    _attr_entity_category = EntityCategory.DIAGNOSTIC
+    # optional, turn them on when comparing boards or cli versions
+    _attr_entity_registry_enabled_default = False
+    _attr_should_poll = False
+
+    def __init__(self, entry_id, timings, phase, prefix):
+        self.timings = timings
+        self.phase = phase
+        self._attr_unique_id = f"{entry_id}_{phase}_latency"
+        self._attr_name = prefix + " " + phase.replace("_", " ") + " latency"
+
+    async def async_added_to_hass(self):
+        self.async_on_remove(self.timings.addListener(self._phaseRecorded))
+
+    @callback
+    def _phaseRecorded(self, phase):
+        if phase == self.phase:
+            self.async_write_ha_state()
+
+    @property
+    def native_value(self):
+        p95 = self.timings.stats(self.phase)["p95"]
+        return None if p95 is None else round(p95 * 1000, 1)
+
+    @property
+    def extra_state_attributes(self):
+        stats = self.timings.stats(self.phase)
+        return {
+            "count": stats["count"],
+            "p50_ms": None if stats["p50"] is None else round(stats["p50"] * 1000, 1),
+            "max_ms": None if stats["max"] is None else round(stats["max"] * 1000, 1),
+        }
+
+
+class ResourceSensor(SensorEntity):
+    """One figure of the latest resource sample of the tunnel and its children,
+    unknown while the tunnel is off."""
+
+    _attr_entity_category = EntityCategory.DIAGNOSTIC
+    _attr_should_poll = False
+
+    def __init__(self, manager, entry_id, bin_dir, description, prefix):
+        self.manager = manager
+        self.entry_id = entry_id
+        self.entity_description = description
+        self.bin_dir = bin_dir
+        self.device = None
+        self._attr_unique_id = f"{entry_id}_{description.key}"
+        self._attr_name = prefix + " " + description.name
+
+    async def async_added_to_hass(self):
+        # the disabled ones are never added, so only hold the tunnel from here
+        self.device = self.manager.acquire(self.entry_id, self.bin_dir)
+        self.async_on_remove(
+            self.device.resources.addListener(self.async_write_ha_state)
+        )
+
+    async def async_will_remove_from_hass(self):
+        self.device = None
+        await self.manager.release(self.entry_id)
+
+    @property
+    def native_value(self):
+        sample = self.device.resources.sample if self.device else None
+        if sample is None:
+            return None
+        value = getattr(sample, self.entity_description.key)
+        if value is not None and self.entity_description.key in _IN_MIB:
+            return value / MIB
+        return value
@@ -0,0 +1,168 @@
+"""Restart a tunnel that exits on its own, e.g. after a network blip or a CLI
+self-update.
+
+Restarts back off exponentially with jitter. A tunnel that keeps crashing trips
+a circuit breaker: it is left alone for a cool down, then gets one trial
+restart. A tunnel that stays up for a while, or that somebody starts by hand,
+resets all of it.
+"""
+import asyncio
+import logging
+import random
+import time
+
+from .const import PACKAGE_NAME
+from .lifecycle import ACTIVE_STATES
+from .lifecycle import STATE_FAILED
+from .lifecycle import STATE_RUNNING
+from .lifecycle import STATE_STARTING
+from .lifecycle import STATE_STOPPED
+from .timing import PHASE_RECOVERY
+
+LOGGER: logging.Logger = logging.getLogger(PACKAGE_NAME)
+
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 300.0
+MAX_RESTARTS = 5
+# a tunnel that ran this long without crashing is healthy again
+STABLE_AFTER = 60.0
+COOLDOWN = 900.0
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
+
+def backoff(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP, rand=random.random):
+    """Delay before restart number attempt (from 0): half of the exponential
+    delay for sure, the other half random, so tunnels that crashed together do not
+    restart together."""
+    delay = min(cap, base * 2 ** attempt)
+    return delay / 2 + delay / 2 * rand()
+
+
+class TunnelSupervisor:
+    """Watches the lifecycle of device and restarts it while it is wanted."""
+
+    def __init__(
+        self,
+        device,
+        maxRestarts=MAX_RESTARTS,
+        stableAfter=STABLE_AFTER,
+        cooldown=COOLDOWN,
+        delay=backoff,
+    ):
+        self.log = LOGGER
+        self.device = device
+        self.maxRestarts = maxRestarts
+        self.stableAfter = stableAfter
+        self.cooldown = cooldown
+        self.delay = delay
+        self.restarts = 0
+        self.failures = 0
+        self.circuit = CIRCUIT_CLOSED
+        self.lastRecovery = None
+        self.crashedAt = None
+        self._task = None
+        self._restarting = False
+        self._stable = None
+        self._listeners = []
+        device.lifecycle.addListener(self._onTransition)
+
+    def stats(self):
+        return {
+            "restarts": self.restarts,
+            "consecutive_failures": self.failures,
+            "circuit": self.circuit,
+            "last_recovery_s": None
+            if self.lastRecovery is None
+            else round(self.lastRecovery, 1),
+        }
+
+    def addListener(self, listener):
+        """Call listener() when stats change outside of a lifecycle transition.
+        Returns a remove callable."""
+        self._listeners.append(listener)
+        return lambda: self._listeners.remove(listener)
+
+    def _notify(self):
+        for listener in tuple(self._listeners):
+            listener()
+
+    def _onTransition(self, previous, state):
+        if self._stable is not None:
+            self._stable.cancel()
+            self._stable = None
+
+        if state == STATE_FAILED and previous in ACTIVE_STATES:
+            self._onCrash()
+        elif state == STATE_STARTING and not self._restarting:
+            # started by hand, that overrides whatever we had planned
+            self._cancel()
+            self.failures = 0
+            self.circuit = CIRCUIT_CLOSED
+        elif state == STATE_STOPPED and not self.device.desired:
+            # stopped on purpose, nothing to recover from
+            self._cancel()
+            self.crashedAt = None
+        elif state == STATE_RUNNING:
+            if self.crashedAt is not None:
+                self.lastRecovery = time.monotonic() - self.crashedAt
+                self.crashedAt = None
+                self.device.timings.record(PHASE_RECOVERY, self.lastRecovery)
+                self.log.info("Tunnel recovered in %.1fs", self.lastRecovery)
+            self._stable = asyncio.get_running_loop().call_later(
+                self.stableAfter, self._onStable
+            )
+
+    def _onStable(self):
+        self._stable = None
+        if self.failures or self.circuit != CIRCUIT_CLOSED:
+            self.failures = 0
+            self.circuit = CIRCUIT_CLOSED
+            self._notify()
+
+    def _onCrash(self):
+        if not self.device.desired:
+            return
+        if self.crashedAt is None:
+            self.crashedAt = time.monotonic()
+        self.failures += 1
+        if self.circuit == CIRCUIT_HALF_OPEN or self.failures > self.maxRestarts:
+            self.circuit = CIRCUIT_OPEN
+            self.log.error(
+                "Tunnel crashed %d times in a row, trying again in %.0fs",
+                self.failures,
+                self.cooldown,
+            )
+            self._schedule(self.cooldown)
+        else:
+            delay = self.delay(self.failures - 1)
+            self.log.warning("Tunnel crashed, restarting in %.1fs", delay)
+            self._schedule(delay)
+
+    def _schedule(self, delay):
+        self._cancel()
+        self._task = asyncio.get_running_loop().create_task(self._restart(delay))
+
+    def _cancel(self):
+        if self._task is not None and not self._task.done():
+            if self._task is not asyncio.current_task():
+                self._task.cancel()
+        self._task = None
+
+    async def _restart(self, delay):
+        await asyncio.sleep(delay)
+        if not self.device.desired or self.device.lifecycle.state != STATE_FAILED:
+            return
+        if self.circuit == CIRCUIT_OPEN:
+            self.circuit = CIRCUIT_HALF_OPEN
+        self.restarts += 1
+        self._restarting = True
+        try:
+            await self.device.asyncStartTunnel()
+        except Exception as err:  # pylint: disable=broad-except
+            # the lifecycle went to failed, which scheduled the next attempt
+            self.log.warning("Restarting the tunnel failed: %s", err)
+        finally:
+            self._restarting = False
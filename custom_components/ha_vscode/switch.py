@@ -3,26 +3,37 @@ import re
 from homeassistant.components.switch import SwitchDeviceClass
 from homeassistant.components.switch import SwitchEntity
 from homeassistant.const import UnitOfInformation
+from homeassistant.core import callback
 from homeassistant.helpers.typing import ConfigType
 from homeassistant.helpers.typing import DiscoveryInfoType
 
-from .vscode_device import VSCodeDeviceAPI
+from .manager import async_get_manager
 
 
 async def async_setup_entry(hass, config, async_add_devices):
     # Run setup via Storage
     dev_url = config.data["dev_url"]
     path = config.data["path"]
-    async_add_devices([VSCodeEntity(path, dev_url)])
+    manager = async_get_manager(hass)
+    entity = VSCodeEntity(manager, config.entry_id, path, dev_url)
+    manager.configure(config.entry_id, {**config.data, **config.options})
+    async_add_devices([entity])
 
 
 class VSCodeEntity(SwitchEntity):
     _attr_name = "Development URL"
     _attr_native_unit_of_measurement = UnitOfInformation
     _attr_device_class = SwitchDeviceClass.SWITCH
+    # the tunnel tells us about every state change
+    _attr_should_poll = False
 
-    def __init__(self, bin_dir, dev_url):
-        self.device = VSCodeDeviceAPI(bin_dir)
+    def __init__(self, manager, entry_id, bin_dir, dev_url):
+        self.manager = manager
+        self.entry_id = entry_id
+        # the tunnel of this entry, the flows attach to the same one
+        self.device = manager.acquire(entry_id, bin_dir)
+        # the address the tunnel had last time, if it changed since the setup
+        dev_url = self.device.record.devURL or dev_url
         if dev_url.startswith("https://vscode.dev/tunnel/"):
             # try and output just the tunnel name
             slen = len("https://vscode.dev/tunnel/")
@@ -32,15 +43,39 @@ class VSCodeEntity(SwitchEntity):
                 dev_url = match.group()[:-1]
         self._attr_name = "VSCode.dev Tunnel: " + dev_url
 
-    def turn_on(self, **kwargs) -> None:
+    async def async_added_to_hass(self):
+        self.async_on_remove(self.device.lifecycle.addListener(self._onTransition))
+        self.async_on_remove(
+            self.device.supervisor.addListener(self.async_write_ha_state)
+        )
+        self.async_on_remove(self.device.idle.addListener(self.async_write_ha_state))
+        self.async_on_remove(self.device.updater.addListener(self.async_write_ha_state))
+
+    async def async_will_remove_from_hass(self):
+        await self.manager.release(self.entry_id)
+
+    @callback
+    def _onTransition(self, previous, state):
+        self.async_write_ha_state()
+
+    async def async_turn_on(self, **kwargs) -> None:
         """Turn the entity on."""
-        self.device.startTunnel()
+        await self.device.asyncSetDesired(True)
 
-    def turn_off(self, **kwargs):
+    async def async_turn_off(self, **kwargs):
         """Turn the entity off."""
-        self.device.stopTunnel()
+        await self.device.asyncSetDesired(False)
 
     @property
     def is_on(self):
         """If the switch is currently on or off."""
-        return self.device.isRunning()
+        return self.device.lifecycle.active
+
+    @property
+    def extra_state_attributes(self):
+        return {
+            "tunnel_state": self.device.lifecycle.state,
+            **self.device.supervisor.stats(),
+            **self.device.idle.stats(),
+            **self.device.updater.stats(),
+        }
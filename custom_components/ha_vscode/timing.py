@@ -0,0 +1,115 @@
+"""Rolling latency statistics for the phases of setting up and running a tunnel."""
+from collections import deque
+from contextlib import contextmanager
+import math
+import time
+
+PHASE_DOWNLOAD = "download"
+PHASE_EXTRACT = "extract"
+PHASE_SPAWN = "spawn"
+PHASE_FIRST_OUTPUT = "first_output"
+PHASE_DEVICE_CODE = "device_code"
+PHASE_DEV_URL = "dev_url"
+PHASE_STOP = "stop"
+PHASE_RECOVERY = "recovery"
+
+# first_output, device_code and dev_url are measured from the end of the spawn,
+# recovery from a crash to the restarted tunnel running again. dev_url is only
+# recorded for tunnels that were already authorized, otherwise it would include
+# however long somebody took to enter the device code
+PHASES = (
+    PHASE_DOWNLOAD,
+    PHASE_EXTRACT,
+    PHASE_SPAWN,
+    PHASE_FIRST_OUTPUT,
+    PHASE_DEVICE_CODE,
+    PHASE_DEV_URL,
+    PHASE_STOP,
+    PHASE_RECOVERY,
+)
+
+WINDOW = 50
+
+# waits for a phase adapt to this host: a high percentile of what it took before,
+# with some margin, within bounds. until there is enough history the caller's
+# default applies
+TIMEOUT_PERCENTILE = 0.95
+TIMEOUT_FACTOR = 1.5
+TIMEOUT_PAD = 1.0
+TIMEOUT_FLOOR = 2.0
+TIMEOUT_CEILING = 60.0
+MIN_SAMPLES = 3
+
+
+def percentile(ordered, fraction):
+    """Nearest rank percentile of an already sorted, non empty sequence."""
+    rank = max(0, math.ceil(fraction * len(ordered)) - 1)
+    return ordered[rank]
+
+
+class PhaseTimings:
+    """The last window durations of every phase, in seconds."""
+
+    def __init__(self, window=WINDOW):
+        self._samples = {phase: deque(maxlen=window) for phase in PHASES}
+        self._listeners = []
+
+    def record(self, phase, seconds):
+        self._samples[phase].append(seconds)
+        for listener in tuple(self._listeners):
+            listener(phase)
+
+    @contextmanager
+    def span(self, phase):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(phase, time.monotonic() - start)
+
+    def stats(self, phase):
+        samples = self._samples[phase]
+        if not samples:
+            return {"count": 0, "last": None, "p50": None, "p95": None, "max": None}
+        ordered = sorted(samples)
+        return {
+            "count": len(samples),
+            "last": samples[-1],
+            "p50": percentile(ordered, 0.5),
+            "p95": percentile(ordered, 0.95),
+            "max": ordered[-1],
+        }
+
+    def summary(self):
+        return {phase: self.stats(phase) for phase in PHASES}
+
+    def timeout(self, phase, default, floor=TIMEOUT_FLOOR, ceiling=TIMEOUT_CEILING):
+        """How long to wait for phase, in seconds."""
+        samples = self._samples[phase]
+        if len(samples) < MIN_SAMPLES:
+            wait = default
+        else:
+            learned = percentile(sorted(samples), TIMEOUT_PERCENTILE)
+            wait = learned * TIMEOUT_FACTOR + TIMEOUT_PAD
+        return min(ceiling, max(floor, wait))
+
+    def export(self):
+        """The samples as plain lists, to be stored."""
+        return {phase: list(samples) for phase, samples in self._samples.items()}
+
+    def restore(self, data):
+        """Put exported samples back in front of the ones recorded since."""
+        for phase, samples in self._samples.items():
+            stored = [
+                value
+                for value in data.get(phase, ())
+                if isinstance(value, (int, float))
+            ]
+            recent = list(samples)
+            samples.clear()
+            samples.extend(stored + recent)
+
+    def addListener(self, listener):
+        """Call listener(phase) after every new sample. Returns a remove callable."""
+        self._listeners.append(listener)
+        return lambda: self._listeners.remove(listener)
@@ -0,0 +1,95 @@
+"""Recent tunnel output, kept in memory, and logged sparingly.
+
+The CLI can be chatty. Every line goes into a ring buffer bounded by lines and
+bytes, which diagnostics and the output service read from. Only what fits in a
+token bucket reaches the log, and nothing is formatted unless the level is
+enabled.
+"""
+from collections import deque
+import logging
+import time
+
+MAX_LINES = 500
+MAX_BYTES = 64 * 1024
+# lines per second, and how many may come at once
+LOG_RATE = 2.0
+LOG_BURST = 20
+
+
+class OutputBuffer:
+    """The last lines of output, with the wall clock time they were read."""
+
+    def __init__(self, maxLines=MAX_LINES, maxBytes=MAX_BYTES):
+        self.maxLines = maxLines
+        self.maxBytes = maxBytes
+        self._lines = deque()
+        self._bytes = 0
+        # lines that were pushed out, since the start
+        self.dropped = 0
+        self._listeners = []
+
+    def addListener(self, listener):
+        """Call listener(at, line) for every line. Returns a remove callable."""
+        self._listeners.append(listener)
+        return lambda: self._listeners.remove(listener)
+
+    def append(self, line, at=None):
+        size = len(line.encode(errors="replace"))
+        if size > self.maxBytes:
+            line = line[: self.maxBytes]
+            size = len(line.encode(errors="replace"))
+        if at is None:
+            at = time.time()
+        self._lines.append((at, line, size))
+        self._bytes += size
+        while len(self._lines) > self.maxLines or self._bytes > self.maxBytes:
+            _, _, dropped = self._lines.popleft()
+            self._bytes -= dropped
+            self.dropped += 1
+        for listener in tuple(self._listeners):
+            listener(at, line)
+
+    def snapshot(self, limit=None):
+        """(time, line) of the last limit lines, oldest first. All if limit is None."""
+        lines = [(at, line) for at, line, _ in self._lines]
+        return lines if limit is None else lines[-limit:] if limit > 0 else []
+
+    def __len__(self):
+        return len(self._lines)
+
+
+class RateLimitedLog:
+    """Log through logger at no more than rate messages per second, in bursts of up
+    to burst. What is held back is counted and reported with the next message."""
+
+    def __init__(self, logger, rate=LOG_RATE, burst=LOG_BURST, clock=time.monotonic):
+        self.logger = logger
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._tokens = float(burst)
+        self._last = clock()
+        self.suppressed = 0
+
+    def log(self, level, msg, *args):
+        if not self.logger.isEnabledFor(level):
+            return
+        now = self._clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        if self._tokens < 1:
+            self.suppressed += 1
+            return
+        self._tokens -= 1
+        if self.suppressed:
+            self.logger.log(
+                level, "%d lines of tunnel output were not logged", self.suppressed
+            )
+            self.suppressed = 0
+        self.logger.log(level, msg, *args)
+
+    def debug(self, msg, *args):
+        self.log(logging.DEBUG, msg, *args)
+
+    def warning(self, msg, *args):
+        self.log(logging.WARNING, msg, *args)
@@ -0,0 +1,106 @@
+"""Classify the lines written by `code tunnel` into typed events."""
+import re
+from typing import Callable
+from typing import NamedTuple
+from typing import Optional
+
+EVENT_DEVICE_CODE = "device_code"
+EVENT_TUNNEL_URL = "tunnel_url"
+EVENT_CONNECTED = "connected"
+EVENT_DISCONNECTED = "disconnected"
+EVENT_ERROR = "error"
+EVENT_UPDATE_AVAILABLE = "update_available"
+EVENT_LICENSE_PROMPT = "license_prompt"
+
+# one row per event type. the "value" group, if any, is what the event carries.
+# every row ends up as a named alternative of a single compiled pattern, so a line
+# is only scanned once no matter how many event types are of interest.
+EVENT_PATTERNS = {
+    EVENT_DEVICE_CODE: r"https://github\.com/login/device and use code (?P<value>\S+)",
+    EVENT_TUNNEL_URL: r"(?P<value>https://vscode\.dev/tunnel/[^/\s]+/)",
+    EVENT_CONNECTED: r"Opened new client on channel (?P<value>\d+)",
+    EVENT_DISCONNECTED: r"(?i:closed client on channel|client disconnected)\D*(?P<value>\d*)",
+    EVENT_ERROR: r"^(?:\[[^\]]*\]\s*)?(?i:error)\b:?\s*(?P<value>.*)$",
+    EVENT_UPDATE_AVAILABLE: r"(?P<value>(?i:update is available|new version of [^.]* is available).*)$",
+    EVENT_LICENSE_PROMPT: r"(?i:do you accept the terms|server license terms)",
+}
+
+
+class TunnelEvent(NamedTuple):
+    """A line of tunnel output that matched one of EVENT_PATTERNS."""
+
+    type: str
+    value: Optional[str]
+    line: str
+
+
+def _build_pattern(event_types):
+    alternatives = []
+    for event_type in event_types:
+        # group names have to be unique across the alternation
+        body = EVENT_PATTERNS[event_type].replace(
+            "(?P<value>", f"(?P<{event_type}_value>"
+        )
+        alternatives.append(f"(?P<{event_type}>{body})")
+    if not alternatives:
+        return None
+    return re.compile("|".join(alternatives))
+
+
+class TunnelOutputParser:
+    """Turn tunnel output lines into events and hand them to subscribers.
+
+    Only event types that somebody subscribed to are part of the compiled pattern,
+    so a line nobody cares about costs a single failed regex scan (or nothing at
+    all when there are no subscribers).
+    """
+
+    def __init__(self):
+        self._subscribers = {}
+        self._pattern = None
+
+    def subscribe(self, event_type: str, callback: Callable[[TunnelEvent], None]):
+        """Call callback for every event of event_type. Returns an unsubscribe callable."""
+        if event_type not in EVENT_PATTERNS:
+            raise ValueError("Unknown tunnel event type: " + event_type)
+        self._subscribers.setdefault(event_type, []).append(callback)
+        self._compile()
+
+        def unsubscribe():
+            callbacks = self._subscribers.get(event_type, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if not callbacks:
+                self._subscribers.pop(event_type, None)
+            self._compile()
+
+        return unsubscribe
+
+    def _compile(self):
+        # keep the table order, it decides which event wins when two could match
+        self._pattern = _build_pattern(
+            [
+                event_type
+                for event_type in EVENT_PATTERNS
+                if event_type in self._subscribers
+            ]
+        )
+
+    def classify(self, line: str) -> Optional[TunnelEvent]:
+        """Return the event for line, considering only subscribed event types."""
+        if self._pattern is None:
+            return None
+        match = self._pattern.search(line)
+        if match is None:
+            return None
+        event_type = match.lastgroup
+        value = match.groupdict().get(event_type + "_value")
+        return TunnelEvent(event_type, value, line)
+
+    def feed(self, line: str) -> Optional[TunnelEvent]:
+        """Classify line and notify the subscribers of its event type."""
+        event = self.classify(line)
+        if event is not None:
+            for callback in tuple(self._subscribers.get(event.type, ())):
+                callback(event)
+        return event
@@ -0,0 +1,64 @@
+"""What we last knew about a tunnel, kept across Home Assistant restarts.
+
+The record is updated by the device as things happen and stored by the
+TunnelManager. On a warm start it answers questions like "where is the tunnel"
+or "are we logged in" without spawning the CLI and waiting for its output.
+"""
+import time
+
+# how long a login we saw ourselves is trusted without asking the CLI again
+AUTH_CACHE_TTL = 12 * 3600
+
+FIELDS = (
+    "devURL",
+    "tunnelName",
+    "authenticated",
+    "provider",
+    "cliVersion",
+    # wall clock
+    "lastStarted",
+    "lastRunning",
+    "lastAuthenticated",
+)
+
+
+class TunnelRecord:
+    """Plain fields, see FIELDS, and a listener that is told about changes."""
+
+    def __init__(self):
+        for field in FIELDS:
+            setattr(self, field, None)
+        self._listeners = []
+
+    def update(self, **changes):
+        changed = False
+        for field, value in changes.items():
+            if field not in FIELDS:
+                raise AttributeError("TunnelRecord has no field " + field)
+            if getattr(self, field) != value:
+                setattr(self, field, value)
+                changed = True
+        if changed:
+            for listener in tuple(self._listeners):
+                listener()
+
+    def authenticatedRecently(self, ttl=AUTH_CACHE_TTL):
+        return (
+            bool(self.authenticated)
+            and self.lastAuthenticated is not None
+            and time.time() - self.lastAuthenticated < ttl
+        )
+
+    def export(self):
+        return {field: getattr(self, field) for field in FIELDS}
+
+    def restore(self, data):
+        """Take the stored fields, without telling the listeners."""
+        for field in FIELDS:
+            if field in data:
+                setattr(self, field, data[field])
+
+    def addListener(self, listener):
+        """Call listener() after every change. Returns a remove callable."""
+        self._listeners.append(listener)
+        return lambda: self._listeners.remove(listener)
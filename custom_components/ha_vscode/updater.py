@@ -0,0 +1,98 @@
+"""Look for new CLI builds in the background.
+
+Every interval, plus a random part of the jitter so a fleet does not ask all at
+once, the updater fetches from the device's sources with a conditional request.
+A new build is downloaded, checked and staged next to the current one, see
+CLICache. The device swaps it in when its tunnel stops or starts, so nobody
+waits on a download and a running tunnel is left alone.
+"""
+import asyncio
+import logging
+import random
+import time
+
+from .const import PACKAGE_NAME
+from .exceptions import HAVSCodeException
+
+LOGGER: logging.Logger = logging.getLogger(PACKAGE_NAME)
+
+# seconds
+UPDATE_INTERVAL = 24 * 60 * 60
+UPDATE_JITTER = 60 * 60
+
+
+class CLIUpdater:
+    """Periodic background fetch of the CLI for a device. Off until configured."""
+
+    def __init__(self, device):
+        self.log = LOGGER
+        self.device = device
+        self.interval = 0
+        self.jitter = 0
+        # wall clock, for the attributes
+        self.lastCheck = None
+        self.lastError = None
+        self._task = None
+        self._listeners = []
+
+    def configure(self, interval, jitter=UPDATE_JITTER):
+        """Check every interval seconds plus up to jitter, 0 turns it off."""
+        running = self._task is not None
+        if (interval, jitter) == (self.interval, self.jitter) and running == (
+            interval > 0
+        ):
+            # an options update must not push the next check back
+            return
+        self.interval = interval
+        self.jitter = jitter
+        self.close()
+        if interval > 0:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self):
+        staged = self.device.cache.staged()
+        return {
+            "cli_version": self.device.record.cliVersion,
+            "cli_staged": staged.get("version") if staged else None,
+            "cli_checked": self.lastCheck,
+        }
+
+    def addListener(self, listener):
+        """Call listener() after every check. Returns a remove callable."""
+        self._listeners.append(listener)
+        return lambda: self._listeners.remove(listener)
+
+    def _notify(self):
+        for listener in tuple(self._listeners):
+            listener()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval + random.uniform(0, self.jitter))
+            await self.check()
+
+    async def check(self):
+        """Fetch and stage what is new. Returns the latest build's manifest entry,
+        None if the check failed."""
+        device = self.device
+        url = device.downloadURL or device.cliDownloadURL()
+        build = None
+        try:
+            build = await device.cache.fetch(
+                device.downloader, url, sources=device.sources, stage=True
+            )
+            self.lastError = None
+        except (HAVSCodeException, OSError) as err:
+            self.log.warning("Checking for a new VSCode CLI failed: %s", err)
+            self.lastError = str(err)
+        self.lastCheck = time.time()
+        if build is not None and not device.lifecycle.active:
+            # nothing runs the current build, no need to wait for a stop
+            await device.promoteCLI()
+        self._notify()
+        return build
@@ -1,22 +1,96 @@
+import argparse
 import asyncio
+import functools
+import json
 import logging
 import os
 import re
+import signal
 import subprocess
 import time
-from threading import Lock
-from threading import Thread
+from typing import NamedTuple
+from typing import Optional
 
+from .cli_cache import CLICache
+from .const import CLI_DOWNLOAD_URL
 from .const import PACKAGE_NAME
-from .exceptions import HAVSCodeDownloadException
-from .exceptions import HAVSCodeTarException
-from .exceptions import HAVSCodeZipException
+from .downloader import CLIDownloader
+from .idle import IdlePolicy
+from .lifecycle import STATE_AWAITING_AUTH
+from .lifecycle import STATE_FAILED
+from .lifecycle import STATE_RUNNING
+from .lifecycle import STATE_STARTING
+from .lifecycle import STATE_STOPPED
+from .lifecycle import STATE_STOPPING
+from .lifecycle import TunnelLifecycle
+from .loop_monitor import LoopStallMonitor
+from .process_tree import descendants
+from .process_tree import signalAll
+from .process_tree import survivors
+from .resource_profile import CGROUP_NAME
+from .resource_profile import ResourceProfile
+from .resources import ResourceSampler
+from .supervisor import TunnelSupervisor
+from .timing import PHASE_DEV_URL
+from .timing import PHASE_DEVICE_CODE
+from .timing import PHASE_DOWNLOAD
+from .timing import PHASE_FIRST_OUTPUT
+from .timing import PHASE_SPAWN
+from .timing import PHASE_STOP
+from .timing import PhaseTimings
+from .timing import TIMEOUT_FLOOR
+from .tunnel_output import EVENT_DEVICE_CODE
+from .tunnel_output import EVENT_ERROR
+from .tunnel_output import EVENT_TUNNEL_URL
+from .tunnel_output import EVENT_UPDATE_AVAILABLE
+from .tunnel_output import TunnelOutputParser
+from .tunnel_log import OutputBuffer
+from .tunnel_log import RateLimitedLog
+from .tunnel_record import TunnelRecord
+from .updater import CLIUpdater
 
 if not "PACKAGE_NAME" in globals():
     PACKAGE_NAME = "ha_vscode"
 
 LOGGER: logging.Logger = logging.getLogger(PACKAGE_NAME)
 
+# what the debug loop monitor wraps, see instrumentLoop
+INSTRUMENTED_METHODS = (
+    "startTunnel",
+    "stopTunnel",
+    "unregisterTunnel",
+    "asyncStartTunnel",
+    "asyncStopTunnel",
+    "asyncUnregisterTunnel",
+    "asyncSetDesired",
+    "getOAuthToken",
+    "getDevURL",
+    "waitForAuth",
+    "activate",
+    "register",
+    "download",
+    "isRunning",
+    "probeAuth",
+)
+
+# how long an answer of probeAuth is good for
+AUTH_PROBE_TTL = 30.0
+AUTH_PROBE_TIMEOUT = 5.0
+_PROVIDER = re.compile(r"provider (?P<provider>\w+)", re.IGNORECASE)
+
+# how long the tunnel and its children get to exit after SIGTERM, and how long we
+# wait for them after SIGKILL. stopping never takes longer than the two together
+STOP_GRACE = 5.0
+KILL_TIMEOUT = 2.0
+# seconds between checks for children that outlive the tunnel, doubling
+REAP_POLL = 0.005
+REAP_POLL_MAX = 0.1
+
+# how long to wait for the device code and the dev url until the timings of this
+# host know better, what the config flow waited before it learned
+TOKEN_TIMEOUT = 5.0
+DEV_URL_TIMEOUT = 5.0
+
 # don't know why but there is no alpine-armhf version, only linux
 architecture_map = {
     "x86_64": "alpine-x64",
@@ -25,16 +99,71 @@ architecture_map = {
 }
 
 
+class AuthState(NamedTuple):
+    """What the CLI knows about its login and tunnel, without running a tunnel.
+
+    authenticated is None when the CLI could not tell us, e.g. an old version
+    without the status subcommands.
+    """
+
+    authenticated: Optional[bool]
+    provider: Optional[str]
+    tunnelName: Optional[str]
+    devURL: Optional[str]
+    running: bool
+
+
+def cliArchitecture():
+    return architecture_map.get(os.uname().machine)
+
+
+async def readLines(stream):
+    """The lines of stream, like iterating over it, except that a line longer than
+    the stream's buffer limit does not end the iteration. What was buffered of it
+    is handed out as the line and the rest is dropped. Once the reader stops,
+    nobody drains the pipe and the cli blocks when it fills up."""
+    overlong = False
+    while True:
+        try:
+            line = await stream.readuntil(b"\n")
+        except asyncio.IncompleteReadError as err:
+            # the last line, without a newline
+            if err.partial and not overlong:
+                yield err.partial
+            return
+        except asyncio.LimitOverrunError as err:
+            # hand out what is buffered once, drop the rest up to the newline
+            head = await stream.readexactly(err.consumed)
+            if not overlong:
+                LOGGER.debug("Tunnel output line over %d bytes cut short", len(head))
+                yield head
+            overlong = True
+            continue
+        if overlong:
+            overlong = False
+            continue
+        yield line
+
+
 class VSCodeDeviceAPI:
     """Command line VSCode Tunnel OAuth device flow"""
 
     _close_session = False
-
-    def __init__(self, storage_dir):
+    # restarts the tunnel when it crashes while desired
+    supervisorClass = TunnelSupervisor
+
+    def __init__(
+        self,
+        storage_dir,
+        session=None,
+        stallThreshold=None,
+        timings=None,
+        stopGrace=STOP_GRACE,
+        cache=None,
+        cliDataDir=None,
+    ):
         self.log = LOGGER
 
-        self.log.setLevel(logging.DEBUG)
-
         ###uncomment if debuggin outside of home assistant
         """handler = logging.StreamHandler(sys.stdout)
         handler.setLevel(logging.DEBUG)
@@ -47,345 +176,633 @@ class VSCodeDeviceAPI:
 
         self.oauthToken = None
         self.devURL = None
+        # what we last knew, kept across restarts by whoever stores it
+        self.record = TunnelRecord()
         self.proc = None
         self.storage_dir = storage_dir
-        self.thread = None
-        self.lock = Lock()
-        if not os.path.exists(self.storage_dir):
-            os.mkdir(self.storage_dir)
-        self.exePath = os.path.join(self.storage_dir, "code")
-
-    def downloadViaCurl(self, outdir):
-        # curl -Lk https://code.visualstudio.com/sha/download?build=stable&os=cli-alpine-x64 --output /workspaces/ha_core/config/custom_components/ha_vscode/bin/vscode_cli.tar.gz
-        result = None
-        architecture = os.uname().machine
-        getVSCodeCLIcurl = [
-            "curl",
-            "-Lk",
-            f"https://code.visualstudio.com/sha/download?build=stable&os=cli-{architecture_map[architecture]}",
-            "--output",
-            outdir,
-        ]
-
-        hasCurl = subprocess.run(
-            ["which", "curl"],
-            capture_output=True,
-            text=True,
-        )
-
-        if hasCurl.returncode == 0:
-            self.log.debug("Curl found on the system")
-            result = subprocess.run(
-                getVSCodeCLIcurl,
-                capture_output=True,
-                text=True,
-                check=True,
+        self.parser = TunnelOutputParser()
+        self.parser.subscribe(EVENT_DEVICE_CODE, self._onDeviceCode)
+        self.parser.subscribe(EVENT_TUNNEL_URL, self._onTunnelURL)
+        self.parser.subscribe(EVENT_ERROR, self._onError)
+        self.parser.subscribe(EVENT_UPDATE_AVAILABLE, self._onUpdateAvailable)
+        self.readerTask = None
+        self._tokenFuture = None
+        self._devURLFuture = None
+        # start/stop requests are run one after the other, in the order they came in
+        self._opLock = asyncio.Lock()
+        self._pending = None
+        # what the last asyncSetDesired asked for, and the one task working on it
+        self.desired = None
+        self._reconciler = None
+        self.lifecycle = TunnelLifecycle()
+        self.supervisor = self.supervisorClass(self)
+        self.idle = IdlePolicy(self)
+        self.resources = ResourceSampler(self)
+        # fetches new cli builds in the background, off until configured
+        self.updater = CLIUpdater(self)
+        # the last lines the cli printed, for diagnostics and the output service
+        self.output = OutputBuffer()
+        self.outputLog = RateLimitedLog(self.log)
+        try:
+            self.loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.loop = None
+        # the directory is created by the cache, off the event loop. tunnels that
+        # share a storage_dir should share the cache too, see TunnelManager
+        self.cache = cache or CLICache(self.storage_dir, cliArchitecture())
+        # the cli's login and tunnel state, None for its default of ~/.vscode/cli
+        self.cliDataDir = cliDataDir
+        # a symlink to the current build in the cache
+        self.exePath = self.cache.exePath
+        self.downloader = CLIDownloader(session)
+        # None means the upstream build for this machine, see cliDownloadURL
+        self.downloadURL = None
+        # tried in order, see artifact_sources. None for just upstream
+        self.sources = None
+        self.downloadProgress = None
+        # shared with whoever reports on this tunnel, e.g. the diagnostics
+        self.timings = timings if timings is not None else PhaseTimings()
+        # the least an adaptive wait lasts, see waitTimeout
+        self.minTimeout = TIMEOUT_FLOOR
+        self._spawnedAt = None
+        self.stopGrace = stopGrace
+        self.resourceProfile = ResourceProfile()
+        self._authState = None
+        self._authStateAt = 0.0
+        self.loopMonitor = None
+        if stallThreshold is not None or (self.loop and self.loop.get_debug()):
+            self.instrumentLoop(stallThreshold)
+
+    @property
+    def tunnelName(self):
+        # survives restarts, so the tunnel comes back at the same address
+        return self.record.tunnelName
+
+    @property
+    def cgroupName(self):
+        # one group per tunnel, so their limits and usage stay apart
+        if self.cliDataDir is None:
+            return CGROUP_NAME
+        return CGROUP_NAME + "-" + os.path.basename(os.path.normpath(self.cliDataDir))
+
+    def _command(self, *args):
+        # the binary is shared, the login and tunnel state are this tunnel's own
+        if self.cliDataDir is None:
+            return (self.exePath, *args)
+        return (self.exePath, "--cli-data-dir", self.cliDataDir, *args)
+
+    async def _makeDataDir(self):
+        if self.cliDataDir is not None:
+            await asyncio.get_running_loop().run_in_executor(
+                None, functools.partial(os.makedirs, self.cliDataDir, exist_ok=True)
             )
-        else:
-            self.log.debug("Curl not found on the system")
-            return None
-
-        return result.returncode == 0
-
-    def downloadViaWGet(self, outdir):
-        # wget https://code.visualstudio.com/sha/download?build=stable&os=cli-alpine-x64 -O /workspaces/ha_core/config/custom_components/ha_vscode/bin/vscode_cli.tar.gz
-
-        result = None
-        architecture = os.uname().machine
-        getVSCodeCLIwget = [
-            "wget",
-            f"https://code.visualstudio.com/sha/download?build=stable&os=cli-{architecture_map[architecture]}",
-            "-O",
-            outdir,
-        ]
 
-        hasWget = subprocess.run(
-            ["which", "wget"],
-            capture_output=True,
-            text=True,
-        )
-        if hasWget.returncode == 0:
-            self.log.debug("wget found on the system")
-            result = subprocess.run(
-                getVSCodeCLIwget,
-                capture_output=True,
-                text=True,
-                check=True,
+    def instrumentLoop(self, threshold=None):
+        # debug aid: time how long every call into this object holds the event loop.
+        # by default a stall is whatever asyncio's debug mode calls a slow callback
+        if threshold is None:
+            threshold = self.loop.slow_callback_duration if self.loop else 0.1
+        self.loopMonitor = LoopStallMonitor(threshold)
+        self.loopMonitor.instrument(self, INSTRUMENTED_METHODS)
+        return self.loopMonitor
+
+    def cliDownloadURL(self):
+        return CLI_DOWNLOAD_URL.format(architecture=cliArchitecture())
+
+    async def download(self):
+        # the archive is unpacked while it downloads, only the code binary hits the disk.
+        # nothing is downloaded if the cached build is still the latest one
+        url = self.downloadURL or self.cliDownloadURL()
+        self.log.debug("Fetching vscode cli from " + url)
+        with self.timings.span(PHASE_DOWNLOAD):
+            build = await self.cache.fetch(
+                self.downloader,
+                url,
+                progress=self._onProgress,
+                timings=self.timings,
+                sources=self.sources,
             )
-        else:
-            self.log.debug("wget not found on the system")
-            return None
+        if build:
+            self.record.update(cliVersion=build.get("version"))
+        return build
 
-        return result.returncode == 0
-
-    def unzip(self, outfile):
-        # force overwrite of existing files - this will ensure vscode cli is updated. and we don't block on user prompt
-        result = subprocess.run(
-            ["gzip", "-fd", outfile],
-            capture_output=True,
-            text=True,
-            check=True,
-        )
-        if result:
-            self.log.debug(result.stdout)
-            self.log.debug("Unzipped " + outfile)
-        else:
-            self.log.debug("Error occurred while unzipping " + outfile)
-            raise HAVSCodeZipException()
-
-    def untar(self, outfile):
-        result = subprocess.run(
-            ["tar", "-xvf", outfile[:-3], "-C", self.storage_dir],
-            capture_output=True,
-            text=True,
-            check=True,
-        )
+    async def promoteCLI(self):
+        # a build the updater staged, now that the tunnel does not run the old one
+        try:
+            build = await self.cache.promote()
+        except OSError as err:
+            self.log.warning("Could not switch to the staged VSCode CLI: " + str(err))
+            return
+        if build is not None:
+            self.log.info("Switched to VSCode CLI " + str(build.get("version")))
+            self.record.update(cliVersion=build.get("version"))
 
-        if result.returncode == 0:
-            self.log.debug(result.stdout)
-            self.log.debug("Untarred " + outfile[:-3])
-        else:
-            self.log.debug(result.stdout)
-            self.log("Error occurred while untarring " + outfile[:-3])
-            raise HAVSCodeTarException()
+    def _onProgress(self, received, total):
+        self.downloadProgress = (received, total)
 
-    def checkExe(self):
+    async def checkExe(self):
         # check that the code executable exists
-        if not os.path.exists(self.exePath):
+        exists = await asyncio.get_running_loop().run_in_executor(
+            None, os.path.exists, self.exePath
+        )
+        if not exists:
             self.log.debug(
                 "Error! VSCode executable is not located at: " + self.exePath
             )
         else:
             self.log.debug("VSCode executable is located at: " + self.exePath)
 
-    def reader(self):
-        self.log.debug("Starting reader thread")
+    async def reader(self, proc):
+        self.log.debug("Starting reader task")
         try:
-            while True:
-                line = self.proc.stdout.readline().strip()
-                if line is not None:
-                    if len(line) > 0:
-                        self.log.debug("Parsing line: " + line)
-                if not self.checkForOauthToken(line):
-                    self.checkForDevURL(line)
-        except:
+            # the stream reader hands us complete lines as soon as they are written,
+            # no need to block an OS thread on readline()
+            first = True
+            async for raw in readLines(proc.stdout):
+                if first:
+                    self._recordSinceSpawn(PHASE_FIRST_OUTPUT)
+                    first = False
+                line = raw.decode(errors="replace").strip()
+                if len(line) > 0:
+                    self.output.append(line)
+                    self.outputLog.debug("Tunnel output: %s", line)
+                self.parser.feed(line)
+        except asyncio.CancelledError:
+            self.log.debug("Reader task cancelled")
+            raise
+        except Exception:
             self.log.debug("Reader threw exception: likely closed stdout")
+        else:
+            # nobody asked for this, _stop cancels the reader before it gets here
+            if proc is self.proc and self.lifecycle.state != STATE_STOPPING:
+                self.log.warning("Tunnel Service exited unexpectedly")
+                self.lifecycle.advance(STATE_FAILED)
         finally:
-            self.log.debug("Received EOF from stdout, thread exiting...")
+            self.log.debug("Received EOF from stdout, reader exiting...")
+            # nothing more will be parsed for this process, wake up anyone still waiting
+            self._resolve(self._tokenFuture, None)
+            self._resolve(self._devURLFuture, None)
+
+    def _resolve(self, future, value):
+        if future is not None and not future.done():
+            future.set_result(value)
+
+    def _runSync(self, coro):
+        # lets the old synchronous entry points keep working. on the event loop we
+        # schedule the coroutine and return the task, from a worker thread (e.g. a
+        # sync entity service call) we hand it to the loop and wait for it.
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+
+        if running is not None:
+            self.loop = running
+            self._pending = running.create_task(coro)
+            return self._pending
+
+        if self.loop is None:
+            coro.close()
+            raise RuntimeError("VSCodeDeviceAPI needs an event loop to run the tunnel")
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
 
     def unregisterTunnel(self):
-        if self.proc:
+        return self._runSync(self.asyncUnregisterTunnel())
+
+    async def asyncUnregisterTunnel(self):
+        if await self._hasTunnel():
             self.log.debug(
                 "Stop tunnel with active subprocess. Stopping and unregistering..."
             )
-            self.stopTunnel()
-
-        isUnregistered = subprocess.run(
-            [
-                self.exePath,
-                "tunnel",
-                "unregister",
-            ],
-            capture_output=True,
-            text=True,
-        )
+            await self.asyncStopTunnel()
 
-        if isUnregistered == 0:
+        proc = await asyncio.create_subprocess_exec(
+            *self._command("tunnel", "unregister"),
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        if await proc.wait() == 0:
             self.log.info("Unregistering tunnel successful.")
         else:
             self.log.error(
                 "Could not unregister tunnel. Please run 'code tunnel unregister' manually to avoid future issues."
             )
 
-    def startTunnel(self):
-        # if the tunnel is already started, stop it and restart - we otherwise might miss important info written to stdout
-        if self.proc:
-            self.log.debug(
-                "Start tunnel with active subprocess. Stopping and restarting..."
+    async def _hasTunnel(self):
+        # a process, even one that exited and was not reaped yet
+        return self.proc is not None
+
+    async def _runCLI(self, *args, timeout=AUTH_PROBE_TIMEOUT):
+        # short lived, machine readable subcommands. returns (returncode, output)
+        try:
+            await self._makeDataDir()
+            proc = await asyncio.create_subprocess_exec(
+                *self._command(*args),
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL,
             )
-            self.stopTunnel()
-
-        self.proc = subprocess.Popen(
-            [self.exePath, "tunnel", "--random-name", "--accept-server-license-terms"],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,  # output stderr to stdout
-            # bufsize=1, #was enabled to reduce the buffer size
-            # do not put shell=true, as this will spawn 2 processes, a shell, and our command.
-            # zombie proesses will ensue if we try to terminate the process with sigint.
-            text=True,
+        except OSError as err:
+            self.log.debug("Could not run code " + " ".join(args) + ": " + str(err))
+            return None, ""
+        try:
+            out, _ = await asyncio.wait_for(proc.communicate(), timeout)
+        except asyncio.TimeoutError:
+            self.log.debug("code " + " ".join(args) + " did not answer in time")
+            proc.kill()
+            await proc.wait()
+            return None, ""
+        return proc.returncode, out.decode(errors="replace").strip()
+
+    async def probeAuth(self, ttl=AUTH_PROBE_TTL):
+        """Ask `code tunnel user show` and `code tunnel status` whether we are
+        logged in and which tunnel we have. Never starts a tunnel."""
+        if self._authState and time.monotonic() - self._authStateAt < ttl:
+            return self._authState
+
+        (userCode, user), (statusCode, status) = await asyncio.gather(
+            self._runCLI("tunnel", "user", "show"),
+            self._runCLI("tunnel", "status"),
+        )
+        authenticated = None
+        provider = None
+        if userCode is not None:
+            authenticated = userCode == 0 and "not logged in" not in user.lower()
+            match = _PROVIDER.search(user)
+            provider = match.group("provider") if match else None
+
+        tunnelName = None
+        running = False
+        if statusCode == 0:
+            try:
+                data = json.loads(status)
+            except ValueError:
+                data = {}
+            tunnel = data.get("tunnel") if isinstance(data, dict) else None
+            running = bool(tunnel)
+            if isinstance(tunnel, dict):
+                tunnelName = tunnel.get("name")
+            if isinstance(data, dict):
+                tunnelName = tunnelName or data.get("name")
+
+        devURL = None
+        if tunnelName:
+            devURL = "https://vscode.dev/tunnel/" + tunnelName + "/"
+        self._setAuthState(
+            AuthState(authenticated, provider, tunnelName, devURL, running)
         )
-        print(self.proc.pid)
-        self.log.info("Tunnel Service started with pid: " + str(self.proc.pid))
-        # create the queue and the reader thread
-        self.thread = Thread(target=self.reader)
-        self.thread.daemon = True
-        self.thread.start()
+        self.log.debug("Auth probe: " + str(self._authState))
+        if authenticated is not None:
+            self.record.update(authenticated=authenticated)
+        if authenticated:
+            self.record.update(provider=provider, lastAuthenticated=time.time())
+        if tunnelName:
+            self.record.update(tunnelName=tunnelName, devURL=devURL)
+        return self._authState
+
+    def _setAuthState(self, state):
+        self._authState = state
+        self._authStateAt = time.monotonic()
+
+    def startTunnel(self, profile=None):
+        return self._runSync(self.asyncStartTunnel(profile))
 
     def stopTunnel(self):
-        if self.proc is None:
-            self.log.debug("Stop Tunnel called with no active subprocess")
-            return
-        # ? need toclose the stdoutput as it will be closed when process is terminated
-        self.log.debug("Terminating subprocess: " + str(self.proc.pid))
-        self.proc.terminate()
-        self.log.debug("Closing subprocess stdout")
-        self.proc.stdout.close()
-        while self.proc.poll() is None:
+        return self._runSync(self.asyncStopTunnel())
+
+    async def asyncStartTunnel(self, profile=None):
+        # profile replaces the ResourceProfile for this and all later starts
+        if profile is not None:
+            self.resourceProfile = profile
+        async with self._opLock:
+            # if the tunnel is already started, stop it and restart - we otherwise might miss important info written to stdout
+            if self.proc:
+                self.log.debug(
+                    "Start tunnel with active subprocess. Stopping and restarting..."
+                )
+                await self._stop()
+
+            self.loop = asyncio.get_running_loop()
+            # anything parsed from a previous process is stale now
+            self.oauthToken = None
+            self.devURL = None
+            self._tokenFuture = self.loop.create_future()
+            self._devURLFuture = self.loop.create_future()
+
+            self.lifecycle.advance(STATE_STARTING)
+            await self.promoteCLI()
+            if self.tunnelName:
+                name = ("--name", self.tunnelName)
+            else:
+                name = ("--random-name",)
             try:
-                self.log.debug("waiting for " + str(self.proc.pid) + " to end")
-                self.proc.wait(timeout=0.1)
-            except subprocess.TimeoutExpired:
-                self.log.debug("Wait timeout expired for subprocess: " + self.proc.pid)
-        # wait for the reader thread to end
-        if self.thread:
-            self.log.debug("Thread is not None. Will check if alive...")
-            if self.thread.is_alive():
-                self.log.debug("Thread is alive. Will attempt to join...")
-                self.thread.join(timeout=0.1)
-                if self.thread.is_alive():
-                    self.log.debug(
-                        "Timeout occurred and thread join failed. Zombie thread may be created"
+                await self._makeDataDir()
+                with self.timings.span(PHASE_SPAWN):
+                    self.proc = await asyncio.create_subprocess_exec(
+                        *self._command(
+                            "tunnel", *name, "--accept-server-license-terms"
+                        ),
+                        stdout=asyncio.subprocess.PIPE,
+                        stderr=asyncio.subprocess.STDOUT,  # output stderr to stdout
+                        # exec, not shell - a shell would be a second process and
+                        # zombie proesses will ensue if we try to terminate the process with sigint.
+                        # a process group of its own, so the server it starts can
+                        # be signalled together with it
+                        start_new_session=True,
+                        preexec_fn=self.resourceProfile.preexec(),
                     )
-                else:
-                    self.log.debug("Thread is dead.")
+            except (OSError, subprocess.SubprocessError):
+                self.lifecycle.advance(STATE_FAILED)
+                raise
+            if self.resourceProfile.cgroup:
+                await self.loop.run_in_executor(
+                    None,
+                    self.resourceProfile.placeInCgroup,
+                    self.proc.pid,
+                    self.cgroupName,
+                )
+            self._spawnedAt = time.monotonic()
+            self.record.update(lastStarted=time.time())
+            self.log.info("Tunnel Service started with pid: " + str(self.proc.pid))
+            self.readerTask = self.loop.create_task(self.reader(self.proc))
+
+    async def asyncStopTunnel(self):
+        async with self._opLock:
+            await self._stop()
+
+    async def asyncSetDesired(self, running):
+        """Ask for the tunnel to be running or not, and wait until it is.
+
+        Requests that come in while a start or stop is under way only change the
+        goal of the task already working on it, so a burst of on/off toggles costs
+        at most one restart instead of one per toggle.
+        """
+        self.desired = running
+        if self._reconciler is None or self._reconciler.done():
+            self._reconciler = asyncio.get_running_loop().create_task(self._reconcile())
+        # the callers share the task, one of them going away must not cancel it
+        await asyncio.shield(self._reconciler)
+
+    async def _reconcile(self):
+        while not self._settled():
+            if self.desired:
+                await self.asyncStartTunnel()
             else:
-                self.log.debug("Thread is alive. Will attempt to join...")
-        self.thread = None
+                await self.asyncStopTunnel()
+
+    def _settled(self):
+        if self.desired:
+            return self.lifecycle.active
+        # a crashed tunnel may have left its server behind, that needs a stop too
+        return not self.lifecycle.active and self.proc is None
+
+    async def _stop(self):
+        if self.proc is None:
+            self.log.debug("Stop Tunnel called with no active subprocess")
+            return
+        proc = self.proc
+        stopping = time.monotonic()
+        self.lifecycle.advance(STATE_STOPPING)
+        loop = asyncio.get_running_loop()
+        # the server and its children are re-parented once the cli is gone, find
+        # them while they are still below it
+        tree = await loop.run_in_executor(None, descendants, proc.pid)
+        self.log.debug(
+            "Terminating subprocess "
+            + str(proc.pid)
+            + " and "
+            + str(len(tree))
+            + " descendants"
+        )
+        await self._signal(proc, tree, signal.SIGTERM)
+        if not await self._reap(proc, tree, self.stopGrace):
+            self.log.warning(
+                "Tunnel did not exit within "
+                + str(self.stopGrace)
+                + "s of SIGTERM. Killing it..."
+            )
+            await self._signal(proc, tree, signal.SIGKILL)
+            if not await self._reap(proc, tree, KILL_TIMEOUT):
+                left = await loop.run_in_executor(None, survivors, tree)
+                if proc.returncode is None:
+                    left.insert(0, proc)
+                self.log.error(
+                    "Tunnel processes survived SIGKILL, giving up on them: "
+                    + str([process.pid for process in left])
+                )
+
+        # give the reader a moment to drain what is left on stdout. children of the
+        # tunnel can keep the pipe open after it exits, so don't wait for EOF forever
+        if self.readerTask:
+            await asyncio.wait({self.readerTask}, timeout=0.1)
+            if not self.readerTask.done():
+                self.log.debug("Reader still waiting on stdout. Cancelling it...")
+                self.readerTask.cancel()
+                await asyncio.gather(self.readerTask, return_exceptions=True)
+        self.readerTask = None
         self.proc = None
+        self._spawnedAt = None
+        if self._authState:
+            self._setAuthState(self._authState._replace(running=False))
+        self.timings.record(PHASE_STOP, time.monotonic() - stopping)
+        await self.promoteCLI()
+        self.lifecycle.advance(STATE_STOPPED)
         self.log.info("Tunnel Service ended.")
 
-    # tried asyncio.timeout with a context manager, but some weird shirt was happening.
-    # no timeouterror was being thrown and the tiemout in the context manager was being
-    # reset to ~5800 seconds.. ??maybe affected by the main event loop somewhere
-    # maybe because we weren't waiting on sleep --> try timeout again!
-    async def getOAuthToken(self, timeout=3.0):
-        out = None
-        start = time.time()
+    async def _signal(self, proc, tree, sig):
+        # the group catches whatever was started after we looked at the tree,
+        # the tree whatever left the group
+        try:
+            os.killpg(proc.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+        await asyncio.get_running_loop().run_in_executor(None, signalAll, tree, sig)
+
+    async def _reap(self, proc, tree, timeout):
+        # True if the cli and all of its descendants are gone within timeout
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        try:
+            await asyncio.wait_for(proc.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        # the children usually follow within a few milliseconds, poll fast at first
+        interval = REAP_POLL
         while True:
-            self.lock.acquire()
-            # self.log.debug("Acquired Lock - getOAuthToken")
-            if self.oauthToken:
-                out = self.oauthToken
-                self.lock.release()
-                # self.log.debug("Released Lock - getOAuthToken")
-                # self.log.debug("getOAuthToken returning: " + out)
-                break
-
-            if (time.time() - start) > timeout:
-                # self.log.debug("Released Lock - getOAuthToken")
-                # self.log.debug("getOAuthToken returning: None")
-                self.lock.release()
-                break
-            self.lock.release()
-            # self.log.debug("Released Lock - getOAuthToken")
-            # self.log.debug("Sleeping for 0.1s in getOAuthToken")
-            await asyncio.sleep(0.1)
-        return out
+            left = await loop.run_in_executor(None, survivors, tree)
+            if not left:
+                return True
+            if loop.time() >= deadline:
+                return False
+            await asyncio.sleep(min(interval, deadline - loop.time()))
+            interval = min(REAP_POLL_MAX, interval * 2)
+
+    def _recordSinceSpawn(self, phase):
+        if self._spawnedAt is not None:
+            self.timings.record(phase, time.monotonic() - self._spawnedAt)
+
+    async def _waitFor(self, attr, futureAttr, timeout):
+        async def wait():
+            # a start scheduled from sync code may not have created the futures yet
+            if self._pending is not None and not self._pending.done():
+                await asyncio.wait({self._pending})
+            value = getattr(self, attr)
+            future = getattr(self, futureAttr)
+            if value or future is None:
+                return value
+            return await asyncio.shield(future)
+
+        try:
+            return await asyncio.wait_for(wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def waitTimeout(self, phase, default):
+        # learned from how long phase took on this host before
+        return self.timings.timeout(phase, default, floor=self.minTimeout)
+
+    async def getOAuthToken(self, timeout=None):
+        if timeout is None:
+            timeout = self.waitTimeout(PHASE_DEVICE_CODE, TOKEN_TIMEOUT)
+        return await self._waitFor("oauthToken", "_tokenFuture", timeout)
 
     # will return none if we can't find the dev url
-    async def getDevURL(self, timeout=5.0):
-        out = None
-        start = time.time()
-        while True:
-            self.lock.acquire()
-            # self.log.debug("Acquired Lock - getDevURL")
-            if self.devURL:
-                out = self.devURL
-                self.lock.release()
-                # self.log.debug("Released Lock - getDevURL")
-                # self.log.debug("getDevURL returning: " + out)
-                break
-
-            if (time.time() - start) > timeout:
-                # self.log.debug("Released Lock - getOAuthToken")
-                # self.log.debug("getOAuthToken returning: None")
-                self.lock.release()
-                break
-            self.lock.release()
-            # self.log.debug("Released Lock - getDevURL")
-            # self.log.debug("Sleeping for 0.1s in getDevURL")
-            await asyncio.sleep(0.1)
-        return out
-
-    def checkForOauthToken(self, line):
-        match = re.search(
-            "https://github.com/login/device and use code .*$",
-            line,
-        )
-        if match:
-            token = match.group()[-9:]
-            self.log.info("Github oauth login token: " + token)
-            # if we parsed an oauth Token, then the dev url must be stale and we need to re-auth
-            self.lock.acquire()
-            self.log.debug("Acquired Lock - checkForOauthToken")
-            self.oauthToken = token
-            self.lock.release()
-            self.log.debug("Released Lock - checkForOauthToken")
-            return self.oauthToken
-        return None
-
-    def checkForDevURL(self, line):
-        match = re.search(
-            "https://vscode.dev/tunnel/[^/]*/",
-            line,
+    async def getDevURL(self, timeout=None):
+        if timeout is None:
+            timeout = self.waitTimeout(PHASE_DEV_URL, DEV_URL_TIMEOUT)
+        return await self._waitFor("devURL", "_devURLFuture", timeout)
+
+    async def waitForAuth(self, timeout=None):
+        """Wait for the device code or the dev url, whichever the tunnel prints
+        first. Returns (oauthToken, devURL), both None if neither came in time."""
+        if timeout is None:
+            timeout = max(
+                self.waitTimeout(PHASE_DEVICE_CODE, TOKEN_TIMEOUT),
+                self.waitTimeout(PHASE_DEV_URL, DEV_URL_TIMEOUT),
+            )
+        # the device code is settled with None once the dev url is there
+        token = await self.getOAuthToken(timeout)
+        return token, self.devURL
+
+    def _onDeviceCode(self, event):
+        token = event.value
+        self.log.info("Github oauth login token: " + token)
+        # if we parsed an oauth Token, then the dev url must be stale and we need to re-auth
+        if self.oauthToken is None:
+            self._recordSinceSpawn(PHASE_DEVICE_CODE)
+        self.oauthToken = token
+        # the tunnel told us for free, no need to probe again
+        self._setAuthState(AuthState(False, None, None, None, True))
+        self.record.update(authenticated=False)
+        self.lifecycle.advance(STATE_AWAITING_AUTH)
+        self._resolve(self._tokenFuture, token)
+
+    def _onTunnelURL(self, event):
+        url = event.value
+        self.log.info("Dev url: " + url)
+        # if we have a dev url, we don't need an oauth token
+        if self.devURL is None and self.oauthToken is None:
+            self._recordSinceSpawn(PHASE_DEV_URL)
+        self.devURL = url
+        name = url.rstrip("/").rsplit("/", 1)[-1]
+        provider = self._authState.provider if self._authState else None
+        self._setAuthState(AuthState(True, provider, name, url, True))
+        now = time.time()
+        self.record.update(
+            devURL=url,
+            tunnelName=name,
+            authenticated=True,
+            lastRunning=now,
+            lastAuthenticated=now,
         )
-        if match:
-            url = match.group()
-            self.log.info("Dev url: " + url)
-            # if we have a dev url, we don't need an oauth token
-            # probably should make this threadsafe
-            self.lock.acquire()
-            self.log.debug("Acquired Lock - checkForDevURL")
-            self.devURL = url
-            self.lock.release()
-            self.log.debug("Released Lock - checkForDevURL")
-            return url
-        return None
+        self.lifecycle.advance(STATE_RUNNING)
+        self._resolve(self._devURLFuture, url)
+        # no device code is coming any more, don't keep anyone waiting for it
+        self._resolve(self._tokenFuture, None)
+
+    def _onError(self, event):
+        self.outputLog.warning("Tunnel reported an error: %s", event.line)
+
+    def _onUpdateAvailable(self, event):
+        self.log.info("Tunnel reported a CLI update: " + event.line)
 
     def isRunning(self):
-        return self.proc is not None
+        return self.proc is not None and self.proc.returncode is None
+
+    @property
+    def pid(self):
+        """The pid of the tunnel process, None if there is none."""
+        return self.proc.pid if self.isRunning() else None
+
+    async def asyncStopServer(self):
+        # the VSCode server runs below the cli, which starts a new one for the next
+        # client that connects
+        pid = self.pid
+        if pid is None:
+            return
+        loop = asyncio.get_running_loop()
+        tree = await loop.run_in_executor(None, descendants, pid)
+        await loop.run_in_executor(None, signalAll, tree, signal.SIGTERM)
+
+    async def asyncAttach(self):
+        """Pick up a tunnel that outlived the last Home Assistant run. Only one in
+        a helper process can, see helper.py."""
+
+    async def asyncDetach(self):
+        """Let go of the tunnel because Home Assistant stops, which stops it."""
+        await self.asyncSetDesired(False)
 
-    async def activate(self, timeout=5.0):
+    async def asyncClose(self):
+        """Nobody is going to use this device again."""
+        self.updater.close()
+
+    async def activate(self, timeout=None):
         result = await self.getDevURL(timeout=timeout)
         if result:
             self.log.debug("Activated on url: " + result)
         if result is None:
-            self.stopTunnel()
+            await self.asyncStopTunnel()
         return result
 
-    async def register(self, timeout=3.0):
-        outfile = "vscode_cli.tar.gz"
-        outdir = os.path.join(self.storage_dir, outfile)
-
-        result = self.downloadViaCurl(outdir)
-        if not result:
-            self.downloadViaWGet(outdir)
-        if result:
-            self.log.debug("Downloaded vscode cli to " + outdir)
-        else:
-            self.log.info(
-                "Could not download vscode cli. Curl and wget are both not available on your system."
-            )
-            raise HAVSCodeDownloadException()
-
-        self.unzip(outdir)
-        self.untar(outdir)
-        self.checkExe()
-        self.startTunnel()
+    async def register(self, timeout=None):
+        build = await self.download()
+        self.log.debug(
+            "Using vscode cli " + str(build.get("version")) + " at " + self.exePath
+        )
+        await self.checkExe()
+        await self.asyncStartTunnel()
         token = await self.getOAuthToken(timeout=timeout)
         if token:
             self.log.debug("Registered with token: " + token)
         return token
 
 
-def main():
-    api = VSCodeDeviceAPI(".")
-    outfile = "vscode_cli.tar.gz"
-    outdir = os.path.join(".", outfile)
-    api.startTunnel()
-    api.getOAuthToken()
-    api.getDevURL(timeout=3)
-    api.stopTunnel()
+async def run(storage_dir, cliDataDir=None):
+    api = VSCodeDeviceAPI(storage_dir, cliDataDir=cliDataDir)
+    await api.asyncStartTunnel()
+    await api.getOAuthToken()
+    await api.getDevURL()
+    await api.asyncStopTunnel()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a VSCode tunnel")
+    parser.add_argument("--storage", default=".", help="where the cli is cached")
+    parser.add_argument(
+        "--cli-data-dir", help="the cli's login and tunnel state, one per tunnel"
+    )
+    parser.add_argument(
+        "--helper",
+        metavar="SOCKET",
+        help="keep the tunnel in this process and serve it on a Unix socket",
+    )
+    args = parser.parse_args(argv)
+    if args.helper:
+        # the helper module builds on this one
+        from .helper import runHelper
+
+        asyncio.run(runHelper(args.helper, args.storage, args.cli_data_dir))
+    else:
+        asyncio.run(run(args.storage, args.cli_data_dir))
 
 
 if __name__ == "__main__":
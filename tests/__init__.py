@@ -0,0 +1 @@
+"""Tests for the ha_vscode integration."""
@@ -0,0 +1,80 @@
+"""Memory and disk bounds of the streaming CLI extraction."""
+import hashlib
+import io
+import os
+import tarfile
+import tracemalloc
+
+import pytest
+
+from custom_components.ha_vscode.archive import CLIExtractor
+from custom_components.ha_vscode.downloader import CHUNK_SIZE
+from custom_components.ha_vscode.exceptions import HAVSCodeZipException
+
+# the bound archive.py documents
+MEMORY_BOUND = 1024 * 1024
+
+
+def archive(payload, name="code"):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        info = tarfile.TarInfo(name)
+        info.size = len(payload)
+        info.mode = 0o755
+        tar.addfile(info, io.BytesIO(payload))
+    return buffer.getvalue()
+
+
+def diskUsage(directory):
+    return sum(entry.stat().st_size for entry in os.scandir(directory))
+
+
+async def feed(extractor, data, directory=None):
+    """Write data the way the downloader does. Returns the peak disk use."""
+    peak = 0
+    await extractor.start()
+    for offset in range(0, len(data), CHUNK_SIZE):
+        await extractor.write(data[offset : offset + CHUNK_SIZE])
+        if directory is not None:
+            peak = max(peak, diskUsage(directory))
+    await extractor.finish()
+    return peak
+
+
+async def test_bounds_for_a_compressible_member(tmp_path):
+    # zeros compress about 1000:1, one chunk holds all of the member
+    payload = bytes(32 * 1024 * 1024)
+    data = archive(payload)
+    assert len(data) < CHUNK_SIZE * 2
+    extractor = CLIExtractor(str(tmp_path / "code"))
+
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        peakDisk = await feed(extractor, data, tmp_path)
+        peakMemory = tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        tracemalloc.stop()
+
+    assert peakMemory < MEMORY_BOUND
+    assert max(peakDisk, diskUsage(tmp_path)) <= len(payload)
+    assert extractor.sha256 == hashlib.sha256(payload).hexdigest()
+    assert os.listdir(tmp_path) == ["code"]
+
+
+async def test_skips_other_members(tmp_path):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        for name, payload in (("README", b"read me"), ("code", b"binary")):
+            info = tarfile.TarInfo(name)
+            info.size = len(payload)
+            tar.addfile(info, io.BytesIO(payload))
+    await feed(CLIExtractor(str(tmp_path / "code")), buffer.getvalue())
+    assert (tmp_path / "code").read_bytes() == b"binary"
+
+
+async def test_truncated_archive(tmp_path):
+    data = archive(os.urandom(256 * 1024))
+    with pytest.raises(HAVSCodeZipException):
+        await feed(CLIExtractor(str(tmp_path / "code")), data[: len(data) // 2])
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,160 @@
+"""Parsing the sources, and installing from a bundle only what it pins."""
+import json
+import os
+
+import pytest
+
+from custom_components.ha_vscode.artifact_sources import BUNDLE_MANIFEST
+from custom_components.ha_vscode.artifact_sources import Bundle
+from custom_components.ha_vscode.artifact_sources import DEFAULT_TIMEOUTS
+from custom_components.ha_vscode.artifact_sources import KIND_FILE
+from custom_components.ha_vscode.artifact_sources import KIND_MIRROR
+from custom_components.ha_vscode.artifact_sources import LocalBundle
+from custom_components.ha_vscode.artifact_sources import parseSources
+from custom_components.ha_vscode.artifact_sources import seedMirror
+from custom_components.ha_vscode.artifact_sources import UPSTREAM
+from custom_components.ha_vscode.cli_cache import CLICache
+from custom_components.ha_vscode.downloader import DownloadResult
+from custom_components.ha_vscode.exceptions import HAVSCodeChecksumException
+from custom_components.ha_vscode.exceptions import HAVSCodeDownloadException
+from tests.test_downloader import cliArchive
+
+ARCHITECTURE = "cli-alpine-x64"
+URL = "https://update.code.visualstudio.com/latest/cli-alpine-x64/stable"
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("upstream", [(UPSTREAM, UPSTREAM, DEFAULT_TIMEOUTS[UPSTREAM])]),
+        (
+            "/share/vscode-cli, http://mirror.lan/vscode-cli 20, upstream",
+            [
+                (KIND_FILE, "/share/vscode-cli", DEFAULT_TIMEOUTS[KIND_FILE]),
+                (KIND_MIRROR, "http://mirror.lan/vscode-cli", 20.0),
+                (UPSTREAM, UPSTREAM, DEFAULT_TIMEOUTS[UPSTREAM]),
+            ],
+        ),
+        (
+            "file:///media/usb 5\n\n  https://cdn.lan/cli/  ,",
+            [
+                (KIND_FILE, "/media/usb", 5.0),
+                (KIND_MIRROR, "https://cdn.lan/cli/", DEFAULT_TIMEOUTS[KIND_MIRROR]),
+            ],
+        ),
+    ],
+)
+def test_parse_sources(text, expected):
+    sources = parseSources(text)
+    assert [(s.kind, s.location, s.timeout) for s in sources] == expected
+    assert [s.pinned for s in sources] == [s[0] != UPSTREAM for s in expected]
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        None,
+        "",
+        " , \n",
+        "vscode-cli",
+        "/share 1 2",
+        "/share 0",
+        "/share -5",
+        "/share x",
+    ],
+)
+def test_bad_sources(text):
+    with pytest.raises(ValueError):
+        parseSources(text)
+
+
+def test_bundle_is_abstract():
+    with pytest.raises(TypeError):
+        Bundle("/share/vscode-cli")
+
+
+def test_where():
+    (local, mirror) = parseSources("/share/cli, http://mirror.lan/cli/")
+    assert local.where("a.tar.gz") == "/share/cli/a.tar.gz"
+    assert mirror.where("a.tar.gz") == "http://mirror.lan/cli/a.tar.gz"
+
+
+class Seeder:
+    """Hands seedMirror the archive in place of CLIDownloader."""
+
+    def __init__(self, archive):
+        self.archive = archive
+
+    async def download(self, url, path, headers=None):
+        with open(path, "wb") as file:
+            file.write(self.archive)
+        return DownloadResult(len(self.archive), '"1.0.0"', None, url)
+
+
+@pytest.fixture
+async def bundle(tmp_path):
+    directory = str(tmp_path / "bundle")
+    await seedMirror(directory, Seeder(cliArchive("1.0.0")), [ARCHITECTURE])
+    return directory
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return CLICache(str(tmp_path / "cli"), ARCHITECTURE)
+
+
+def repin(directory, sha256):
+    path = os.path.join(directory, BUNDLE_MANIFEST)
+    with open(path, encoding="utf-8") as file:
+        manifest = json.load(file)
+    manifest["builds"][ARCHITECTURE]["sha256"] = sha256
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(manifest, file)
+
+
+async def test_install_from_bundle(bundle, cache):
+    build = await cache.fetch(None, URL, sources=parseSources(bundle))
+    assert build["version"] == "1.0.0"
+    assert build["url"] == os.path.join(bundle, "vscode_cli_cli-alpine-x64.tar.gz")
+    assert os.access(cache.exePath, os.X_OK)
+    # the second time it is already there
+    assert await cache.fetch(None, URL, sources=parseSources(bundle)) == build
+
+
+async def test_pin_mismatch(bundle, cache):
+    repin(bundle, "0" * 64)
+    with pytest.raises(HAVSCodeDownloadException) as raised:
+        await cache.fetch(None, URL, sources=parseSources(bundle))
+    assert isinstance(raised.value.__cause__, HAVSCodeChecksumException)
+    # nothing was installed, and nothing is left over
+    assert not os.path.lexists(cache.exePath)
+    assert cache.current() is None
+    assert [name for name in os.listdir(cache.directory) if len(name) == 64] == []
+
+
+async def test_pin_mismatch_tries_the_next_source(tmp_path, bundle, cache):
+    tampered = str(tmp_path / "tampered")
+    await seedMirror(tampered, Seeder(cliArchive("6.6.6")), [ARCHITECTURE])
+    with open(os.path.join(bundle, BUNDLE_MANIFEST), encoding="utf-8") as file:
+        repin(tampered, json.load(file)["builds"][ARCHITECTURE]["sha256"])
+
+    build = await cache.fetch(None, URL, sources=parseSources(f"{tampered}, {bundle}"))
+    assert build["version"] == "1.0.0"
+    assert build["url"].startswith(bundle)
+
+
+@pytest.mark.parametrize(
+    "manifest",
+    [
+        "not json",
+        {"builds": {}},
+        {"builds": {ARCHITECTURE: {"sha256": "abc", "file": "a.tar.gz"}}},
+        {"builds": {ARCHITECTURE: {"sha256": "0" * 64, "file": "../a.tar.gz"}}},
+    ],
+)
+async def test_unusable_manifest(tmp_path, manifest):
+    (tmp_path / BUNDLE_MANIFEST).write_text(
+        manifest if isinstance(manifest, str) else json.dumps(manifest)
+    )
+    with pytest.raises(HAVSCodeDownloadException):
+        await LocalBundle(str(tmp_path)).pin(None, ARCHITECTURE)
@@ -0,0 +1,114 @@
+"""The content-addressed cache of CLI builds, in a temporary directory."""
+import json
+import os
+
+import pytest
+
+from custom_components.ha_vscode.cli_cache import CLICache
+from custom_components.ha_vscode.downloader import DownloadResult
+from tests.test_downloader import cliArchive
+
+URL = "https://update.code.visualstudio.com/latest/cli-alpine-x64/stable"
+
+
+class Upstream:
+    """Serves the last published build in place of CLIDownloader, and a 304 for
+    the one the cache asks about with If-None-Match."""
+
+    def __init__(self):
+        self.archive = None
+        self.etag = None
+
+    def publish(self, version):
+        self.archive = cliArchive(version)
+        self.etag = f'"{version}"'
+
+    async def stream(self, url, sink, progress=None, headers=None):
+        if (headers or {}).get("If-None-Match") == self.etag:
+            return None
+        await sink.start()
+        await sink.write(self.archive)
+        await sink.finish()
+        return DownloadResult(len(self.archive), self.etag, None, url)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return CLICache(str(tmp_path / "cli"), "cli-alpine-x64")
+
+
+@pytest.fixture
+def upstream():
+    return Upstream()
+
+
+def current(cache):
+    """The build the code symlink points at."""
+    return os.path.basename(os.path.dirname(os.path.realpath(cache.exePath)))
+
+
+def builds(cache):
+    return sorted(name for name in os.listdir(cache.directory) if len(name) == 64)
+
+
+async def test_adopt_legacy(tmp_path, cache):
+    legacy = tmp_path / "bin"
+    legacy.mkdir()
+    binary = legacy / "code"
+    binary.write_text("#!/bin/sh\necho 'code 1.2.3 (commit 0123abcd)'\n")
+    (legacy / "vscode_cli.tar.gz").write_bytes(b"")
+
+    build = await cache.migrate(str(legacy))
+    assert build["version"] == "1.2.3"
+    assert build["commit"] == "0123abcd"
+    assert build["etag"] is None
+    assert current(cache) == build["sha256"]
+    assert os.access(cache.exePath, os.X_OK)
+    # nothing is left where it was
+    assert not legacy.exists()
+
+    # and it is all in the manifest for the next start
+    with open(os.path.join(cache.directory, "manifest.json")) as manifest:
+        assert json.load(manifest)["current"] == build["sha256"]
+    again = CLICache(cache.directory, cache.architecture)
+    assert await again.migrate(str(legacy)) is None
+    assert again.current() == build
+
+
+async def test_stage_and_promote(cache, upstream):
+    upstream.publish("1.0.0")
+    old = await cache.fetch(upstream, URL)
+    assert old["version"] == "1.0.0"
+    assert current(cache) == old["sha256"]
+    # unchanged, so the server answers 304
+    assert await cache.fetch(upstream, URL) == old
+
+    upstream.publish("1.1.0")
+    new = await cache.fetch(upstream, URL, stage=True)
+    assert new["version"] == "1.1.0"
+    assert cache.staged() == new
+    # a running tunnel keeps the build it was started with
+    assert current(cache) == old["sha256"]
+    assert builds(cache) == sorted([old["sha256"], new["sha256"]])
+
+    assert await cache.promote() == new
+    assert current(cache) == new["sha256"]
+    assert cache.staged() is None
+    assert await cache.promote() is None
+
+
+async def test_keeps_the_build_before(cache, upstream):
+    fetched = []
+    for version in ("1.0.0", "1.1.0", "1.2.0"):
+        upstream.publish(version)
+        fetched.append(await cache.fetch(upstream, URL))
+    os.mkdir(os.path.join(cache.directory, "notes"))
+    upstream.publish("1.3.0")
+    fetched.append(await cache.fetch(upstream, URL))
+
+    kept = sorted(build["sha256"] for build in fetched[-2:])
+    assert builds(cache) == kept
+    assert sorted(cache.manifest["builds"]) == kept
+    assert current(cache) == fetched[-1]["sha256"]
+    # not one of ours, so not touched
+    assert os.path.isdir(os.path.join(cache.directory, "notes"))
@@ -0,0 +1,178 @@
+"""The options flow, with the tunnel's device standing in for the CLI."""
+from unittest.mock import AsyncMock
+from unittest.mock import patch
+
+from homeassistant.config_entries import SOURCE_USER
+from homeassistant.data_entry_flow import FlowResultType
+from homeassistant.helpers.storage import STORAGE_DIR
+from pytest_homeassistant_custom_component.common import MockConfigEntry
+import pytest
+
+from custom_components.ha_vscode.cli_cache import CLICache
+from custom_components.ha_vscode.config_flow import PROGRESS_DEVICE_CODE
+from custom_components.ha_vscode.config_flow import PROGRESS_DOWNLOAD
+from custom_components.ha_vscode.config_flow import PROGRESS_START
+from custom_components.ha_vscode.const import CLI_DIR
+from custom_components.ha_vscode.const import CONF_CLI_DATA_DIR
+from custom_components.ha_vscode.const import CONF_IDLE_TIMEOUT
+from custom_components.ha_vscode.const import CONF_SOURCES
+from custom_components.ha_vscode.const import CONF_TUNNEL_NAME
+from custom_components.ha_vscode.const import DOMAIN
+from custom_components.ha_vscode.const import NAME
+from custom_components.ha_vscode.const import TUNNELS_DIR
+from custom_components.ha_vscode.lifecycle import STATE_STARTING
+from custom_components.ha_vscode.lifecycle import STATE_STOPPED
+from custom_components.ha_vscode.lifecycle import STATE_STOPPING
+from custom_components.ha_vscode.manager import async_get_manager
+from custom_components.ha_vscode.vscode_device import AuthState
+from custom_components.ha_vscode.vscode_device import VSCodeDeviceAPI
+
+DEV_URL = "https://vscode.dev/tunnel/den"
+NOT_LOGGED_IN = AuthState(False, None, None, None, False)
+LOGGED_IN = AuthState(True, "github", "den", DEV_URL, False)
+
+
+@pytest.fixture(autouse=True)
+def auto_enable_custom_integrations(enable_custom_integrations):
+    yield
+
+
+@pytest.fixture
+def entry(hass):
+    entry = MockConfigEntry(
+        domain=DOMAIN,
+        unique_id="den",
+        title=NAME + " den",
+        data={
+            "token": "ABCD-1234",
+            "dev_url": DEV_URL,
+            "path": hass.config.path(STORAGE_DIR, DOMAIN, CLI_DIR),
+            "timeout": 42.0,
+            CONF_TUNNEL_NAME: "den",
+            CONF_CLI_DATA_DIR: hass.config.path(
+                STORAGE_DIR, DOMAIN, TUNNELS_DIR, "den"
+            ),
+            CONF_SOURCES: "http://mirror.lan/vscode-cli 20, upstream",
+        },
+    )
+    entry.add_to_hass(hass)
+    return entry
+
+
+@pytest.fixture
+async def device(hass, entry):
+    """The entry's device, held as the switch holds it."""
+    manager = async_get_manager(hass)
+    await manager.load()
+    device = manager.acquire(entry.entry_id, entry.data["path"])
+    yield device
+    await manager.release(entry.entry_id)
+
+
+async def test_options_wait_for_a_starting_tunnel(hass, entry, device):
+    # the switch just turned the tunnel on, it has not printed anything yet
+    device.lifecycle.advance(STATE_STARTING)
+    with patch.object(
+        device, "probeAuth", AsyncMock(return_value=NOT_LOGGED_IN)
+    ), patch.object(
+        device, "waitForAuth", AsyncMock(return_value=("WXYZ-9876", None))
+    ), patch.object(
+        device, "startTunnel"
+    ) as start, patch.object(
+        device, "stopTunnel"
+    ) as stop:
+        result = await hass.config_entries.options.async_init(entry.entry_id)
+        assert result["type"] == FlowResultType.FORM
+        assert result["step_id"] == "reauth"
+        assert result["description_placeholders"]["token"] == "WXYZ-9876"
+
+        hass.config_entries.options.async_abort(result["flow_id"])
+        await hass.async_block_till_done()
+        # the switch's tunnel is left as it was
+        start.assert_not_called()
+        stop.assert_not_called()
+    assert device.lifecycle.state == STATE_STARTING
+    device.lifecycle.advance(STATE_STOPPING)
+    device.lifecycle.advance(STATE_STOPPED)
+
+
+async def test_options_keep_what_the_setup_chose(hass, entry, device):
+    with patch.object(device, "probeAuth", AsyncMock(return_value=LOGGED_IN)):
+        result = await hass.config_entries.options.async_init(entry.entry_id)
+    assert result["type"] == FlowResultType.FORM
+    assert result["step_id"] == "user"
+    defaults = result["data_schema"]({})
+    assert defaults["timeout"] == entry.data["timeout"]
+    assert defaults[CONF_SOURCES] == entry.data[CONF_SOURCES]
+
+    result = await hass.config_entries.options.async_configure(
+        result["flow_id"], user_input={**defaults, CONF_IDLE_TIMEOUT: 15.0}
+    )
+    assert result["type"] == FlowResultType.CREATE_ENTRY
+    assert entry.options[CONF_IDLE_TIMEOUT] == 15.0
+    assert entry.options["timeout"] == entry.data["timeout"]
+    assert entry.options[CONF_SOURCES] == entry.data[CONF_SOURCES]
+
+
+async def progressed(hass, result):
+    """What the frontend does when a progress step's task is done."""
+    await hass.async_block_till_done()
+    return await hass.config_entries.flow.async_configure(result["flow_id"])
+
+
+async def test_closed_dialog_leaves_no_timings(hass):
+    manager = async_get_manager(hass)
+    with patch.object(CLICache, "fetch", AsyncMock(return_value=None)) as fetch:
+        result = await hass.config_entries.flow.async_init(
+            DOMAIN, context={"source": SOURCE_USER}
+        )
+        assert result["type"] == FlowResultType.FORM
+        assert result["step_id"] == "user"
+        await hass.async_block_till_done()
+        # the CLI is fetched while the user picks a name
+        fetch.assert_awaited_once()
+        # what would be saved to .storage
+        assert result["flow_id"] in manager._data()
+
+        hass.config_entries.flow.async_abort(result["flow_id"])
+        await hass.async_block_till_done()
+    assert result["flow_id"] not in manager._data()
+
+
+async def test_entry_takes_over_the_flows_tunnel(hass):
+    manager = async_get_manager(hass)
+    with patch.object(CLICache, "fetch", AsyncMock(return_value=None)), patch.object(
+        VSCodeDeviceAPI, "checkExe", AsyncMock()
+    ), patch.object(
+        VSCodeDeviceAPI, "asyncStartTunnel", autospec=True
+    ) as start, patch.object(
+        VSCodeDeviceAPI, "asyncStopTunnel", autospec=True
+    ) as stop, patch.object(
+        VSCodeDeviceAPI, "waitForAuth", AsyncMock(return_value=(None, DEV_URL))
+    ):
+        result = await hass.config_entries.flow.async_init(
+            DOMAIN, context={"source": SOURCE_USER}
+        )
+        result = await hass.config_entries.flow.async_configure(
+            result["flow_id"], {CONF_TUNNEL_NAME: "den"}
+        )
+        assert result["type"] == FlowResultType.SHOW_PROGRESS
+        # a step for each phase, until the tunnel printed the url
+        steps = []
+        while result["type"] == FlowResultType.SHOW_PROGRESS:
+            steps.append(result["progress_action"])
+            result = await progressed(hass, result)
+        assert steps == [PROGRESS_DOWNLOAD, PROGRESS_START, PROGRESS_DEVICE_CODE]
+        assert result["type"] == FlowResultType.CREATE_ENTRY
+        (entry,) = hass.config_entries.async_entries(DOMAIN)
+        (device,) = [call.args[0] for call in start.call_args_list]
+        # the tunnel the flow started is the entry's, nothing stopped it
+        assert manager.get(entry.entry_id) is device
+        assert manager.get(result["flow_id"]) is None
+        stop.assert_not_called()
+
+        # the switch is the one holding it now
+        assert await hass.config_entries.async_unload(entry.entry_id)
+        await hass.async_block_till_done()
+        assert manager.get(entry.entry_id) is None
+        assert [call.args[0] for call in stop.call_args_list] == [device]
@@ -0,0 +1,46 @@
+"""Diagnostics leave out the tunnel's name and address."""
+import json
+
+from homeassistant.helpers.storage import STORAGE_DIR
+from pytest_homeassistant_custom_component.common import MockConfigEntry
+import pytest
+
+from custom_components.ha_vscode.const import CLI_DIR
+from custom_components.ha_vscode.const import CONF_CLI_DATA_DIR
+from custom_components.ha_vscode.const import CONF_TUNNEL_NAME
+from custom_components.ha_vscode.const import DOMAIN
+from custom_components.ha_vscode.const import NAME
+from custom_components.ha_vscode.const import TUNNELS_DIR
+from custom_components.ha_vscode.diagnostics import (
+    async_get_config_entry_diagnostics,
+)
+
+TUNNEL_NAME = "secret-den"
+
+
+@pytest.fixture(autouse=True)
+def auto_enable_custom_integrations(enable_custom_integrations):
+    yield
+
+
+async def test_tunnel_name_redacted(hass):
+    entry = MockConfigEntry(
+        domain=DOMAIN,
+        unique_id=TUNNEL_NAME,
+        title=NAME + " " + TUNNEL_NAME,
+        data={
+            "token": "ABCD-1234",
+            "dev_url": "https://vscode.dev/tunnel/" + TUNNEL_NAME,
+            "path": hass.config.path(STORAGE_DIR, DOMAIN, CLI_DIR),
+            CONF_TUNNEL_NAME: TUNNEL_NAME,
+            CONF_CLI_DATA_DIR: hass.config.path(
+                STORAGE_DIR, DOMAIN, TUNNELS_DIR, TUNNEL_NAME
+            ),
+        },
+    )
+    entry.add_to_hass(hass)
+
+    diagnostics = await async_get_config_entry_diagnostics(hass, entry)
+    assert TUNNEL_NAME not in json.dumps(diagnostics)
+    assert "ABCD-1234" not in json.dumps(diagnostics)
+    assert diagnostics["entry"]["domain"] == DOMAIN
@@ -0,0 +1,237 @@
+"""CLIDownloader against a local stand-in for the CLI download server."""
+import datetime
+import io
+import os
+import ssl
+import tarfile
+
+import aiohttp
+from aiohttp import web
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+import pytest
+
+from custom_components.ha_vscode.cli_cache import CLICache
+from custom_components.ha_vscode.downloader import CLIDownloader
+from custom_components.ha_vscode.exceptions import HAVSCodeDownloadException
+
+DATA = bytes(range(256)) * 1024
+
+
+def cliArchive(version):
+    """A .tar.gz whose `code` answers --version, padded so it takes a few chunks."""
+    script = f"#!/bin/sh\necho 'code {version} (commit 0123abcd)'\nexit 0\n"
+    payload = script.encode() + os.urandom(256 * 1024)
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        info = tarfile.TarInfo("code")
+        info.size = len(payload)
+        info.mode = 0o755
+        tar.addfile(info, io.BytesIO(payload))
+    return buffer.getvalue()
+
+
+class Origin:
+    """Serves data with an ETag, honours Range and If-Range, and can drop the
+    connection part way through the next response."""
+
+    def __init__(self, data=DATA, etag='"v1"'):
+        self.data = data
+        self.etag = etag
+        # bytes of the next response to send before hanging up
+        self.dropAfter = None
+        # called after the drop, e.g. to publish a new build
+        self.afterDrop = None
+        self.requests = []
+
+    async def handle(self, request):
+        self.requests.append(dict(request.headers))
+        if request.headers.get("If-None-Match") == self.etag:
+            return web.Response(status=304, headers={"ETag": self.etag})
+        start = 0
+        ranged = request.headers.get("Range")
+        if ranged and request.headers.get("If-Range", self.etag) == self.etag:
+            start = int(ranged[len("bytes=") : -len("-")])
+        body = self.data[start:]
+        headers = {"ETag": self.etag}
+        if start:
+            headers[
+                "Content-Range"
+            ] = f"bytes {start}-{len(self.data) - 1}/{len(self.data)}"
+        response = web.StreamResponse(status=206 if start else 200, headers=headers)
+        response.content_length = len(body)
+        await response.prepare(request)
+        if self.dropAfter is not None:
+            await response.write(body[: self.dropAfter])
+            self.dropAfter = None
+            request.transport.close()
+            if self.afterDrop:
+                self.afterDrop()
+            return response
+        await response.write(body)
+        await response.write_eof()
+        return response
+
+
+@pytest.fixture
+def origin():
+    return Origin()
+
+
+@pytest.fixture
+async def url(aiohttp_server, socket_enabled, origin):
+    app = web.Application()
+    app.router.add_get("/cli", origin.handle)
+    server = await aiohttp_server(app)
+    return str(server.make_url("/cli"))
+
+
+async def test_download(tmp_path, origin, url):
+    outfile = tmp_path / "cli"
+    progress = []
+    result = await CLIDownloader().download(
+        url, str(outfile), lambda received, total: progress.append((received, total))
+    )
+    assert outfile.read_bytes() == DATA
+    assert result.received == len(DATA)
+    assert result.etag == '"v1"'
+    assert progress[-1] == (len(DATA), len(DATA))
+
+
+async def test_resume_after_drop(tmp_path, origin, url):
+    origin.dropAfter = len(DATA) // 3
+    outfile = tmp_path / "cli"
+    result = await CLIDownloader(chunk_size=4096).download(url, str(outfile))
+    assert outfile.read_bytes() == DATA
+    assert result.received == len(DATA)
+    assert len(origin.requests) == 2
+    resumed = origin.requests[1]
+    received = int(resumed["Range"][len("bytes=") : -len("-")])
+    assert 0 < received <= len(DATA) // 3
+    assert resumed["If-Range"] == '"v1"'
+
+
+async def test_restart_when_validator_changed(tmp_path, origin, url):
+    new = bytes(reversed(DATA))
+
+    def publish():
+        origin.data = new
+        origin.etag = '"v2"'
+
+    origin.dropAfter = len(DATA) // 3
+    origin.afterDrop = publish
+    outfile = tmp_path / "cli"
+    result = await CLIDownloader(chunk_size=4096).download(url, str(outfile))
+    # the server answered the stale If-Range with the whole new file
+    assert outfile.read_bytes() == new
+    assert result.received == len(new)
+    assert result.etag == '"v2"'
+    assert origin.requests[1]["If-Range"] == '"v1"'
+
+
+async def test_not_modified(tmp_path, origin, url):
+    outfile = tmp_path / "cli"
+    result = await CLIDownloader().download(
+        url, str(outfile), headers={"If-None-Match": '"v1"'}
+    )
+    assert result is None
+    assert outfile.read_bytes() == b""
+    assert len(origin.requests) == 1
+
+
+async def test_gives_up(tmp_path, url):
+    with pytest.raises(HAVSCodeDownloadException):
+        await CLIDownloader(retries=0).download(url + "/missing", str(tmp_path / "cli"))
+
+
+def _selfSigned(directory):
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(
+            x509.SubjectAlternativeName([x509.DNSName("localhost")]), critical=False
+        )
+        .sign(key, hashes.SHA256())
+    )
+    certfile = directory / "cert.pem"
+    keyfile = directory / "key.pem"
+    certfile.write_bytes(cert.public_bytes(serialization.Encoding.PEM))
+    keyfile.write_bytes(
+        key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        )
+    )
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(certfile, keyfile)
+    return context
+
+
+async def test_untrusted_certificate(tmp_path, aiohttp_server, socket_enabled, origin):
+    app = web.Application()
+    app.router.add_get("/cli", origin.handle)
+    server = await aiohttp_server(app, ssl=_selfSigned(tmp_path))
+    attempts = []
+
+    async def onRequestStart(session, context, params):
+        attempts.append(params.url)
+
+    trace = aiohttp.TraceConfig()
+    trace.on_request_start.append(onRequestStart)
+    async with aiohttp.ClientSession(trace_configs=[trace]) as session:
+        with pytest.raises(HAVSCodeDownloadException) as err:
+            await CLIDownloader(session).download(
+                str(server.make_url("/cli")), str(tmp_path / "cli")
+            )
+    assert isinstance(err.value.__cause__, aiohttp.ClientSSLError)
+    # not retried, it would fail the same way
+    assert len(attempts) == 1
+    assert origin.requests == []
+
+
+async def test_cache_resumes_extraction(tmp_path, origin, url):
+    origin.data = cliArchive("1.2.3")
+    origin.dropAfter = len(origin.data) // 2
+    cache = CLICache(str(tmp_path / "cli"), "cli-alpine-x64")
+    build = await cache.fetch(CLIDownloader(chunk_size=4096), url)
+    assert build["version"] == "1.2.3"
+    assert build["etag"] == '"v1"'
+    assert os.access(cache.exePath, os.X_OK)
+    assert "Range" in origin.requests[1]
+
+    # and the next fetch is a conditional one
+    assert await cache.fetch(CLIDownloader(), url) == build
+    assert origin.requests[2]["If-None-Match"] == '"v1"'
+    assert sorted(os.listdir(tmp_path / "cli")) == sorted(
+        [build["sha256"], "code", "manifest.json"]
+    )
+
+
+async def test_cache_restarts_extraction(tmp_path, origin, url):
+    new = cliArchive("1.2.4")
+
+    def publish():
+        origin.data = new
+        origin.etag = '"v2"'
+
+    origin.data = cliArchive("1.2.3")
+    origin.dropAfter = len(origin.data) // 2
+    origin.afterDrop = publish
+    cache = CLICache(str(tmp_path / "cli"), "cli-alpine-x64")
+    build = await cache.fetch(CLIDownloader(chunk_size=4096), url)
+    assert build["version"] == "1.2.4"
+    assert build["etag"] == '"v2"'
+    # nothing of the first attempt is left behind
+    assert not [name for name in os.listdir(tmp_path / "cli") if name.startswith(".")]
@@ -0,0 +1,265 @@
+"""The tunnel helper and HelperDeviceAPI, against the fake code CLI.
+
+The helper runs in this process, on this loop, except where the test is about
+the helper process itself.
+"""
+import asyncio
+import json
+import os
+import struct
+
+import pytest
+import pytest_socket
+
+from custom_components.ha_vscode.exceptions import HAVSCodeHelperException
+from custom_components.ha_vscode.helper import HELPER_SOCKET
+from custom_components.ha_vscode.helper import HelperDeviceAPI
+from custom_components.ha_vscode.helper import HelperProtocolError
+from custom_components.ha_vscode.helper import MAX_FRAME
+from custom_components.ha_vscode.helper import readFrame
+from custom_components.ha_vscode.helper import TunnelHelper
+from custom_components.ha_vscode.helper import writeFrame
+from custom_components.ha_vscode.lifecycle import route
+from custom_components.ha_vscode.lifecycle import STATE_FAILED
+from custom_components.ha_vscode.lifecycle import STATE_RUNNING
+from custom_components.ha_vscode.lifecycle import STATE_STOPPED
+from custom_components.ha_vscode.supervisor import CIRCUIT_CLOSED
+from custom_components.ha_vscode.supervisor import CIRCUIT_OPEN
+from custom_components.ha_vscode.vscode_device import VSCodeDeviceAPI
+
+FAKE_CODE = os.path.join(
+    os.path.dirname(__file__), os.pardir, "benchmarks", "fake_code.py"
+)
+URL = "https://vscode.dev/tunnel/den/"
+
+
+class Sink:
+    """The write end of a stream."""
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+
+
+def stream(data):
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    reader.feed_eof()
+    return reader
+
+
+async def waitFor(predicate, timeout=5.0):
+    for _ in range(int(timeout / 0.01)):
+        if predicate():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("timed out")
+
+
+async def send(path, op):
+    """A request over a connection of its own."""
+    reader, writer = await asyncio.open_unix_connection(path)
+    writeFrame(writer, {"id": 7, "op": op})
+    answer = await readFrame(reader)
+    writer.close()
+    await writer.wait_closed()
+    return answer
+
+
+def settle(device):
+    # what a stop would have reported to a client that is gone
+    for step in route(device.lifecycle.state, STATE_STOPPED) or ():
+        device.lifecycle.advance(step)
+
+
+async def test_frames():
+    messages = [{"id": 1, "op": "status"}, {"event": "line", "at": 1.5, "line": "ü"}]
+    sink = Sink()
+    for message in messages:
+        writeFrame(sink, message)
+    body = b'{"id":1,"op":"status"}'
+    assert bytes(sink.data[: 4 + len(body)]) == struct.pack("!I", len(body)) + body
+
+    reader = stream(bytes(sink.data))
+    assert [await readFrame(reader) for _ in messages] == messages
+    assert await readFrame(reader) is None
+
+
+@pytest.mark.parametrize(
+    "data, error",
+    [
+        (b"\x00\x00", "inside a frame header"),
+        (struct.pack("!I", 10) + b"{}", "inside a frame"),
+        (struct.pack("!I", MAX_FRAME + 1), "too large"),
+        (struct.pack("!I", 3) + b"{{{", "not JSON"),
+    ],
+)
+async def test_bad_frames(data, error):
+    with pytest.raises(HelperProtocolError, match=error):
+        await readFrame(stream(data))
+
+
+@pytest.fixture
+def unix_sockets():
+    # they can be created during tests, but not connected to
+    pytest_socket.socket_allow_hosts(["127.0.0.1"], allow_unix_socket=True)
+    yield
+    pytest_socket.socket_allow_hosts(["127.0.0.1"])
+
+
+@pytest.fixture
+def script(tmp_path, monkeypatch):
+    """Writes what the fake CLI does next."""
+    path = tmp_path / "script.json"
+    monkeypatch.setenv("FAKE_CODE_SCRIPT", str(path))
+
+    def write(**config):
+        path.write_text(json.dumps({"name": "den", **config}))
+        if "crash_after" in config:
+            (tmp_path / "script.json.crash").write_text("")
+
+    write()
+    return write
+
+
+@pytest.fixture
+async def helper(tmp_path, script, unix_sockets):
+    """The helper's device, served on tmp_path/helper.sock."""
+    device = VSCodeDeviceAPI(str(tmp_path / "helper"), stopGrace=0.2)
+    device.exePath = FAKE_CODE
+    device.supervisor.delay = lambda attempt: 0
+    server = TunnelHelper(device, str(tmp_path / HELPER_SOCKET))
+    serving = asyncio.get_running_loop().create_task(server.serve())
+    await waitFor(lambda: os.path.exists(server.path))
+    device.serving = serving
+    yield device
+    if not serving.done():
+        await send(server.path, "shutdown")
+    await asyncio.gather(serving, return_exceptions=True)
+    await device.asyncSetDesired(False)
+    await device.asyncClose()
+
+
+@pytest.fixture
+async def client(tmp_path):
+    """Makes HelperDeviceAPIs for the helper at tmp_path/helper.sock."""
+    clients = []
+
+    def make():
+        device = HelperDeviceAPI(str(tmp_path), str(tmp_path))
+        device.exePath = FAKE_CODE
+        device.record.update(tunnelName="den")
+        clients.append(device)
+        return device
+
+    yield make
+    for device in clients:
+        await device.asyncDetach()
+        await device.asyncClose()
+        settle(device)
+
+
+async def test_start_and_reattach(helper, client):
+    first = client()
+    await first.asyncSetDesired(True)
+    assert await first.getDevURL(5) == URL
+    assert helper.lifecycle.state == STATE_RUNNING
+    assert first.pid == helper.pid is not None
+
+    # Home Assistant restarts, the tunnel does not
+    await first.asyncDetach()
+    assert helper.lifecycle.state == STATE_RUNNING
+    second = client()
+    await second.asyncAttach()
+    assert second.lifecycle.state == STATE_RUNNING
+    assert second.desired is True
+    assert second.pid == helper.pid
+    assert await second.getDevURL(0.1) == URL
+    assert second.record.devURL == helper.record.devURL
+    assert second.output.snapshot() == helper.output.snapshot()
+
+    await second.asyncSetDesired(False)
+    assert helper.lifecycle.state == STATE_STOPPED
+    assert second.lifecycle.state == STATE_STOPPED
+
+
+async def test_crash_is_restarted_by_the_helper(helper, client, script):
+    script(crash_after=0.05)
+    device = client()
+    stats = []
+    device.supervisor.addListener(lambda: stats.append(device.supervisor.stats()))
+    await device.asyncSetDesired(True)
+    await waitFor(lambda: helper.supervisor.restarts == 1)
+    await waitFor(lambda: device.lifecycle.state == STATE_RUNNING)
+    assert device.pid == helper.pid
+    # the helper's count, which nobody on this side reset
+    assert device.supervisor.stats() == helper.supervisor.stats()
+    assert stats[-1]["restarts"] == 1
+    assert stats[-1]["consecutive_failures"] == 1
+
+
+async def test_open_circuit_is_left_alone(helper, client, script):
+    helper.supervisor.maxRestarts = 0
+    helper.supervisor.cooldown = 60
+    script(crash_after=0.05)
+    device = client()
+    await device.asyncSetDesired(True)
+    await waitFor(lambda: device.supervisor.stats()["circuit"] == CIRCUIT_OPEN)
+    assert device.lifecycle.state == STATE_FAILED
+    # longer than a first restart would wait on this side
+    await asyncio.sleep(1.1)
+    assert helper.lifecycle.state == STATE_FAILED
+    assert helper.supervisor.circuit == CIRCUIT_OPEN
+    assert helper.supervisor.failures == 1
+
+    # a start by hand still closes it
+    await device.asyncSetDesired(True)
+    await waitFor(lambda: device.lifecycle.state == STATE_RUNNING)
+    assert device.supervisor.stats()["circuit"] == CIRCUIT_CLOSED
+
+
+async def test_helper_goes_away(helper, client):
+    device = client()
+    await device.asyncSetDesired(True)
+    await device.getDevURL(5)
+    helper.serving.cancel()
+    await waitFor(lambda: device.lifecycle.state == STATE_FAILED)
+    assert device.pid is None
+
+
+async def test_unregister_stops_the_tunnel_in_the_helper(helper, client):
+    device = client()
+    await device.asyncSetDesired(True)
+    await device.getDevURL(5)
+    await device.asyncUnregisterTunnel()
+    assert helper.lifecycle.state == STATE_STOPPED
+    assert device.lifecycle.state == STATE_STOPPED
+
+
+async def test_unknown_op(helper):
+    answer = await send(
+        os.path.join(os.path.dirname(helper.storage_dir), HELPER_SOCKET), "dance"
+    )
+    assert answer == {"id": 7, "error": "unknown op dance"}
+
+
+async def test_helper_process_runs_without_home_assistant(
+    tmp_path, monkeypatch, unix_sockets
+):
+    # a Home Assistant that can't be imported
+    poisoned = tmp_path / "poisoned" / "homeassistant"
+    poisoned.mkdir(parents=True)
+    (poisoned / "__init__.py").write_text("raise ImportError('not in the helper')")
+    monkeypatch.setenv("PYTHONPATH", str(poisoned.parent))
+    device = HelperDeviceAPI(str(tmp_path), str(tmp_path))
+    try:
+        await device.asyncAttach()
+    except HAVSCodeHelperException:
+        log = tmp_path / "helper.log"
+        pytest.fail(log.read_text() if log.exists() else "the helper did not start")
+    assert device.lifecycle.state == STATE_STOPPED
+    await device.asyncClose()
+    # the helper removes its socket on the way out
+    await waitFor(lambda: not os.path.exists(device.socketPath))
@@ -0,0 +1,126 @@
+"""Idle suspend and resume, against a stand-in device."""
+import asyncio
+from unittest.mock import AsyncMock
+
+import pytest
+
+from custom_components.ha_vscode.idle import IDLE_OFF
+from custom_components.ha_vscode.idle import IDLE_SERVER
+from custom_components.ha_vscode.idle import IDLE_TUNNEL
+from custom_components.ha_vscode.idle import IdlePolicy
+from custom_components.ha_vscode.lifecycle import STATE_RUNNING
+from custom_components.ha_vscode.lifecycle import STATE_STARTING
+from custom_components.ha_vscode.lifecycle import STATE_STOPPED
+from custom_components.ha_vscode.lifecycle import STATE_STOPPING
+from custom_components.ha_vscode.lifecycle import TunnelLifecycle
+from custom_components.ha_vscode.tunnel_output import TunnelOutputParser
+
+TIMEOUT = 0.02
+RELAY = "[2023-07-21 14:05:30] info [tunnels::connections::relay_tunnel_host] "
+
+
+class Device:
+    """What the policy needs of VSCodeDeviceAPI."""
+
+    def __init__(self):
+        self.parser = TunnelOutputParser()
+        self.lifecycle = TunnelLifecycle()
+        self.asyncStopServer = AsyncMock()
+        self.asyncSetDesired = AsyncMock(side_effect=self._setDesired)
+
+    async def _setDesired(self, running):
+        for state in (
+            (STATE_STARTING, STATE_RUNNING)
+            if running
+            else (STATE_STOPPING, STATE_STOPPED)
+        ):
+            self.lifecycle.advance(state)
+
+    def connect(self, channel):
+        self.parser.feed(RELAY + "Opened new client on channel " + channel)
+
+    def disconnect(self, channel):
+        self.parser.feed(RELAY + "Closed client on channel " + channel)
+
+
+@pytest.fixture
+async def device():
+    device = Device()
+    yield device
+    await device.asyncSetDesired(False)
+
+
+def running(device, mode):
+    policy = IdlePolicy(device)
+    policy.configure(mode, TIMEOUT)
+    device.lifecycle.advance(STATE_STARTING)
+    device.lifecycle.advance(STATE_RUNNING)
+    return policy
+
+
+async def idle():
+    await asyncio.sleep(TIMEOUT * 3)
+
+
+async def test_off(device):
+    policy = running(device, IDLE_OFF)
+    await idle()
+    assert policy.stats()["idle_since"] is not None
+    assert policy.suspended is None
+    device.asyncStopServer.assert_not_awaited()
+    device.asyncSetDesired.assert_not_awaited()
+
+
+async def test_server(device):
+    policy = running(device, IDLE_SERVER)
+    await idle()
+    device.asyncStopServer.assert_awaited_once()
+    assert policy.suspended == IDLE_SERVER
+    # the tunnel stays up for the next client, which gets a new server
+    assert device.lifecycle.state == STATE_RUNNING
+    device.connect("2")
+    assert policy.suspended is None
+    assert policy.stats()["clients"] == 1
+
+
+async def test_tunnel_and_resume(device):
+    policy = running(device, IDLE_TUNNEL)
+    changes = []
+    policy.addListener(lambda: changes.append(policy.stats()))
+    await idle()
+    device.asyncSetDesired.assert_awaited_once_with(False)
+    assert device.lifecycle.state == STATE_STOPPED
+    assert changes[-1]["suspended"] == IDLE_TUNNEL
+
+    await policy.resume()
+    device.asyncSetDesired.assert_awaited_with(True)
+    assert device.lifecycle.state == STATE_RUNNING
+    assert policy.suspended is None
+
+
+async def test_not_while_connected(device):
+    policy = running(device, IDLE_TUNNEL)
+    device.connect("2")
+    device.connect("3")
+    device.disconnect("2")
+    await idle()
+    assert policy.stats() == {"clients": 1, "idle_since": None, "suspended": None}
+    device.asyncSetDesired.assert_not_awaited()
+
+    # the last one gone, the countdown starts
+    device.disconnect("3")
+    assert policy.stats()["idle_since"] is not None
+    await idle()
+    assert policy.suspended == IDLE_TUNNEL
+
+
+async def test_resume_does_nothing_unless_suspended(device):
+    policy = running(device, IDLE_SERVER)
+    device.connect("2")
+    await policy.resume()
+    device.asyncSetDesired.assert_not_awaited()
+
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        IdlePolicy(Device()).configure("sometimes", TIMEOUT)
@@ -0,0 +1,38 @@
+"""The TunnelManager keeps the tunnel records across restarts."""
+from unittest.mock import patch
+
+from pytest_homeassistant_custom_component.common import async_fire_time_changed
+
+from custom_components.ha_vscode.manager import async_get_manager
+from custom_components.ha_vscode.manager import RECORDS_STORAGE_KEY
+from custom_components.ha_vscode.manager import SAVE_DELAY
+
+
+async def test_record_updates_are_saved_once(hass, hass_storage, freezer, tmp_path):
+    manager = async_get_manager(hass)
+    await manager.load()
+    device = manager.acquire("entry", str(tmp_path))
+    with patch.object(manager, "_recordData", wraps=manager._recordData) as data:
+        for url in ("https://vscode.dev/tunnel/a", "https://vscode.dev/tunnel/b"):
+            device.record.update(devURL=url, tunnelName=url[-1])
+        device.record.update(authenticated=True, provider="github")
+        await hass.async_block_till_done()
+        assert RECORDS_STORAGE_KEY not in hass_storage
+
+        freezer.tick(SAVE_DELAY - 1)
+        async_fire_time_changed(hass)
+        await hass.async_block_till_done()
+        assert RECORDS_STORAGE_KEY not in hass_storage
+
+        freezer.tick(2)
+        async_fire_time_changed(hass)
+        await hass.async_block_till_done()
+        data.assert_called_once()
+
+    stored = hass_storage[RECORDS_STORAGE_KEY]["data"]["entry"]
+    assert stored["devURL"] == "https://vscode.dev/tunnel/b"
+    assert stored["tunnelName"] == "b"
+    assert stored["provider"] == "github"
+    # and a warm start gets it back
+    assert manager.record("entry")["authenticated"] is True
+    await manager.release("entry")
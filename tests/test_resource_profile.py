@@ -0,0 +1,142 @@
+"""Priority and limits of a spawned child, and a cgroup in a fake hierarchy."""
+import json
+import os
+import resource
+import subprocess
+import sys
+
+import pytest
+
+from custom_components.ha_vscode import resource_profile
+from custom_components.ha_vscode.const import CONF_CGROUP
+from custom_components.ha_vscode.const import CONF_CPU_MAX
+from custom_components.ha_vscode.const import CONF_IO_CLASS
+from custom_components.ha_vscode.const import CONF_MAX_FILES
+from custom_components.ha_vscode.const import CONF_MEMORY_LIMIT
+from custom_components.ha_vscode.const import CONF_MEMORY_MAX
+from custom_components.ha_vscode.const import CONF_NICE
+from custom_components.ha_vscode.resource_profile import IO_CLASS_IDLE
+from custom_components.ha_vscode.resource_profile import IO_CLASS_LOW
+from custom_components.ha_vscode.resource_profile import MIB
+from custom_components.ha_vscode.resource_profile import ResourceProfile
+
+# ioprio_get, next to the ioprio_set numbers the module knows
+_SYS_IOPRIO_GET = {"x86_64": 252, "aarch64": 31, "armv7l": 315, "i686": 290}
+
+# what the child sees of itself
+REPORT = """
+import ctypes, json, os, resource, sys
+number = int(sys.argv[1])
+ioprio = ctypes.CDLL(None).syscall(number, 1, 0) if number else None
+print(json.dumps({
+    "nice": os.nice(0),
+    "as": resource.getrlimit(resource.RLIMIT_AS),
+    "nofile": resource.getrlimit(resource.RLIMIT_NOFILE),
+    "ioprio": ioprio,
+}))
+"""
+
+
+def spawn(profile):
+    number = _SYS_IOPRIO_GET.get(os.uname().machine, 0)
+    out = subprocess.run(
+        [sys.executable, "-c", REPORT, str(number)],
+        preexec_fn=profile.preexec(),
+        check=True,
+        stdout=subprocess.PIPE,
+    ).stdout
+    return json.loads(out)
+
+
+def test_nothing_to_do():
+    assert ResourceProfile().preexec() is None
+    assert ResourceProfile.fromOptions({}) == ResourceProfile()
+
+
+def test_from_options():
+    options = {
+        CONF_NICE: 10,
+        CONF_IO_CLASS: IO_CLASS_IDLE,
+        CONF_MEMORY_LIMIT: 2048,
+        CONF_MAX_FILES: 512,
+        CONF_CGROUP: True,
+        CONF_CPU_MAX: 50,
+        CONF_MEMORY_MAX: 0,
+    }
+    assert ResourceProfile.fromOptions(options) == ResourceProfile(
+        nice=10,
+        ioClass=IO_CLASS_IDLE,
+        memoryLimit=2048 * MIB,
+        maxFiles=512,
+        cgroup=True,
+        cpuMax=50,
+        memoryMax=None,
+    )
+
+
+def test_child_gets_the_profile():
+    own = spawn(ResourceProfile())
+    profile = ResourceProfile(
+        nice=5, ioClass=IO_CLASS_LOW, memoryLimit=4096 * MIB, maxFiles=256
+    )
+    child = spawn(profile)
+    assert child["nice"] == min(own["nice"] + 5, 19)
+    assert child["as"] == [4096 * MIB, 4096 * MIB]
+    assert child["nofile"] == [256, 256]
+    if child["ioprio"] is not None:
+        assert child["ioprio"] == 2 << 13 | 7
+    # the parent is left alone
+    assert os.nice(0) == own["nice"]
+    assert resource.getrlimit(resource.RLIMIT_NOFILE) == tuple(own["nofile"])
+
+
+def test_limits_stay_below_the_hard_limit():
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY:
+        pytest.skip("no hard limit on open files")
+    child = spawn(ResourceProfile(maxFiles=hard * 2))
+    assert child["nofile"] == [hard, hard]
+
+
+@pytest.fixture
+def hierarchy(tmp_path, monkeypatch):
+    """A cgroup2 mount at tmp_path in which we are in /ha."""
+    parent = tmp_path / "ha"
+    parent.mkdir()
+    (parent / "cgroup.controllers").write_text("cpu memory io\n")
+    (parent / "cgroup.subtree_control").write_text("")
+    monkeypatch.setattr(resource_profile, "CGROUP_ROOT", str(tmp_path))
+    monkeypatch.setattr(resource_profile, "_ownCgroup", lambda: "/ha")
+    return parent
+
+
+def test_cgroup(hierarchy):
+    profile = ResourceProfile(cgroup=True, cpuMax=50, memoryMax=256 * MIB)
+    group = profile.placeInCgroup(1234)
+    assert group == str(hierarchy / "ha_vscode")
+    assert (hierarchy / "cgroup.subtree_control").read_text() == "+cpu +memory"
+    assert (hierarchy / "ha_vscode" / "cpu.max").read_text() == "50000 100000"
+    assert (hierarchy / "ha_vscode" / "memory.max").read_text() == str(256 * MIB)
+    assert (hierarchy / "ha_vscode" / "cgroup.procs").read_text() == "1234"
+
+
+def test_cgroup_without_controllers(hierarchy):
+    # what the kernel does while the parent has processes of its own
+    (hierarchy / "cgroup.subtree_control").unlink()
+    (hierarchy / "cgroup.subtree_control").mkdir()
+    group = ResourceProfile(cgroup=True, cpuMax=50).placeInCgroup(1234)
+    # moved all the same, just without limits
+    assert (hierarchy / "ha_vscode" / "cgroup.procs").read_text() == "1234"
+    assert not (hierarchy / "ha_vscode" / "cpu.max").exists()
+    assert group == str(hierarchy / "ha_vscode")
+
+
+def test_not_a_cgroup2_group(hierarchy):
+    (hierarchy / "cgroup.controllers").unlink()
+    assert ResourceProfile(cgroup=True).placeInCgroup(1234) is None
+    assert not (hierarchy / "ha_vscode").exists()
+
+
+def test_cgroup_off(hierarchy):
+    assert ResourceProfile(cpuMax=50).placeInCgroup(1234) is None
+    assert not (hierarchy / "ha_vscode").exists()
@@ -0,0 +1,61 @@
+"""Sensors of the tunnel, set up from a config entry."""
+from homeassistant.helpers.storage import STORAGE_DIR
+from pytest_homeassistant_custom_component.common import MockConfigEntry
+import pytest
+
+from custom_components.ha_vscode.const import CLI_DIR
+from custom_components.ha_vscode.const import CONF_TUNNEL_NAME
+from custom_components.ha_vscode.const import DOMAIN
+from custom_components.ha_vscode.const import NAME
+from custom_components.ha_vscode.manager import async_get_manager
+
+
+@pytest.fixture(autouse=True)
+def auto_enable_custom_integrations(enable_custom_integrations):
+    yield
+
+
+async def setUp(hass, **data):
+    entry = MockConfigEntry(
+        domain=DOMAIN,
+        unique_id=data.get(CONF_TUNNEL_NAME),
+        title=" ".join(filter(None, (NAME, data.get(CONF_TUNNEL_NAME)))),
+        data={
+            "token": "ABCD-1234",
+            "dev_url": "https://vscode.dev/tunnel/den",
+            "path": hass.config.path(STORAGE_DIR, DOMAIN, CLI_DIR),
+            **data,
+        },
+    )
+    entry.add_to_hass(hass)
+    assert await hass.config_entries.async_setup(entry.entry_id)
+    await hass.async_block_till_done()
+    return entry
+
+
+async def test_unload_releases_the_tunnel(hass):
+    entry = await setUp(hass)
+    assert hass.states.get("sensor.vscode_tunnel_cpu") is not None
+    # the disabled sensors are never added, they must not hold the tunnel either
+    assert await hass.config_entries.async_unload(entry.entry_id)
+    await hass.async_block_till_done()
+    assert async_get_manager(hass).get(entry.entry_id) is None
+
+
+async def test_names_per_tunnel(hass):
+    entries = [
+        await setUp(
+            hass,
+            **{CONF_TUNNEL_NAME: name, "dev_url": "https://vscode.dev/tunnel/" + name},
+        )
+        for name in ("den", "garage")
+    ]
+    names = sorted(
+        state.name
+        for state in hass.states.async_all("sensor")
+        if state.name.endswith(" CPU")
+    )
+    assert names == ["VSCode Tunnel den CPU", "VSCode Tunnel garage CPU"]
+    for entry in entries:
+        assert await hass.config_entries.async_unload(entry.entry_id)
+    await hass.async_block_till_done()
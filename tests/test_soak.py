@@ -0,0 +1,22 @@
+"""A short run of the soak harness, through the switch entity."""
+import importlib
+import os
+
+import pytest
+
+BENCHMARKS = os.path.join(os.path.dirname(__file__), os.pardir, "benchmarks")
+
+
+@pytest.fixture
+def soak(monkeypatch):
+    monkeypatch.syspath_prepend(BENCHMARKS)
+    # the harness points the fake cli at its script through the environment
+    monkeypatch.setenv("FAKE_CODE_SCRIPT", "")
+    return importlib.import_module("soak")
+
+
+def test_every_scenario(soak, capsys):
+    cycles = str(len(soak.SCENARIOS))
+    assert (
+        soak.main(["--cycles", cycles, "--warmup", "2", "--switch"]) == 0
+    ), capsys.readouterr().out
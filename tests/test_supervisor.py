@@ -0,0 +1,145 @@
+"""Restarts with backoff, and the circuit breaker, against a stand-in device."""
+import asyncio
+
+import pytest
+
+from custom_components.ha_vscode.lifecycle import STATE_FAILED
+from custom_components.ha_vscode.lifecycle import STATE_RUNNING
+from custom_components.ha_vscode.lifecycle import STATE_STARTING
+from custom_components.ha_vscode.lifecycle import STATE_STOPPED
+from custom_components.ha_vscode.lifecycle import STATE_STOPPING
+from custom_components.ha_vscode.lifecycle import TunnelLifecycle
+from custom_components.ha_vscode.supervisor import backoff
+from custom_components.ha_vscode.supervisor import CIRCUIT_CLOSED
+from custom_components.ha_vscode.supervisor import CIRCUIT_HALF_OPEN
+from custom_components.ha_vscode.supervisor import CIRCUIT_OPEN
+from custom_components.ha_vscode.supervisor import TunnelSupervisor
+from custom_components.ha_vscode.timing import PHASE_RECOVERY
+from custom_components.ha_vscode.timing import PhaseTimings
+
+
+class Device:
+    """What the supervisor needs of VSCodeDeviceAPI. The next `crashes` starts
+    fail right away, the ones after that come up."""
+
+    def __init__(self):
+        self.lifecycle = TunnelLifecycle()
+        self.timings = PhaseTimings()
+        self.desired = True
+        self.crashes = 0
+        self.starts = 0
+
+    async def asyncStartTunnel(self):
+        self.starts += 1
+        self.lifecycle.advance(STATE_STARTING)
+        if self.crashes:
+            self.crashes -= 1
+            self.lifecycle.advance(STATE_FAILED)
+        else:
+            self.lifecycle.advance(STATE_RUNNING)
+
+
+@pytest.fixture
+async def device():
+    device = Device()
+    yield device
+    # stopped on purpose, which cancels whatever is still planned
+    device.desired = False
+    device.lifecycle.advance(STATE_STOPPING)
+    device.lifecycle.advance(STATE_STOPPED)
+
+
+def supervise(device, **kwargs):
+    return TunnelSupervisor(device, delay=lambda attempt: 0, **kwargs)
+
+
+async def waitFor(predicate):
+    for _ in range(1000):
+        if predicate():
+            return
+        await asyncio.sleep(0.001)
+    raise AssertionError("timed out")
+
+
+@pytest.mark.parametrize(
+    "attempt, rand, expected",
+    [
+        (0, 0.0, 0.5),
+        (0, 1.0, 1.0),
+        (3, 0.0, 4.0),
+        (3, 0.5, 6.0),
+        # capped
+        (20, 0.0, 150.0),
+        (20, 1.0, 300.0),
+    ],
+)
+def test_backoff(attempt, rand, expected):
+    assert backoff(attempt, rand=lambda: rand) == expected
+
+
+async def test_restart_after_crash(device):
+    supervisor = supervise(device, stableAfter=0.01)
+    notified = []
+    supervisor.addListener(lambda: notified.append(supervisor.stats()))
+    await device.asyncStartTunnel()
+
+    device.lifecycle.advance(STATE_FAILED)
+    assert supervisor.stats()["consecutive_failures"] == 1
+    await waitFor(lambda: device.lifecycle.state == STATE_RUNNING)
+    assert device.starts == 2
+    stats = supervisor.stats()
+    assert stats["restarts"] == 1
+    assert stats["circuit"] == CIRCUIT_CLOSED
+    assert stats["last_recovery_s"] is not None
+    assert device.timings.stats(PHASE_RECOVERY)["count"] == 1
+
+    # up for long enough, the failures are forgiven
+    await waitFor(lambda: notified)
+    assert notified[-1]["consecutive_failures"] == 0
+
+
+async def test_circuit_breaker(device):
+    supervisor = supervise(device, maxRestarts=2, cooldown=0.05)
+    await device.asyncStartTunnel()
+
+    # the restarts crash too, the third crash in a row opens the circuit
+    device.crashes = 2
+    device.lifecycle.advance(STATE_FAILED)
+    await waitFor(lambda: supervisor.circuit == CIRCUIT_OPEN)
+    assert supervisor.restarts == 2
+    assert supervisor.failures == 3
+    assert device.lifecycle.state == STATE_FAILED
+
+    # one trial after the cool down, it crashes as well
+    device.crashes = 1
+    await waitFor(lambda: supervisor.restarts == 3)
+    assert supervisor.circuit == CIRCUIT_OPEN
+    assert device.lifecycle.state == STATE_FAILED
+
+    # the next trial comes up, half open until it has been up for a while
+    await waitFor(lambda: device.lifecycle.state == STATE_RUNNING)
+    assert supervisor.restarts == 4
+    assert supervisor.circuit == CIRCUIT_HALF_OPEN
+
+
+async def test_started_by_hand(device):
+    supervisor = supervise(device, maxRestarts=0, cooldown=60)
+    await device.asyncStartTunnel()
+    device.lifecycle.advance(STATE_FAILED)
+    assert supervisor.circuit == CIRCUIT_OPEN
+
+    # overrides the cool down and closes the circuit
+    await device.asyncStartTunnel()
+    assert supervisor.stats()["circuit"] == CIRCUIT_CLOSED
+    assert supervisor.stats()["consecutive_failures"] == 0
+    assert supervisor._task is None
+
+
+async def test_not_wanted(device):
+    supervisor = supervise(device)
+    await device.asyncStartTunnel()
+    device.desired = False
+    device.lifecycle.advance(STATE_FAILED)
+    await asyncio.sleep(0.01)
+    assert device.starts == 1
+    assert supervisor.stats()["consecutive_failures"] == 0
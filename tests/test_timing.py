@@ -0,0 +1,60 @@
+"""Rolling phase statistics and the timeouts learned from them."""
+import pytest
+
+from custom_components.ha_vscode.timing import PHASE_DEV_URL
+from custom_components.ha_vscode.timing import PHASE_STOP
+from custom_components.ha_vscode.timing import PhaseTimings
+
+
+@pytest.mark.parametrize(
+    "samples, default, expected",
+    [
+        # too few samples, the default
+        ((), 10.0, 10.0),
+        ((30.0, 30.0), 10.0, 10.0),
+        # still within bounds
+        ((), 0.5, 2.0),
+        ((), 600.0, 60.0),
+        # p95 * 1.5 + 1
+        ((2.0, 2.0, 2.0), 10.0, 4.0),
+        ((1.0, 2.0, 3.0, 4.0), 10.0, 7.0),
+        # a single slow one is the p95 of a small window
+        ((1.0,) * 18 + (10.0,), 10.0, 16.0),
+        # but not of a larger one
+        ((1.0,) * 19 + (10.0,), 10.0, 2.5),
+        # floor
+        ((0.1, 0.2, 0.3), 10.0, 2.0),
+        # ceiling
+        ((50.0, 50.0, 50.0), 10.0, 60.0),
+    ],
+)
+def test_timeout(samples, default, expected):
+    timings = PhaseTimings()
+    for seconds in samples:
+        timings.record(PHASE_DEV_URL, seconds)
+    assert timings.timeout(PHASE_DEV_URL, default) == expected
+
+
+def test_timeout_per_phase_and_bounds():
+    timings = PhaseTimings()
+    for _ in range(3):
+        timings.record(PHASE_STOP, 8.0)
+    assert timings.timeout(PHASE_STOP, 5.0, floor=1.0, ceiling=10.0) == 10.0
+    # the other phases have no history
+    assert timings.timeout(PHASE_DEV_URL, 5.0) == 5.0
+
+
+def test_window():
+    timings = PhaseTimings(window=3)
+    for seconds in (40.0, 40.0, 40.0, 1.0, 1.0, 1.0):
+        timings.record(PHASE_DEV_URL, seconds)
+    # the slow ones fell out
+    assert timings.stats(PHASE_DEV_URL)["max"] == 1.0
+    assert timings.timeout(PHASE_DEV_URL, 10.0) == 2.5
+
+
+def test_restore_keeps_the_recent_ones():
+    timings = PhaseTimings(window=3)
+    timings.record(PHASE_DEV_URL, 3.0)
+    timings.restore({PHASE_DEV_URL: [1.0, "x", 2.0, 5.0]})
+    assert timings.export()[PHASE_DEV_URL] == [2.0, 5.0, 3.0]
@@ -0,0 +1,114 @@
+"""The output ring buffer and the rate limited log."""
+import logging
+
+import pytest
+
+from custom_components.ha_vscode.tunnel_log import OutputBuffer
+from custom_components.ha_vscode.tunnel_log import RateLimitedLog
+
+
+def test_bounded_by_lines():
+    buffer = OutputBuffer(maxLines=3)
+    for number in range(5):
+        buffer.append(f"line {number}", at=number)
+    assert len(buffer) == 3
+    assert buffer.dropped == 2
+    assert buffer.snapshot() == [(2, "line 2"), (3, "line 3"), (4, "line 4")]
+
+
+def test_bounded_by_bytes():
+    buffer = OutputBuffer(maxBytes=10)
+    buffer.append("abcd", at=1)
+    buffer.append("efgh", at=2)
+    assert len(buffer) == 2
+    # 12 bytes, the oldest goes
+    buffer.append("ijkl", at=3)
+    assert buffer.snapshot() == [(2, "efgh"), (3, "ijkl")]
+    assert buffer.dropped == 1
+
+
+def test_long_line_is_cut():
+    buffer = OutputBuffer(maxBytes=10)
+    buffer.append("abc", at=1)
+    buffer.append("x" * 25, at=2)
+    # fills the buffer on its own
+    assert buffer.snapshot() == [(2, "x" * 10)]
+    assert buffer.dropped == 1
+
+
+@pytest.mark.parametrize(
+    "limit, expected",
+    [(None, ["a", "b", "c"]), (2, ["b", "c"]), (0, []), (9, ["a", "b", "c"])],
+)
+def test_snapshot_limit(limit, expected):
+    buffer = OutputBuffer()
+    for line in "abc":
+        buffer.append(line)
+    assert [line for _, line in buffer.snapshot(limit)] == expected
+
+
+def test_listeners():
+    buffer = OutputBuffer()
+    seen = []
+    remove = buffer.addListener(lambda at, line: seen.append((at, line)))
+    buffer.append("one", at=1)
+    remove()
+    buffer.append("two", at=2)
+    assert seen == [(1, "one")]
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def logger(caplog):
+    caplog.set_level(logging.DEBUG, "tests.tunnel")
+    return logging.getLogger("tests.tunnel")
+
+
+def messages(caplog):
+    return [record.getMessage() for record in caplog.records]
+
+
+def test_burst_then_summary(logger, caplog):
+    clock = Clock()
+    log = RateLimitedLog(logger, rate=2.0, burst=3, clock=clock)
+    for number in range(5):
+        log.debug("line %d", number)
+    assert messages(caplog) == ["line 0", "line 1", "line 2"]
+    assert log.suppressed == 2
+
+    # half a second buys one more, which says what was held back
+    clock.now = 0.5
+    log.debug("line %d", 5)
+    assert messages(caplog)[3:] == [
+        "2 lines of tunnel output were not logged",
+        "line 5",
+    ]
+    assert log.suppressed == 0
+
+
+def test_refill_is_capped_at_the_burst(logger, caplog):
+    clock = Clock()
+    log = RateLimitedLog(logger, rate=2.0, burst=3, clock=clock)
+    clock.now = 60.0
+    for number in range(5):
+        log.warning("line %d", number)
+    assert len(caplog.records) == 3
+    assert all(record.levelno == logging.WARNING for record in caplog.records)
+
+
+def test_nothing_when_disabled(caplog):
+    caplog.set_level(logging.INFO, "tests.quiet")
+    log = RateLimitedLog(logging.getLogger("tests.quiet"), burst=1, clock=Clock())
+    for number in range(5):
+        log.debug("line %d", number)
+    # neither logged nor counted, and no tokens spent
+    assert log.suppressed == 0
+    log.warning("shown")
+    assert messages(caplog) == ["shown"]
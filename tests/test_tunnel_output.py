@@ -0,0 +1,89 @@
+"""The tunnel output parser against the transcripts the benchmarks replay."""
+import os
+
+import pytest
+
+from custom_components.ha_vscode.tunnel_output import EVENT_CONNECTED
+from custom_components.ha_vscode.tunnel_output import EVENT_DEVICE_CODE
+from custom_components.ha_vscode.tunnel_output import EVENT_DISCONNECTED
+from custom_components.ha_vscode.tunnel_output import EVENT_ERROR
+from custom_components.ha_vscode.tunnel_output import EVENT_LICENSE_PROMPT
+from custom_components.ha_vscode.tunnel_output import EVENT_PATTERNS
+from custom_components.ha_vscode.tunnel_output import EVENT_TUNNEL_URL
+from custom_components.ha_vscode.tunnel_output import EVENT_UPDATE_AVAILABLE
+from custom_components.ha_vscode.tunnel_output import TunnelOutputParser
+
+TRANSCRIPTS = os.path.join(
+    os.path.dirname(__file__), os.pardir, "benchmarks", "transcripts"
+)
+URL = "https://vscode.dev/tunnel/ha-sunny-pi/"
+
+# line number: (event type, value). Every other line is no event
+EXPECTED = {
+    "first_run.txt": {
+        5: (EVENT_LICENSE_PROMPT, None),
+        9: (EVENT_DEVICE_CODE, "3F2A-91BC"),
+        11: (EVENT_TUNNEL_URL, URL),
+    },
+    "session.txt": {
+        5: (EVENT_LICENSE_PROMPT, None),
+        9: (EVENT_TUNNEL_URL, URL),
+        10: (EVENT_CONNECTED, "2"),
+        16: (EVENT_CONNECTED, "3"),
+        18: (EVENT_DISCONNECTED, "3"),
+        19: (EVENT_DISCONNECTED, "2"),
+        20: (
+            EVENT_UPDATE_AVAILABLE,
+            "new version of Visual Studio Code CLI is available (1.81.0). "
+            "Run `code update` to update.",
+        ),
+        21: (EVENT_ERROR, "Error connecting to tunnel: websocket closed unexpectedly"),
+        23: (EVENT_CONNECTED, "2"),
+    },
+}
+
+
+def transcript(name):
+    with open(os.path.join(TRANSCRIPTS, name), encoding="utf-8") as file:
+        return [line.strip() for line in file]
+
+
+@pytest.mark.parametrize("name", sorted(EXPECTED))
+def test_transcript(name):
+    parser = TunnelOutputParser()
+    for event_type in EVENT_PATTERNS:
+        parser.subscribe(event_type, lambda event: None)
+    events = {}
+    for number, line in enumerate(transcript(name), 1):
+        event = parser.classify(line)
+        if event is not None:
+            assert event.line == line
+            events[number] = (event.type, event.value)
+    assert events == EXPECTED[name]
+
+
+def test_only_subscribed_events():
+    parser = TunnelOutputParser()
+    codes = []
+    urls = []
+    parser.subscribe(EVENT_DEVICE_CODE, codes.append)
+    unsubscribe = parser.subscribe(EVENT_TUNNEL_URL, urls.append)
+    for line in transcript("first_run.txt"):
+        parser.feed(line)
+    assert [event.value for event in codes] == ["3F2A-91BC"]
+    assert [event.value for event in urls] == [URL]
+
+    unsubscribe()
+    assert parser.feed("Open this link in your browser " + URL + "config") is None
+    # the license terms are nobody's business here
+    assert parser.classify(transcript("first_run.txt")[4]) is None
+
+
+def test_no_subscribers():
+    parser = TunnelOutputParser()
+    assert all(parser.feed(line) is None for line in transcript("session.txt"))
+
+
+def test_unknown_event_type():
+    with pytest.raises(ValueError):
+        TunnelOutputParser().subscribe("bogus", lambda event: None)
@@ -0,0 +1,106 @@
+"""Background checks for new CLI builds, against a fake upstream."""
+import asyncio
+
+import pytest
+
+from custom_components.ha_vscode.exceptions import HAVSCodeDownloadException
+from custom_components.ha_vscode.lifecycle import route
+from custom_components.ha_vscode.lifecycle import STATE_RUNNING
+from custom_components.ha_vscode.lifecycle import STATE_STOPPED
+from custom_components.ha_vscode.vscode_device import VSCodeDeviceAPI
+from tests.test_cli_cache import Upstream
+
+
+class Offline:
+    async def stream(self, url, sink, progress=None, headers=None):
+        raise HAVSCodeDownloadException()
+
+
+@pytest.fixture
+async def device(tmp_path):
+    device = VSCodeDeviceAPI(str(tmp_path))
+    device.downloader = Upstream()
+    device.downloader.publish("1.0.0")
+    await device.cache.fetch(device.downloader, device.cliDownloadURL())
+    device.record.update(cliVersion="1.0.0")
+    yield device
+    for step in route(device.lifecycle.state, STATE_STOPPED) or ():
+        device.lifecycle.advance(step)
+    await device.asyncClose()
+
+
+def run(device):
+    for step in route(device.lifecycle.state, STATE_RUNNING):
+        device.lifecycle.advance(step)
+
+
+async def test_stages_while_running(device):
+    updater = device.updater
+    checks = []
+    updater.addListener(lambda: checks.append(updater.stats()))
+    run(device)
+    device.downloader.publish("2.0.0")
+
+    build = await updater.check()
+    assert build["version"] == "2.0.0"
+    # the running tunnel keeps its build until it stops
+    assert device.cache.current()["version"] == "1.0.0"
+    assert checks == [
+        {
+            "cli_version": "1.0.0",
+            "cli_staged": "2.0.0",
+            "cli_checked": updater.lastCheck,
+        }
+    ]
+
+    await device.promoteCLI()
+    assert device.cache.current()["version"] == "2.0.0"
+    assert updater.stats()["cli_version"] == "2.0.0"
+    assert updater.stats()["cli_staged"] is None
+
+
+async def test_promotes_when_stopped(device):
+    device.downloader.publish("2.0.0")
+    await device.updater.check()
+    assert device.cache.current()["version"] == "2.0.0"
+    assert device.cache.staged() is None
+    assert device.record.cliVersion == "2.0.0"
+
+
+async def test_nothing_new(device):
+    build = await device.updater.check()
+    assert build["version"] == "1.0.0"
+    assert device.cache.staged() is None
+
+
+async def test_failed_check(device):
+    device.downloader = Offline()
+    checks = []
+    device.updater.addListener(lambda: checks.append(device.updater.stats()))
+    assert await device.updater.check() is None
+    assert device.updater.lastError is not None
+    # told all the same, the time of the check changed
+    assert checks[-1]["cli_checked"] is not None
+    assert device.cache.current()["version"] == "1.0.0"
+
+
+async def test_periodic(device):
+    updater = device.updater
+    checks = []
+    updater.addListener(lambda: checks.append(updater.stats()))
+    device.downloader.publish("2.0.0")
+    updater.configure(0.01, 0)
+    for _ in range(500):
+        if len(checks) >= 2:
+            break
+        await asyncio.sleep(0.01)
+    assert len(checks) >= 2
+    assert device.cache.current()["version"] == "2.0.0"
+
+    # the same options again leave the schedule alone
+    task = updater._task
+    updater.configure(0.01, 0)
+    assert updater._task is task
+    updater.configure(0)
+    assert updater._task is None
+    assert task.cancelling()
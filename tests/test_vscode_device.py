@@ -0,0 +1,266 @@
+"""The tunnel device against stand-ins for the code CLI."""
+import asyncio
+import signal
+import sys
+import time
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+from unittest.mock import patch
+
+import pytest
+
+from custom_components.ha_vscode.lifecycle import STATE_AWAITING_AUTH
+from custom_components.ha_vscode.lifecycle import STATE_FAILED
+from custom_components.ha_vscode.lifecycle import STATE_RUNNING
+from custom_components.ha_vscode.lifecycle import STATE_STARTING
+from custom_components.ha_vscode.lifecycle import STATE_STOPPED
+from custom_components.ha_vscode.lifecycle import STATE_STOPPING
+from custom_components.ha_vscode.process_tree import descendants
+from custom_components.ha_vscode.process_tree import survivors
+from custom_components.ha_vscode.vscode_device import AUTH_PROBE_TTL
+from custom_components.ha_vscode.vscode_device import AuthState
+from custom_components.ha_vscode.vscode_device import KILL_TIMEOUT
+from custom_components.ha_vscode.vscode_device import readLines
+from custom_components.ha_vscode.vscode_device import VSCodeDeviceAPI
+
+DEVICE_CODE = (
+    "To grant access to the server, please log into "
+    "https://github.com/login/device and use code ABCD-1234"
+)
+DEV_URL = "https://vscode.dev/tunnel/den/"
+# four times what a StreamReader buffers by default
+LONG = 4 * 64 * 1024
+
+
+@pytest.fixture
+async def device(tmp_path):
+    device = VSCodeDeviceAPI(str(tmp_path))
+    yield device
+    # where _stop leaves it, so nothing keeps sampling the tunnel
+    device.lifecycle.advance(STATE_STOPPING)
+    device.lifecycle.advance(STATE_STOPPED)
+    await device.asyncClose()
+
+
+async def spawn(directory, *lines):
+    """A process that prints lines and exits, in place of `code tunnel`."""
+    transcript = directory / "transcript.txt"
+    transcript.write_text("".join(line + "\n" for line in lines))
+    return await asyncio.create_subprocess_exec(
+        "cat",
+        str(transcript),
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+    )
+
+
+def started(device):
+    # what asyncStartTunnel sets up before it spawns the cli
+    loop = asyncio.get_running_loop()
+    device._tokenFuture = loop.create_future()
+    device._devURLFuture = loop.create_future()
+    device.lifecycle.advance(STATE_STARTING)
+
+
+async def test_long_lines():
+    stream = asyncio.StreamReader(limit=16)
+    lines = readLines(stream)
+    stream.feed_data(b"one\n" + b"x" * 40)
+    assert await lines.__anext__() == b"one\n"
+    # no newline in sight yet, what is buffered is the line
+    assert await lines.__anext__() == b"x" * 40
+    stream.feed_data(b"x" * 40 + b"\ntwo\n" + b"y" * 40 + b"\nthree")
+    stream.feed_eof()
+    # the rest of it is dropped, a complete long line is handed out once
+    assert [line async for line in lines] == [b"two\n", b"y" * 40, b"three"]
+
+
+async def test_reader_parses_past_a_long_line(tmp_path, device):
+    started(device)
+    device.proc = await spawn(tmp_path, DEVICE_CODE, "z" * LONG, "Open " + DEV_URL)
+    await asyncio.wait_for(device.reader(device.proc), 10)
+
+    assert device._tokenFuture.result() == "ABCD-1234"
+    assert device._devURLFuture.result() == DEV_URL
+    assert device.oauthToken == "ABCD-1234"
+    assert device.devURL == DEV_URL
+    assert device.output.snapshot()[-1][1] == "Open " + DEV_URL
+    # the process exited without being asked to
+    assert device.lifecycle.state == STATE_FAILED
+    await device.proc.wait()
+
+
+async def test_reader_settles_the_waits_at_eof(tmp_path, device):
+    started(device)
+    device.proc = await spawn(tmp_path, "* Visual Studio Code Server")
+    await asyncio.wait_for(device.reader(device.proc), 10)
+    # nothing more is coming, nobody is kept waiting for it
+    assert device._tokenFuture.result() is None
+    assert device._devURLFuture.result() is None
+    assert await device.waitForAuth(timeout=1) == (None, None)
+    await device.proc.wait()
+
+
+async def test_device_code_then_url(device):
+    started(device)
+    device.parser.feed(DEVICE_CODE)
+    assert device.lifecycle.state == STATE_AWAITING_AUTH
+    assert await device.waitForAuth(timeout=1) == ("ABCD-1234", None)
+    device.parser.feed("Open " + DEV_URL)
+    assert device.lifecycle.state == STATE_RUNNING
+    assert await device.getDevURL(timeout=1) == DEV_URL
+    assert device.record.tunnelName == "den"
+
+
+def answers(user, status):
+    """_runCLI in place of `code tunnel user show` and `code tunnel status`."""
+
+    async def runCLI(*args, **kwargs):
+        return user if args[1] == "user" else status
+
+    return AsyncMock(side_effect=runCLI)
+
+
+@pytest.mark.parametrize(
+    "user, status, expected",
+    [
+        (
+            (0, "Logged in with provider github"),
+            (0, '{"tunnel": {"name": "den"}, "service_installed": false}'),
+            AuthState(True, "github", "den", DEV_URL, True),
+        ),
+        (
+            (1, "Not logged in"),
+            (0, '{"tunnel": null}'),
+            AuthState(False, None, None, None, False),
+        ),
+        # output we can't read tells us nothing about the tunnel
+        (
+            (0, "Logged in with provider microsoft"),
+            (0, "Tunnel status: {not json"),
+            AuthState(True, "microsoft", None, None, False),
+        ),
+        (
+            (0, "Logged in with provider github"),
+            (0, '["den"]'),
+            AuthState(True, "github", None, None, False),
+        ),
+        # an old cli without the status subcommands
+        ((None, ""), (None, ""), AuthState(None, None, None, None, False)),
+    ],
+)
+async def test_probe_auth(device, user, status, expected):
+    with patch.object(device, "_runCLI", answers(user, status)):
+        assert await device.probeAuth() == expected
+    if expected.authenticated is not None:
+        assert device.record.authenticated == expected.authenticated
+    assert device.record.tunnelName == expected.tunnelName
+
+
+async def test_probe_auth_cached(device):
+    runCLI = answers((0, "Logged in with provider github"), (0, '{"tunnel": null}'))
+    with patch.object(device, "_runCLI", runCLI):
+        first = await device.probeAuth()
+        assert await device.probeAuth() is first
+        assert runCLI.await_count == 2
+
+        # the answer has expired
+        device._authStateAt -= AUTH_PROBE_TTL + 1
+        assert await device.probeAuth() == first
+        assert runCLI.await_count == 4
+
+
+@pytest.fixture
+async def operations(device):
+    """asyncStartTunnel and asyncStopTunnel taking a moment each, in the order
+    they ran."""
+    ran = []
+
+    async def start(profile=None):
+        ran.append("start")
+        device.lifecycle.advance(STATE_STARTING)
+        await asyncio.sleep(0.01)
+        # no pid, there is nothing to sample or signal
+        device.proc = SimpleNamespace(pid=None, returncode=None)
+        device.lifecycle.advance(STATE_RUNNING)
+
+    async def stop():
+        ran.append("stop")
+        device.lifecycle.advance(STATE_STOPPING)
+        await asyncio.sleep(0.01)
+        device.proc = None
+        device.lifecycle.advance(STATE_STOPPED)
+
+    with patch.object(device, "asyncStartTunnel", start), patch.object(
+        device, "asyncStopTunnel", stop
+    ):
+        yield ran
+        if device._reconciler is not None:
+            await device._reconciler
+
+
+async def test_toggles_coalesce(device, operations):
+    # the first toggle starts the tunnel, the others only change what it is for
+    await asyncio.gather(
+        *(device.asyncSetDesired(running) for running in (True, False, True, True))
+    )
+    assert operations == ["start"]
+    assert device.lifecycle.state == STATE_RUNNING
+
+    await asyncio.gather(
+        *(device.asyncSetDesired(running) for running in (False, True, False))
+    )
+    assert operations == ["start", "stop"]
+    assert device.lifecycle.state == STATE_STOPPED
+
+
+async def test_toggles_while_starting(device, operations):
+    on = asyncio.create_task(device.asyncSetDesired(True))
+    while device.lifecycle.state != STATE_STARTING:
+        await asyncio.sleep(0)
+    toggles = [
+        asyncio.create_task(device.asyncSetDesired(running))
+        for running in (False, True, False)
+    ]
+    await asyncio.gather(on, *toggles)
+    # the start under way finishes, then the last of the toggles wins
+    assert operations == ["start", "stop"]
+    assert device.lifecycle.state == STATE_STOPPED
+
+
+STUBBORN = """
+import signal, subprocess, sys, time
+signal.signal(signal.SIGTERM, signal.SIG_IGN)
+server = [sys.executable, "-c", "import time; time.sleep(60)"]
+# one child in the tunnel's group, one that left it and only the tree finds
+subprocess.Popen(server)
+subprocess.Popen(server, start_new_session=True)
+print("up", flush=True)
+time.sleep(60)
+"""
+
+
+async def test_stop_escalates_to_the_whole_tree(tmp_path):
+    device = VSCodeDeviceAPI(str(tmp_path), stopGrace=0.2)
+    # what asyncStartTunnel spawns, a group of its own that ignores SIGTERM
+    device.proc = await asyncio.create_subprocess_exec(
+        sys.executable,
+        "-c",
+        STUBBORN,
+        stdout=asyncio.subprocess.PIPE,
+        start_new_session=True,
+    )
+    device.lifecycle.advance(STATE_STARTING)
+    assert await device.proc.stdout.readline() == b"up\n"
+    tree = descendants(device.proc.pid)
+    assert len(tree) == 2
+
+    proc = device.proc
+    started = time.monotonic()
+    await device.asyncStopTunnel()
+    assert time.monotonic() - started < device.stopGrace + KILL_TIMEOUT
+    assert proc.returncode == -signal.SIGKILL
+    assert survivors(tree) == []
+    assert device.proc is None
+    assert device.lifecycle.state == STATE_STOPPED
+    await device.asyncClose()